@@ -1,11 +1,17 @@
 # Requires Python 3.8
-from flask import Flask, request, session, redirect, url_for, render_template
-from flask_session import Session  # https://pythonhosted.org/Flask-Session
+from flask import Flask, request, session, redirect, url_for, render_template, jsonify, stream_with_context
+from contextlib import contextmanager
+import click
 import logging
 import msal
 import uuid
+import threading
 # Import local files
-from azstorage import UserStorageSession, AzureStorage
+from azstorage import UserStorageSession, AzureStorage, Response
+from multipart_stream import parse_upload_request, iter_upload_files
+from session_store import init_session, compact_token_cache
+from assets import init_assets
+from metrics import REQUESTS_IN_FLIGHT
 import app_config
 
 # Configure Default Logger - used by some imported modules like msal
@@ -22,7 +28,8 @@ logger.addHandler(ch)
 
 app = Flask(__name__, instance_relative_config=True)
 app.config.from_object(app_config)
-Session(app)
+init_session(app)
+init_assets(app)
 
 # This section is needed for url_for("foo", _external=True) to automatically
 # generate http scheme when this sample is running on localhost,
@@ -34,10 +41,47 @@ app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 # Create the Azure Storage connection object based on the app_config.py
 azure_storage = AzureStorage(app.config)
+# Acquire the storage token and open connections before the worker is reported ready
+azure_storage.start_warm_up()
+
+
+# Count the requests being handled, a request is done once its context is torn down
+@app.before_request
+def track_request_start():
+    REQUESTS_IN_FLIGHT.inc()
+
+
+@app.teardown_request
+def track_request_end(exception=None):
+    REQUESTS_IN_FLIGHT.dec()
+
+
+# Tag blobs uploaded before BLOB_INDEX_TAGS was enabled with their upload user
+# Run from the app folder with: FLASK_APP=app.py flask backfill-tags
+@app.cli.command('backfill-tags')
+@click.option('--concurrency', default=16, help="Number of blobs tagged at once")
+def backfill_tags(concurrency):
+    tagged, failed = azure_storage.backfill_tags(concurrency)
+    click.echo("Tagged " + str(tagged) + " blobs, " + str(failed) + " failed")
+
+
+# Liveness probe, answered without touching storage so storage outages don't restart pods
+# A worker that can no longer serve requests fails it by not answering within the probe timeout
+@app.route('/healthz')
+def healthz():
+    return jsonify(status="ok")
+
+
+# Readiness probe, fails until the storage clients of this worker have been warmed up
+@app.route('/readyz')
+def readyz():
+    if not azure_storage.ready:
+        return jsonify(status="starting"), 503
+    return jsonify(status="ready")
 
 
 # Main page handling
-@app.route('/', methods=['GET', 'POST'])
+@app.route('/')
 # @auth('user')
 def index():
     # check if user logged in, if not redirect to login
@@ -46,25 +90,11 @@ def index():
 
     auth = azure_storage.validate_user(session, request)
     response = auth['response']
-    # If authorization was successful
+    # If authorization was successful show the page without a message. The file table
+    # is loaded page by page from /api/blobs and uploads and deletes are handled by
+    # their own endpoints, so the page itself needs no listing
     if response.status_code==200:
-    
-        # Create user session object
-        user_session = UserStorageSession(auth['path'], auth['user'])
-
-        # Get blobs and folders for selected path and user
-        response = azure_storage.walk_blobs(user_session)
-
-        # If request is a Post, handle the file upload
-        if request.method == 'POST':
-            file = request.files['file']
-            subfolder = request.form['subfolder']
-            response = azure_storage.upload_blob(file, subfolder, user_session)
-
-        # Check for delete flag and handle blob deletion
-        delete = request.args.get('delete')
-        if delete:
-            response = azure_storage.delete_blob(user_session, request.args.get('blob'))
+        response = Response()
 
     # If response is empty or error_flags are set return the appropriate error,
     # else return the valid response
@@ -76,13 +106,283 @@ def index():
     elif response.error_flag == 2:
         return response.message, response.status_code
     else:
-        return render_template('base.html',
-                            message=response.message,
-                            blobs=user_session.blob_table,
-                            user=auth['user'],
-                            folders=auth['folder_access'],
-                            current_folder=auth['current_folder'],
-                            subfolders=user_session.folder_list), response.status_code
+        return app.response_class(_stream_template('base.html',
+                                                   message=response.message,
+                                                   chunk_size=app_config.UPLOAD_CHUNK_SIZE,
+                                                   parallel_chunks=app_config.UPLOAD_PARALLEL_CHUNKS,
+                                                   batch_size=app_config.UPLOAD_BATCH_SIZE,
+                                                   direct_upload=app_config.DIRECT_UPLOAD,
+                                                   upload_dedupe=azure_storage.upload_dedupe,
+                                                   user=auth['user'],
+                                                   folders=auth['folder_access'],
+                                                   current_folder=auth['current_folder'])), response.status_code
+
+
+# Upload a file posted by Dropzone to the selected folder
+# Returns the new table entry so the page can add it without reloading the listing
+@app.route('/upload', methods=['POST'])
+def upload():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    # Parse the body as it arrives instead of using request.files, which spools the whole
+    # file to memory or disk before the upload to storage can start
+    try:
+        form, file = parse_upload_request(request, app_config.UPLOAD_BUFFER_SIZE)
+    except ValueError as e:
+        logger.warning(auth['user'] + " sent an invalid upload request: " + str(e))
+        return _json_response(Response(message="Invalid upload request", status_code=400))
+    if file is None:
+        return _json_response(Response(message="Must select a file to upload first!", status_code=400))
+
+    # Chunked uploads send the Dropzone chunk parameters with every chunk
+    if 'dzuuid' in form:
+        response = azure_storage.stage_chunk(file,
+                                             form.get('subfolder', ''),
+                                             user_session,
+                                             form['dzuuid'],
+                                             form.get('dzchunkindex'),
+                                             chunk_length(form))
+        return _json_response(response)
+
+    response = azure_storage.upload_blob(file, form.get('subfolder', ''), user_session, request.content_length)
+    if response.status_code != 200:
+        return _json_response(response)
+    return _json_response(response, blob=user_session.blob_table[-1])
+
+
+# Upload several small files posted by Dropzone in one request
+# The files are uploaded concurrently and the response lists the outcome and table entry of each file
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    try:
+        response = azure_storage.upload_blobs(iter_upload_files(request, app_config.UPLOAD_BUFFER_SIZE), user_session)
+    except ValueError as e:
+        logger.warning(auth['user'] + " sent an invalid batch upload request: " + str(e))
+        return _json_response(Response(message="Invalid upload request", status_code=400))
+    return _json_response(response, results=user_session.upload_results)
+
+
+# Authorize the browser to upload one file straight to storage with a short lived SAS URL
+@app.route('/upload/direct', methods=['POST'])
+def upload_direct():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    response = azure_storage.create_upload_sas(request.form.get('filename'),
+                                               request.form.get('subfolder', ''),
+                                               user_session)
+    return _json_response(response, url=user_session.upload_url, upload_id=user_session.upload_id)
+
+
+# Commit a direct upload once the browser has staged all blocks of the file
+@app.route('/upload/direct/finalize', methods=['POST'])
+def upload_direct_finalize():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    response = azure_storage.complete_direct_upload(request.form.get('filename'),
+                                                    request.form.get('subfolder', ''),
+                                                    user_session,
+                                                    request.form.get('upload_id', ''),
+                                                    request.form.get('block_count'),
+                                                    request.form.get('content_type'),
+                                                    request.form.get('md5'))
+    if response.status_code != 200:
+        return _json_response(response)
+    return _json_response(response, blob=user_session.blob_table[-1])
+
+
+# Get the chunks of a chunked upload that are already staged, used to resume an interrupted upload
+@app.route('/upload/status')
+def upload_status():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    response = azure_storage.list_staged_chunks(request.args.get('filename'),
+                                                request.args.get('subfolder', ''),
+                                                user_session,
+                                                request.args.get('dzuuid', ''))
+    return _json_response(response, staged=user_session.staged_chunks)
+
+
+# Commit all chunks of a chunked upload once Dropzone has sent the last one
+@app.route('/upload/finalize', methods=['POST'])
+def upload_finalize():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    response = azure_storage.commit_chunks(request.form.get('filename'),
+                                           request.form.get('subfolder', ''),
+                                           user_session,
+                                           request.form.get('dzuuid', ''),
+                                           request.form.get('dztotalchunkcount'),
+                                           request.form.get('md5'))
+    if response.status_code != 200:
+        return _json_response(response)
+    return _json_response(response, blob=user_session.blob_table[-1])
+
+
+# Upload a file the user already uploaded elsewhere by copying it in storage, given the MD5 and size of the file
+# The page sends the file itself if no copy was made
+@app.route('/upload/dedupe', methods=['POST'])
+def upload_dedupe():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    response = azure_storage.copy_duplicate(request.form.get('filename'),
+                                            request.form.get('subfolder', ''),
+                                            user_session,
+                                            request.form.get('md5'),
+                                            request.form.get('size'),
+                                            list(auth['folder_paths'].values()))
+    if response.status_code != 200:
+        return _json_response(response)
+    return _json_response(response, blob=user_session.blob_table[-1])
+
+
+# Delete a single file, authorized against the uploaded_by metadata of the blob itself
+@app.route('/delete', methods=['POST'])
+def delete():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    blob_name = request.form.get('blob')
+    response = azure_storage.delete_blob(user_session, blob_name)
+    return _json_response(response, blob=blob_name)
+
+
+# Delete the files selected in the file table, every "blob" field of the form is one blob name
+# The response lists whether each blob was deleted, a file that could not be deleted does not fail the others
+@app.route('/delete/bulk', methods=['POST'])
+def delete_bulk():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    response = azure_storage.delete_blobs(user_session, request.form.getlist('blob'))
+    return _json_response(response, results=user_session.delete_results)
+
+
+# Stream a file from the selected folder, with support for Range and If-None-Match requests
+@app.route('/download')
+def download():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    response = azure_storage.download_blob(user_session,
+                                           request.args.get('blob'),
+                                           request.range,
+                                           request.if_none_match,
+                                           request.if_range if 'If-Range' in request.headers else None)
+    if response.status_code != 200:
+        return _json_response(response)
+    return _download_response(user_session.download)
+
+
+# Stream the files of the selected folder whose path starts with the optional prefix as a ZIP archive
+@app.route('/download/zip')
+def download_zip():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    response = azure_storage.download_folder(user_session, request.args.get('prefix', ''))
+    if response.status_code != 200:
+        return _json_response(response)
+    return _download_response(user_session.download)
+
+
+# Get one page of blobs for the file table, continuing from the token of the previous page
+@app.route('/api/blobs')
+def api_blobs():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    # Only the files of the current user, found by their blob index tag when tags are enabled
+    if request.args.get('mine') == '1':
+        list_page = azure_storage.list_user_blobs_page
+    else:
+        list_page = azure_storage.list_blobs_page
+    response = list_page(user_session, request.args.get('prefix', ''), request.args.get('continuation'))
+    if response.status_code != 200:
+        return _json_response(response)
+    return jsonify(blobs=user_session.blob_table, continuation=user_session.continuation)
+
+
+# Get the subfolders of the selected folder for the optional subfolder list
+@app.route('/api/folders')
+def api_folders():
+    auth = _validate_api_user()
+    if auth['response'].status_code != 200:
+        return _json_response(auth['response'])
+
+    user_session = UserStorageSession(auth['path'], auth['user'])
+    response = azure_storage.list_folders(user_session)
+    if response.status_code != 200:
+        return _json_response(response)
+    return jsonify(folders=user_session.folder_list)
+
+
+# Size of a Dropzone chunk, the last chunk of a file is usually shorter than the chunk size
+def chunk_length(form):
+    try:
+        return min(int(form['dzchunksize']), int(form['dztotalfilesize']) - int(form['dzchunkbyteoffset']))
+    except (KeyError, ValueError):
+        return None
+
+
+# Render a template while it is sent, so the browser can start loading the page
+# and its scripts before the rest of the template has been rendered
+def _stream_template(template_name, **context):
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    return stream_with_context(template.generate(context))
+
+
+# Send a download prepared by AzureStorage, the content is passed through as it is read from storage
+def _download_response(download):
+    return app.response_class(download['body'], status=download['status'], headers=download['headers'],
+                              direct_passthrough=True)
+
+
+# API requests are not redirected to the login page, they get a 401 instead
+def _validate_api_user():
+    if not session.get("user"):
+        return dict(response=Response(message="User not logged in", status_code=401, error_flag=2))
+    return azure_storage.validate_user(session, request)
+
+
+# Convert a Response object to JSON, errors are returned in the "error" field that Dropzone displays
+def _json_response(response, **data):
+    if response.status_code != 200:
+        return jsonify(error=response.message, **data), response.status_code
+    return jsonify(message=response.message, **data), response.status_code
 
 
 @app.route("/login")
@@ -101,15 +401,14 @@ def authorized():
     if "error" in request.args:  # Authentication/Authorization failure
         return render_template("auth_error.html", result=request.args)
     if request.args.get('code'):
-        cache = _load_cache()
-        result = _build_msal_app(cache=cache).acquire_token_by_authorization_code(
+        redirect_uri = url_for("authorized", _external=True)
+        result = _with_session_cache(lambda cca: cca.acquire_token_by_authorization_code(
             request.args['code'],
             scopes=app_config.SCOPE,  # Misspelled scope would cause an HTTP 400 error here
-            redirect_uri=url_for("authorized", _external=True))
+            redirect_uri=redirect_uri))
         if "error" in result:
             return render_template("auth_error.html", result=result)
         session["user"] = result.get("id_token_claims")
-        _save_cache(cache)
     return redirect(url_for("index"))
 
 
@@ -122,39 +421,68 @@ def logout():
         "?post_logout_redirect_uri=" + url_for("index", _external=True))
 
 
-def _load_cache():
-    cache = msal.SerializableTokenCache()
-    if session.get("token_cache"):
-        cache.deserialize(session["token_cache"])
-    return cache
+def _load_cache(cache):
+    cache.deserialize(session.get("token_cache"))  # Replaces whatever the cache held before
 
 
 def _save_cache(cache):
     if cache.has_state_changed:
-        session["token_cache"] = cache.serialize()
-
-
-def _build_msal_app(cache=None, authority=None):
-    return msal.ConfidentialClientApplication(
-        app_config.CLIENT_ID, authority=authority or app_config.AUTHORITY,
-        client_credential=app_config.CLIENT_SECRET, token_cache=cache)
+        session["token_cache"] = compact_token_cache(cache.serialize())
+
+
+# MSAL apps are reused per authority and worker, as creating one runs authority discovery
+# An app is used by one request at a time, which loads the token cache of its session into it.
+# Idle apps wait in _msal_apps and a new app is only created when all apps of the authority are
+# in use, so no request waits for the calls of another request to Azure AD.
+_msal_apps = {}
+_msal_apps_lock = threading.Lock()
+
+
+@contextmanager
+def _msal_app(authority=None):
+    authority = authority or app_config.AUTHORITY
+    with _msal_apps_lock:
+        idle = _msal_apps.setdefault(authority, [])
+        cca = idle.pop() if idle else None
+    if cca is None:
+        cca = msal.ConfidentialClientApplication(
+            app_config.CLIENT_ID, authority=authority,
+            client_credential=app_config.CLIENT_SECRET, token_cache=msal.SerializableTokenCache())
+    try:
+        yield cca
+    finally:
+        with _msal_apps_lock:
+            _msal_apps[authority].append(cca)
+
+
+# Call func with an MSAL app whose token cache holds the cache of this session
+# This web app maintains one cache per session, which is loaded into the app and saved
+# back before the app is used by another request, so sessions never see each other's tokens
+def _with_session_cache(func, authority=None):
+    with _msal_app(authority) as cca:
+        _load_cache(cca.token_cache)
+        try:
+            result = func(cca)
+            _save_cache(cca.token_cache)
+        finally:
+            cca.token_cache.deserialize(None)
+    return result
 
 
 def _build_auth_url(authority=None, scopes=None, state=None):
-    return _build_msal_app(authority=authority).get_authorization_request_url(
-        scopes or [],
-        state=state or str(uuid.uuid4()),
-        redirect_uri=url_for("authorized", _external=True))
+    with _msal_app(authority) as cca:  # Building the URL does not use the token cache
+        return cca.get_authorization_request_url(
+            scopes or [],
+            state=state or str(uuid.uuid4()),
+            redirect_uri=url_for("authorized", _external=True))
 
 
 def _get_token_from_cache(scope=None):
-    cache = _load_cache()  # This web app maintains one cache per session
-    cca = _build_msal_app(cache=cache)
-    accounts = cca.get_accounts()
-    if accounts:  # So all account(s) belong to the current signed-in user
-        result = cca.acquire_token_silent(scope, account=accounts[0])
-        _save_cache(cache)
-        return result
+    def acquire_token(cca):
+        accounts = cca.get_accounts()
+        if accounts:  # So all account(s) belong to the current signed-in user
+            return cca.acquire_token_silent(scope, account=accounts[0])
+    return _with_session_cache(acquire_token)
 
 
 app.jinja_env.globals.update(_build_auth_url=_build_auth_url)  # Used in template
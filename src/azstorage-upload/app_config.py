@@ -20,6 +20,114 @@ CLIENT_SECRET = os.getenv("AZURE_CLIENT_SECRET")
 if not CLIENT_SECRET:
     raise ValueError("Need to define CLIENT_SECRET environment variable")
 
+# Number of blobs returned per page when listing a container path
+LIST_PAGE_SIZE = int(os.getenv('AZURE_STORAGE_LIST_PAGE_SIZE', 5000))
+
+# Number of blobs returned per page by the /api/blobs endpoint used by the file table
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 500))
+
+# Files larger than the chunk size are uploaded in chunks of this many bytes, each staged
+# as a block of the blob, with up to UPLOAD_PARALLEL_CHUNKS chunks of a file sent at once
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+UPLOAD_PARALLEL_CHUNKS = int(os.getenv('UPLOAD_PARALLEL_CHUNKS', 4))
+
+# Up to UPLOAD_BATCH_SIZE files no larger than the chunk size are sent together in one request and
+# uploaded to storage by a pool of UPLOAD_BATCH_CONCURRENCY threads shared by all requests of a worker
+UPLOAD_BATCH_SIZE = int(os.getenv('UPLOAD_BATCH_SIZE', 20))
+UPLOAD_BATCH_CONCURRENCY = int(os.getenv('UPLOAD_BATCH_CONCURRENCY', 8))
+
+# Size of the HTTP connection pool to the storage account, shared by all threads of a worker
+STORAGE_CONNECTION_POOL_SIZE = int(os.getenv('STORAGE_CONNECTION_POOL_SIZE', 32))
+
+# Failed storage requests, such as ServerBusy and OperationTimedOut responses of a throttling account, are retried
+# up to STORAGE_RETRY_TOTAL times after a random wait of up to STORAGE_RETRY_BACKOFF seconds, doubled for each retry
+# and at most STORAGE_RETRY_MAX_BACKOFF seconds. A request is not retried past STORAGE_REQUEST_DEADLINE seconds
+# from its start. Each attempt waits at most STORAGE_CONNECTION_TIMEOUT seconds to connect and STORAGE_READ_TIMEOUT
+# seconds for the service to respond, and never past the deadline.
+STORAGE_RETRY_TOTAL = int(os.getenv('STORAGE_RETRY_TOTAL', 3))
+STORAGE_RETRY_BACKOFF = float(os.getenv('STORAGE_RETRY_BACKOFF', 0.5))
+STORAGE_RETRY_MAX_BACKOFF = float(os.getenv('STORAGE_RETRY_MAX_BACKOFF', 8))
+STORAGE_REQUEST_DEADLINE = float(os.getenv('STORAGE_REQUEST_DEADLINE', 30))
+STORAGE_CONNECTION_TIMEOUT = float(os.getenv('STORAGE_CONNECTION_TIMEOUT', 10))
+STORAGE_READ_TIMEOUT = float(os.getenv('STORAGE_READ_TIMEOUT', 30))
+
+# After STORAGE_CIRCUIT_FAILURES failed storage requests in a row storage requests fail at once for
+# STORAGE_CIRCUIT_RESET seconds, before a single request checks if the account has recovered. 0 disables this
+STORAGE_CIRCUIT_FAILURES = int(os.getenv('STORAGE_CIRCUIT_FAILURES', 10))
+STORAGE_CIRCUIT_RESET = float(os.getenv('STORAGE_CIRCUIT_RESET', 30))
+
+# Connections of the pool opened when a worker starts, along with acquiring the storage token,
+# before /readyz reports the worker as ready
+STORAGE_WARM_UP_CONNECTIONS = int(os.getenv('STORAGE_WARM_UP_CONNECTIONS', 4))
+
+# Size of the buffers used to read upload request bodies, which are streamed to storage
+# as they arrive rather than stored locally first
+UPLOAD_BUFFER_SIZE = int(os.getenv('UPLOAD_BUFFER_SIZE', 64 * 1024))
+
+# Block upload settings for files sent through the app. Files up to UPLOAD_MAX_SINGLE_PUT_SIZE
+# bytes are uploaded in one request, larger files as blocks of UPLOAD_MAX_BLOCK_SIZE bytes with
+# up to UPLOAD_MAX_CONCURRENCY blocks uploaded at once. With UPLOAD_TUNING set to "adaptive" the
+# block size and concurrency are picked from the request size, keeping the blocks held in memory
+# for one upload below UPLOAD_MAX_BUFFER bytes where possible.
+UPLOAD_MAX_SINGLE_PUT_SIZE = int(os.getenv('UPLOAD_MAX_SINGLE_PUT_SIZE', 4 * 1024 * 1024))
+UPLOAD_MAX_BLOCK_SIZE = int(os.getenv('UPLOAD_MAX_BLOCK_SIZE', 4 * 1024 * 1024))
+UPLOAD_MAX_CONCURRENCY = int(os.getenv('UPLOAD_MAX_CONCURRENCY', 2))
+UPLOAD_TUNING = os.getenv('UPLOAD_TUNING', 'fixed')
+UPLOAD_MAX_BUFFER = int(os.getenv('UPLOAD_MAX_BUFFER', 32 * 1024 * 1024))
+
+# Bytes of file content each worker holds in memory at once for uploads, batch uploads, downloads and
+# ZIP downloads. Each request reserves the most it can hold before it starts, and gets a 503 if the
+# memory is not released by other requests within MEMORY_BUDGET_TIMEOUT seconds. Keep the budget of all
+# workers within the memory limit of the pod, see values.yaml of the Helm chart. 0 disables the budget
+MEMORY_BUDGET = int(os.getenv('MEMORY_BUDGET', 48 * 1024 * 1024))
+MEMORY_BUDGET_TIMEOUT = float(os.getenv('MEMORY_BUDGET_TIMEOUT', 30))
+
+# Upload files straight from the browser to storage with a short lived user delegation SAS
+# The storage account needs a CORS rule allowing PUT from the app's URL and the app registration
+# needs permission to generate user delegation keys (e.g. Storage Blob Data Contributor)
+DIRECT_UPLOAD = os.getenv('DIRECT_UPLOAD', 'false').lower() == 'true'
+DIRECT_UPLOAD_SAS_MINUTES = int(os.getenv('DIRECT_UPLOAD_SAS_MINUTES', 30))
+
+# Number of ownership checks run at once for a bulk delete before the blobs are deleted in batches,
+# also used for the property requests of the "only my files" listing
+DELETE_CONCURRENCY = int(os.getenv('DELETE_CONCURRENCY', 16))
+
+# Also write the uploading user as an uploaded_by blob index tag, so "only my files" is answered by
+# the service with Find Blobs by Tags. Needs a storage account without hierarchical namespace and an
+# app role that can read, write and filter tags (e.g. Storage Blob Data Owner)
+BLOB_INDEX_TAGS = os.getenv('BLOB_INDEX_TAGS', 'false').lower() == 'true'
+
+# Files larger than UPLOAD_CHUNK_SIZE are hashed by the page before they are sent, and a file the user
+# already uploaded to any of their folders is copied in storage instead. Needs INVENTORY_INDEX
+UPLOAD_DEDUPE = os.getenv('UPLOAD_DEDUPE', 'false').lower() == 'true'
+
+# Downloads are streamed from storage in chunks of DOWNLOAD_CHUNK_SIZE bytes. Folder ZIP downloads read
+# up to ZIP_DOWNLOAD_CONCURRENCY files at once, buffering at most ZIP_DOWNLOAD_PREFETCH_CHUNKS chunks of each
+DOWNLOAD_CHUNK_SIZE = int(os.getenv('DOWNLOAD_CHUNK_SIZE', 2 * 1024 * 1024))
+ZIP_DOWNLOAD_CONCURRENCY = int(os.getenv('ZIP_DOWNLOAD_CONCURRENCY', 3))
+ZIP_DOWNLOAD_PREFETCH_CHUNKS = int(os.getenv('ZIP_DOWNLOAD_PREFETCH_CHUNKS', 2))
+
+# Folder listing cache - "memory" keeps listings per worker process, "redis" shares them
+# across workers and pods through LISTING_CACHE_REDIS_URL and "none" disables caching
+LISTING_CACHE_TYPE = os.getenv('LISTING_CACHE_TYPE', 'memory')
+LISTING_CACHE_TTL = int(os.getenv('LISTING_CACHE_TTL', 60))  # seconds
+LISTING_CACHE_MAX_ENTRIES = int(os.getenv('LISTING_CACHE_MAX_ENTRIES', 32))
+LISTING_CACHE_REDIS_URL = os.getenv('LISTING_CACHE_REDIS_URL')
+if LISTING_CACHE_TYPE == 'redis' and not LISTING_CACHE_REDIS_URL:
+    raise ValueError("Need to define LISTING_CACHE_REDIS_URL when LISTING_CACHE_TYPE is redis")
+
+# Optional local SQLite inventory of the container at INVENTORY_PATH that listings are served from
+# once a background listing has filled it. Our own uploads and deletes update it right away, changes
+# made by others are picked up by a reconciliation listing every INVENTORY_RECONCILE_INTERVAL seconds
+# The index is kept by each pod, so it is only allowed for a single replica. REPLICAS is set by the Helm chart,
+# with more replicas the uploads and deletes of one pod would not show up in the listings of the others
+INVENTORY_INDEX = os.getenv('INVENTORY_INDEX', 'false').lower() == 'true'
+INVENTORY_PATH = os.getenv('INVENTORY_PATH', '/tmp/azstorage-inventory.db')
+INVENTORY_RECONCILE_INTERVAL = int(os.getenv('INVENTORY_RECONCILE_INTERVAL', 15 * 60))  # seconds
+REPLICAS = int(os.getenv('REPLICAS', 1))
+if INVENTORY_INDEX and REPLICAS > 1:
+    raise ValueError("INVENTORY_INDEX is only supported with a single replica, REPLICAS is " + str(REPLICAS))
+
 # AUTHORITY = "https://login.microsoftonline.com/common"  # For multi-tenant app
 AUTHORITY = "https://login.microsoftonline.com/<azure ad tenant name>.onmicrosoft.com"
 
@@ -42,9 +150,27 @@ PATHS = dict(
   Sandbox = "sandbox/"
 )
 
+# Folders of PATHS whose uploads of compressible files are stored gzip compressed, e.g. ["Finance"]
+# A file is compressible if the content type of its name is in COMPRESS_CONTENT_TYPES, where entries
+# ending in / match every type starting with them. Compressed blobs are decompressed when downloaded.
+# They are read with a user delegation SAS, so the app registration needs permission to generate
+# user delegation keys, as for DIRECT_UPLOAD.
+COMPRESS_FOLDERS = []
+COMPRESS_CONTENT_TYPES = ["text/", "application/json", "application/xml", "application/sql"]
+
 # You can find the proper permission names from this document
 # https://docs.microsoft.com/en-us/graph/permissions-reference
 SCOPE = ["User.Read "]
 
 SESSION_TYPE = "filesystem"  # So token cache will be stored in server-side session
 
+# Session store - "filesystem" keeps sessions on the pod's local disk with Flask-Session, "redis" shares
+# them across workers and pods through SESSION_REDIS_URL so the app can run with several replicas, and
+# "memory" keeps them in the worker process for tests. Sessions expire after SESSION_LIFETIME seconds
+# without a request.
+SESSION_STORE = os.getenv('SESSION_STORE', 'filesystem')
+SESSION_REDIS_URL = os.getenv('SESSION_REDIS_URL')
+if SESSION_STORE == 'redis' and not SESSION_REDIS_URL:
+    raise ValueError("Need to define SESSION_REDIS_URL when SESSION_STORE is redis")
+PERMANENT_SESSION_LIFETIME = int(os.getenv('SESSION_LIFETIME', 8 * 60 * 60))
+
@@ -0,0 +1,110 @@
+from flask import request, send_from_directory, url_for
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import sys
+import logging
+
+logger = logging.getLogger('azure_storage_app')
+
+MANIFEST_NAME = 'manifest.json'
+# Fingerprinted files never change, so browsers can keep them for a year without checking back
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=' + str(ASSET_MAX_AGE) + ', immutable'
+# Only text assets are worth compressing, images are already compressed
+COMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.html', '.json', '.txt')
+# Precompressed variants in order of preference, by Accept-Encoding and file suffix
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+# Copy every file of the static folder to the assets folder under a name holding a hash of its content,
+# next to gzip and brotli compressed variants of the text files, and write the manifest mapping each
+# static file name to its fingerprinted name. Run when the image is built, see the Dockerfile.
+def build_assets(static_folder, assets_folder):
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        logger.warning("brotli is not installed, assets are only precompressed with gzip")
+
+    shutil.rmtree(assets_folder, ignore_errors=True)
+    os.makedirs(assets_folder)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            base, extension = os.path.splitext(filename)
+            fingerprinted = base + '.' + hashlib.sha256(data).hexdigest()[:12] + extension
+            manifest[filename] = fingerprinted
+
+            target = os.path.join(assets_folder, fingerprinted)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            if extension.lower() in COMPRESS_EXTENSIONS:
+                # mtime=0 keeps the gzip output the same between builds
+                with open(target + '.gz', 'wb') as f:
+                    f.write(gzip.compress(data, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(target + '.br', 'wb') as f:
+                        f.write(brotli.compress(data, quality=11))
+
+    with open(os.path.join(assets_folder, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+# Serve the built assets of the app from /assets and add the asset_url template helper
+# Without a built manifest, for example when running from the source folder, asset_url
+# falls back to url_for and the files are served from the static folder as before.
+def init_assets(app):
+    assets_folder = os.path.join(app.root_path, 'assets')
+    manifest = {}
+    try:
+        with open(os.path.join(assets_folder, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        logger.info("No asset manifest in " + assets_folder + ", static files are served without fingerprints")
+
+    @app.route('/assets/<path:filename>')
+    def assets(filename):
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        accept_encoding = request.accept_encodings
+        for encoding, suffix in ENCODINGS:
+            if accept_encoding[encoding] and os.path.isfile(os.path.join(assets_folder, filename + suffix)):
+                response = send_from_directory(assets_folder, filename + suffix, mimetype=mimetype,
+                                               cache_timeout=ASSET_MAX_AGE)
+                response.headers['Content-Encoding'] = encoding
+                break
+        else:
+            response = send_from_directory(assets_folder, filename, mimetype=mimetype, cache_timeout=ASSET_MAX_AGE)
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+        response.vary.add('Accept-Encoding')
+        return response
+
+    # Drop-in replacement for url_for that links static files to their fingerprinted asset
+    def asset_url(endpoint, **values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]
+            return url_for('assets', **values)
+        return url_for(endpoint, **values)
+
+    app.jinja_env.globals.update(asset_url=asset_url)
+
+
+# Build the assets of the static folder next to this file
+# Run from the app folder with: python assets.py
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    app_folder = os.path.dirname(os.path.abspath(__file__))
+    built = build_assets(os.path.join(app_folder, 'static'),
+                         sys.argv[1] if len(sys.argv) > 1 else os.path.join(app_folder, 'assets'))
+    print("Built " + str(len(built)) + " assets")
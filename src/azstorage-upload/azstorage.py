@@ -1,13 +1,55 @@
-from azure.storage.blob import BlobServiceClient
-from azure.storage.blob._models import BlobPrefix
+from azure.storage.blob import (BlobServiceClient, BlobClient, BlobBlock, BlobSasPermissions, ContentSettings,
+                                generate_blob_sas)
 from azure.identity import ClientSecretCredential
-from azure.core.exceptions import ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError, ResourceModifiedError
 from werkzeug.utils import secure_filename
+from werkzeug.http import http_date
+from werkzeug.urls import url_quote
+from listing_cache import build_listing_cache, BlobEntry
+from inventory import build_inventory, is_inventory_token, blob_content_md5, CHUNK_MD5_KEY
+from zip_stream import iter_zip
+from compression import (GzipStream, gzip_chunk, iter_gunzip, is_compressed, logical_size, compressible,
+                         CONTENT_ENCODING, ORIGINAL_SIZE_KEY)
+from storage_retry import CircuitBreaker, StorageRetry, StorageUnavailableError, retry_settings
+from memory_budget import MemoryBudget, MemoryBudgetExceeded, ReservedBody
+from metrics import track_storage, track_storage_items, record_upload, record_listing, VALIDATE_USER, STORAGE_READY
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
+import hashlib
+import io
+import math
+import queue
+import threading
 import time
+import uuid
 import logging
+import requests
 
 logger = logging.getLogger('azure_storage_app')
 
+# Most deletes the Blob Batch API accepts in one request
+DELETE_BATCH_SIZE = 256
+# Most blobs accepted by a single bulk delete request
+MAX_BULK_DELETE = 5000
+# Seconds to wait for the server side copy of a duplicate upload before it is given up
+DEDUPE_COPY_TIMEOUT = 60
+# Scope of the token used for storage requests
+STORAGE_SCOPE = "https://storage.azure.com/.default"
+# Seconds between warm-up attempts while storage can't be reached, doubling up to the maximum
+WARM_UP_RETRY_SECONDS = 5
+WARM_UP_MAX_RETRY_SECONDS = 60
+# Error codes of a storage account that is throttling requests
+THROTTLING_ERROR_CODES = ["ServerBusy", "OperationTimedOut"]
+# Content types compressed by default in the folders of COMPRESS_FOLDERS, prefixes end in /
+COMPRESS_CONTENT_TYPES = ["text/", "application/json", "application/xml", "application/sql"]
+# Minutes a download of a compressed blob may take, the lifetime of the SAS it is read with
+RAW_DOWNLOAD_SAS_MINUTES = 60
+# Content-Encoding the responses of those downloads are sent with instead of gzip, see download_raw
+RAW_CONTENT_ENCODING = 'identity'
+
+
 class Response:
 
     # Default response object is success with blank message
@@ -25,8 +67,23 @@ class UserStorageSession:
     def __init__(self, path, user):
         self.path = path
         self.user = user
+        # Rows of the file table
         self.blob_table = []
         self.folder_list = []
+        # Continuation token of the next page when listing one page at a time
+        self.continuation = None
+        # Sizes of the chunks of a chunked upload already staged, by chunk index
+        self.staged_chunks = {}
+        # SAS URL the browser uploads to directly when direct uploads are enabled,
+        # and the upload id its block ids are made of
+        self.upload_url = None
+        self.upload_id = None
+        # Outcome of each blob of a bulk delete
+        self.delete_results = []
+        # Outcome of each file of a batch upload
+        self.upload_results = []
+        # Download to send in the response, a dict of the status code, headers and an iterator of the content
+        self.download = None
 
 
 # Class for storing a connection to an Azure storage account and container
@@ -35,26 +92,143 @@ class UserStorageSession:
 # to indicates if the error template page should be used instead of the base template
 class AzureStorage:
 
-    def __init__(self, app_config):
+    def __init__(self, app_config, credential=None):
         
         self.app_config = app_config
         self.account_url = self.app_config['STORAGE_URL']
         self.container_name = self.app_config['CONTAINER_NAME']
+        self.list_page_size = self.app_config.get('LIST_PAGE_SIZE', 5000)
+        self.api_page_size = self.app_config.get('API_PAGE_SIZE', 500)
+        self.listing_cache = build_listing_cache(self.app_config)
+        # Optional local index of the container that listings are served from once it is filled
+        self.inventory = build_inventory(self.app_config)
+        self.upload_sas_minutes = self.app_config.get('DIRECT_UPLOAD_SAS_MINUTES', 30)
+        self.delete_concurrency = self.app_config.get('DELETE_CONCURRENCY', 16)
+        # Write the uploading user as a blob index tag as well, so a user's files can be found by the service
+        self.blob_tags = self.app_config.get('BLOB_INDEX_TAGS', False)
+        # Uploads of content the user already uploaded are copied in storage, the hashes are looked up in the inventory
+        self.upload_dedupe = self.app_config.get('UPLOAD_DEDUPE', False) and self.inventory is not None
+        if self.app_config.get('UPLOAD_DEDUPE', False) and self.inventory is None:
+            logger.warning("UPLOAD_DEDUPE needs INVENTORY_INDEX, duplicate uploads will be sent in full")
+
+        # Uploads of compressible content types to the paths of these folders are stored gzip compressed
+        compress_folders = self.app_config.get('COMPRESS_FOLDERS', [])
+        missing = [folder for folder in compress_folders if folder not in self.app_config['PATHS']]
+        if missing:
+            raise ValueError("Compressed folders missing from PATHS: " + ", ".join(missing))
+        self.compressed_paths = [self.app_config['PATHS'][folder] for folder in compress_folders]
+        self.compress_content_types = self.app_config.get('COMPRESS_CONTENT_TYPES', COMPRESS_CONTENT_TYPES)
+
+        # Folders of each role in the order they are configured, checked against PATHS at startup
+        # The folders of a set of roles are merged once and then looked up by role set in role_access
+        self.role_folders = compile_role_folders(self.app_config['ROLES'], self.app_config['PATHS'])
+        self.role_access = {}
+
+        # Downloads are read from storage in chunks of this size, folder ZIP downloads read up to
+        # zip_concurrency blobs at once and buffer up to zip_prefetch_chunks chunks of each
+        self.download_chunk_size = self.app_config.get('DOWNLOAD_CHUNK_SIZE', 2 * 1024 * 1024)
+        self.zip_concurrency = self.app_config.get('ZIP_DOWNLOAD_CONCURRENCY', 3)
+        self.zip_prefetch_chunks = self.app_config.get('ZIP_DOWNLOAD_PREFETCH_CHUNKS', 2)
+
+        # File content held in memory by the uploads and downloads of the worker, see MemoryBudget
+        self.memory_budget = MemoryBudget(self.app_config.get('MEMORY_BUDGET', 48 * 1024 * 1024),
+                                          self.app_config.get('MEMORY_BUDGET_TIMEOUT', 30))
+
+        # Block upload settings, picked per upload from the expected size in adaptive mode
+        self.upload_settings = dict(max_single_put_size=self.app_config.get('UPLOAD_MAX_SINGLE_PUT_SIZE', 4 * 1024 * 1024),
+                                    max_block_size=self.app_config.get('UPLOAD_MAX_BLOCK_SIZE', 4 * 1024 * 1024),
+                                    max_concurrency=self.app_config.get('UPLOAD_MAX_CONCURRENCY', 2))
+        self.upload_tuning = self.app_config.get('UPLOAD_TUNING', 'fixed')
+        self.upload_max_buffer = self.app_config.get('UPLOAD_MAX_BUFFER', 32 * 1024 * 1024)
+        # The blocks of an upload are held along with a copy of each, which has to fit the memory budget
+        if self.memory_budget.size:
+            self.upload_max_buffer = min(self.upload_max_buffer, self.memory_budget.size // 2)
+
+        # Files of batch uploads are sent to storage by a thread pool shared by all requests of the
+        # process, so the number of transfers running at once does not grow with the number of requests
+        self.batch_max_file_size = self.app_config.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)
+        self.batch_concurrency = self.app_config.get('UPLOAD_BATCH_CONCURRENCY', 8)
+        self.upload_executor = ThreadPoolExecutor(max_workers=self.batch_concurrency,
+                                                  thread_name_prefix="azure-storage-upload")
+
+        # User delegation key used to sign upload SAS tokens, renewed shortly before it expires
+        self.delegation_key = None
+        self.delegation_key_expiry = None
+        self.delegation_key_lock = threading.Lock()
+
+        # Storage requests are retried with jittered backoff within a deadline by the clients' retry policy,
+        # and fail at once while the circuit breaker is open
+        self.circuit_breaker = CircuitBreaker(self.app_config.get('STORAGE_CIRCUIT_FAILURES', 10),
+                                              self.app_config.get('STORAGE_CIRCUIT_RESET', 30))
+        self.retry_settings = retry_settings(self.app_config)
+
+        # Set once the storage token was acquired and the connection pool warmed up, see start_warm_up
+        self.ready = False
+        self.warm_up_connections = self.app_config.get('STORAGE_WARM_UP_CONNECTIONS', 4)
         
-        # Get a token credential for authentication
-        token_credential = ClientSecretCredential(
+        # Get a token credential for authentication, unless another credential is given
+        # such as the account key of a local storage emulator used by the benchmarks
+        self.token_credential = credential or ClientSecretCredential(
             self.app_config['TENANT_ID'],
             self.app_config['CLIENT_ID'],
             self.app_config['CLIENT_SECRET']
         )
         
         # Create the BlobServiceClient and connect to the storage container
+        # All threads share the client's connection pool, which is sized for the request and upload threads
         try:
-            self.blob_service_client = BlobServiceClient(account_url=self.account_url, credential=token_credential)
+            session = requests.Session()
+            pool_size = self.app_config.get('STORAGE_CONNECTION_POOL_SIZE', 32)
+            session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+            # Options shared with the SAS clients of compressed downloads, see download_raw
+            self.client_options = dict(max_single_get_size=self.download_chunk_size,
+                                       max_chunk_get_size=self.download_chunk_size,
+                                       retry_policy=StorageRetry(self.circuit_breaker, **self.retry_settings),
+                                       connection_timeout=self.retry_settings['connection_timeout'],
+                                       read_timeout=self.retry_settings['read_timeout'],
+                                       session=session)
+            self.blob_service_client = BlobServiceClient(account_url=self.account_url, credential=self.token_credential,
+                                                         max_single_put_size=self.upload_settings['max_single_put_size'],
+                                                         max_block_size=self.upload_settings['max_block_size'],
+                                                         **self.client_options)
             self.container_client = self.blob_service_client.get_container_client(self.container_name)
         except Exception as e:
             logger.error(e)
 
+        if self.inventory is not None:
+            self.inventory.start(self.list_inventory_blobs)
+
+    # Warm up the storage clients in a background thread, retrying until storage can be reached
+    # Until then the worker is reported as not ready, so it gets no traffic before its first request
+    # can be served without paying for the token, DNS lookup and TLS handshakes.
+    def start_warm_up(self):
+        threading.Thread(target=self.run_warm_up, name="azure-storage-warm-up", daemon=True).start()
+
+    def run_warm_up(self):
+        delay = WARM_UP_RETRY_SECONDS
+        while True:
+            elapsed_time = time.time()
+            try:
+                self.warm_up()
+            except Exception as e:
+                logger.error("Storage warm-up failed, retrying in " + str(delay) + " seconds: " + str(e))
+                time.sleep(delay)
+                delay = min(delay * 2, WARM_UP_MAX_RETRY_SECONDS)
+                continue
+            self.ready = True
+            STORAGE_READY.set(1)
+            logger.info("Storage warm-up succeeded after " + str(round(time.time() - elapsed_time, 2)) + " seconds")
+            return
+
+    # Acquire the storage token and open warm_up_connections connections of the pool with container property requests
+    def warm_up(self):
+        if hasattr(self.token_credential, 'get_token'):
+            self.token_credential.get_token(STORAGE_SCOPE)
+        with ThreadPoolExecutor(max_workers=self.warm_up_connections) as executor:
+            with track_storage('warm_up'):
+                list(executor.map(lambda i: self.container_client.get_container_properties(),
+                                  range(self.warm_up_connections)))
+
     # Validates the user is authorized and returns user and access information along with the Response object
     def validate_user(self, session, request):
         user = session["user"]["preferred_username"].lower()
@@ -62,19 +236,16 @@ class AzureStorage:
         # Check if user token contains the proper role
         if 'roles' not in session["user"]:
             logger.warning(user + " not assigned any roles for this application")
+            VALIDATE_USER.labels('no_roles').inc()
             return dict(response=Response(message="User not assigned any roles for this application", status_code=401, error_flag=1))
-        if not any(x in self.app_config['ROLES'].keys() for x in session["user"]["roles"]):
+
+        # Get folders that user has access to, roles not configured in ROLES are ignored
+        access = self.get_role_access(session["user"]["roles"])
+        if not access:
             logger.warning(user + " not assigned the proper role for access")
+            VALIDATE_USER.labels('no_matching_role').inc()
             return dict(response=Response(message="User not assigned the proper role for access", status_code=401, error_flag=1))
-
-        
-
-        # Get folders that user has access to
-        folder_access = []
-        for role in session["user"]["roles"]:
-            folder_access += self.app_config["ROLES"][role]
-        # Remove duplicate entries
-        folder_access = unique(folder_access)
+        folder_access, folder_paths = access
 
         # Get selected folder path or default to first available folder
         current_folder = request.args.get('folder')
@@ -82,76 +253,130 @@ class AzureStorage:
             current_folder = folder_access[0]
         else:
             # Validate that user has access to the selected folder
-            if current_folder not in folder_access:
+            if current_folder not in folder_paths:
                 logger.warning(user + " not assigned access to folder: " + current_folder)
+                VALIDATE_USER.labels('folder_denied').inc()
                 return dict(response=Response(message="User not assigned access to this folder", status_code=401, error_flag=1))
 
-        path = self.app_config["PATHS"][current_folder]
+        path = folder_paths[current_folder]
         logger.debug(user + " has been authorized on folder: " + current_folder)
+        VALIDATE_USER.labels('authorized').inc()
         return dict(response=Response("User has been authorized"), 
                     user=user, 
                     folder_access=folder_access, 
+                    folder_paths=folder_paths,
                     current_folder=current_folder, 
                     path=path)
 
-    # Function to walk an Azure Storage path and get all blobs and subdirectories
-    def walk_blobs(self, user_session: UserStorageSession, sub_folder=""):
-        # Initiate blob iterator on the search path
-        search_path = user_session.path + sub_folder
+    # Get the folders a set of roles has access to, in the order of ROLES without duplicates, and their paths
+    # Returns None if none of the roles are configured. Results are kept per set of configured roles,
+    # so after the first request of a role set this is a dictionary lookup.
+    def get_role_access(self, roles):
+        key = frozenset(role for role in roles if role in self.role_folders)
+        access = self.role_access.get(key)
+        if access is None:
+            folder_paths = {}
+            for role, folders in self.role_folders.items():
+                if role in key:
+                    for folder in folders:
+                        folder_paths.setdefault(folder, self.app_config['PATHS'][folder])
+            access = (list(folder_paths), folder_paths) if folder_paths else ()
+            self.role_access[key] = access
+        return access or None
+
+    # Get only the subfolders of the user path, from the cached listing of the path
+    def list_folders(self, user_session: UserStorageSession):
         try:
-            blob_list = self.container_client.walk_blobs(name_starts_with=search_path, include='metadata',
-                                                         delimiter='/')
+            blobs, folders = self.cached_tree(user_session.path)
         except Exception as e:
-            logger.error(e)
-            return Response(message="Failed to get Blob List", status_code=400)
+            return storage_error(e, "Failed to get Folder List")
 
-        new_folders = []
-        for blob in blob_list:
-            # Check if item is a directory and add to list of additional folders to walk
-            if isinstance(blob, BlobPrefix):
-                new_folders.append(remove_prefix(blob.name, user_session.path).rstrip("/"))
-            else:
-                # Try to get metadata for blob if it exists and check if user matches the
-                # original upload user
-                try:
-                    metadata = getattr(blob, 'metadata')
-                    if metadata is None:
-                        logger.warning("Metadata missing from blob: " + blob.name + " Setting user to null")
-                        uploaded_by = ""
-                    else:
-                        uploaded_by = metadata['uploaded_by'].lower()
-                except AttributeError:
-                    logger.warning("Metadata missing from blob: " + blob.name + " Setting user to null")
-                    uploaded_by = ""
-
-                # If blob uploaded by current user, enable deleteion
-                if uploaded_by == user_session.user:
-                    delete_enabled = True
-                else:
-                    delete_enabled = False
-
-                # Convert size to KB
-                size = int(blob.size / 1024)
-                if size == 0:
-                    size = "<1"
-
-                # Add blob info to blob_table
-                user_session.blob_table.append(dict(filename=blob.name.split("/")[-1],
-                                                            path=blob.name.rsplit("/", 1)[0],
-                                                            name=blob.name,
-                                                            size=size,
-                                                            uploaded_by=uploaded_by,
-                                                            delete_enabled=delete_enabled))
-
-        # Append discovered subfolders to folder list and recursively walk any new directories
-        user_session.folder_list += new_folders
-        for folder in new_folders:
-            self.walk_blobs(user_session, folder + "/")
+        user_session.folder_list += folders
+        return Response()
+
+    # Get a single page of blobs under the user path and an optional name prefix
+    # The continuation token of the next page is stored on the user session and is None on the last page
+    # Pages are not served from the listing cache: its listings are in the order of a recursive walk and the
+    # storage continuation tokens can't point into them, so a cached folder is only used by the index page
+    def list_blobs_page(self, user_session: UserStorageSession, prefix="", continuation=None):
+        if self.inventory_serves(continuation):
+            return self.list_inventory_page(user_session, prefix, continuation)
+        try:
+            pages = self.container_client.list_blobs(name_starts_with=user_session.path + prefix, include='metadata',
+                                                     results_per_page=self.api_page_size).by_page(
+                                                         continuation_token=continuation)
+            with track_storage('list'):
+                page = next(pages, [])
+            for blob in page:
+                user_session.blob_table.append(blob_entry(blob).row(user_session.user))
+            user_session.continuation = pages.continuation_token
+        except Exception as e:
+            return storage_error(e, "Failed to get Blob List")
 
         return Response()
 
+    # Get a page of blobs from the inventory, continuation tokens are the name of the last blob of a page
+    def list_inventory_page(self, user_session: UserStorageSession, prefix="", continuation=None):
+        try:
+            entries, user_session.continuation = self.inventory.page(user_session.path + prefix, continuation,
+                                                                     self.api_page_size)
+        except Exception as e:
+            return storage_error(e, "Failed to get Blob List")
+
+        for entry in entries:
+            user_session.blob_table.append(entry.row(user_session.user))
+        return Response()
+
+    # Pages are served from the inventory once it is ready, except for the remaining pages of a
+    # listing started from storage, and pages of a listing started from the inventory stay there
+    def inventory_serves(self, continuation):
+        if self.inventory is None:
+            return False
+        if continuation:
+            return is_inventory_token(continuation)
+        return self.inventory.ready()
+
+    # List every blob of the container for the inventory
+    def list_inventory_blobs(self):
+        pages = self.container_client.list_blobs(include='metadata', results_per_page=self.list_page_size).by_page()
+        for page in track_storage_items('list', pages):
+            yield from page
+
+    # Serve the listing from the inventory once it is ready, or from the cache if this path was listed recently
+    def cached_tree(self, path):
+        if self.inventory is not None and self.inventory.ready():
+            return folder_tree(path, self.inventory.entries(path))
+        listing = self.listing_cache.get(path)
+        if listing is None:
+            listing = self.list_tree(path)
+            self.listing_cache.set(path, *listing)
+        return listing
+
+    # List every blob under a path in one paged pass and build the folder tree in memory
+    # Returns the blob entries and the relative folder names in the same order a
+    # recursive delimiter based walk of the path would produce them
+    def list_tree(self, path):
+        pages = self.container_client.list_blobs(name_starts_with=path, include='metadata',
+                                                 results_per_page=self.list_page_size).by_page()
+        blobs, folders = folder_tree(path, (blob_entry(blob) for page in track_storage_items('list', pages)
+                                            for blob in page))
+        record_listing(len(blobs), len(folders))
+        return blobs, folders
+
+    # Check if a blob exists in the container
+    def blob_exists(self, blob_name):
+        blob_client = self.container_client.get_blob_client(blob_name)
+        try:
+            with track_storage('get_properties'):
+                blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            return False
+        return True
+
     # Upload blob to Azure Storage
-    def upload_blob(self, file, subfolder, user_session: UserStorageSession):
+    # size_hint is the expected size of the file, e.g. the request content length, used by adaptive tuning
+    # and to reserve the memory of the upload, unless the caller already reserved it
+    def upload_blob(self, file, subfolder, user_session: UserStorageSession, size_hint=None, reserved=False):
         # Check if file was included in the Post, if not return warning
         filename = secure_filename(file.filename)
         if not filename:
@@ -166,66 +391,1162 @@ class AzureStorage:
             # Create a blob client using the local file name as the name for the blob
             blob_client = self.blob_service_client.get_blob_client(container=self.container_name,
                                                                    blob=(upload_path + filename))
-            try:
-                # Check if blob already exists
-                if blob_client.get_blob_properties()['size'] > 0:
-                    logger.warning(filename + " already exists in the selected path. Skipping upload.")
-                    return Response(message=filename +" already exists in the selected path",status_code=409,error_flag=2)
-            except ResourceNotFoundError as e:
-                # catch exception that indicates that the blob does not exist and we are good to upload file
-                pass
             logger.info(user_session.user + " uploading " + filename + " to Azure Storage on path: " + upload_path)
 
             # create metadata including the uploading user's id
             metadata = {'uploaded_by': user_session.user}
-            # Upload the file and measure upload time
+            # Upload the file and measure upload time and throughput
+            settings = self.get_upload_settings(size_hint)
+            with self.memory_budget.reserve(0 if reserved else upload_memory(settings, size_hint)):
+                elapsed_time = time.time()
+                size, content_md5 = self.upload_stream(blob_client, file, metadata, settings,
+                                                       self.upload_tags(user_session.user),
+                                                       self.compress_upload(upload_path + filename))
+                elapsed_time = time.time() - elapsed_time
+            record_upload(size, elapsed_time)
+            logger.info("Upload succeeded after " + str(round(elapsed_time, 2)) + " seconds (" +
+                        str(round(size / 1048576 / max(elapsed_time, 0.001), 2)) + " MB/s) for: " + filename)
+
+            # Update the table display and any cached listings with the new blob
+            entry = BlobEntry(upload_path + filename, size, user_session.user)
+            user_session.blob_table.append(entry.row(user_session.user))
+            self.cache_blob_added(entry, content_md5)
+
+        except (ResourceExistsError, ResourceModifiedError):
+            # The upload only creates the blob if it does not exist yet
+            logger.warning(filename + " already exists in the selected path. Skipping upload.")
+            return Response(message=filename +" already exists in the selected path",status_code=409,error_flag=2)
+        except Exception as e:
+            return storage_error(e, "Failed to upload file", error_flag=1)
+
+
+        return Response(message="Uploaded File Successfully",status_code=200)
+
+    # Upload the files of a batch upload, given as (form fields, file) pairs in the order they are received
+    # Each file is read into memory and uploaded on the shared upload pool while the next one is received,
+    # with at most batch_concurrency files of the request held at once. Files larger than the chunk size
+    # are not accepted, the page sends those on their own. The outcome of each file is added to
+    # user_session.upload_results in the order of the files.
+    # Memory for the largest file and its copy sent to storage is reserved before a file is read, the part
+    # the file does not need is released once it has been read and the rest once its upload has finished.
+    def upload_blobs(self, files, user_session: UserStorageSession):
+        uploads = []
+        running = set()
+        try:
+            for fields, file in files:
+                try:
+                    reserved = self.memory_budget.acquire(2 * (self.batch_max_file_size + 1))
+                except MemoryBudgetExceeded as e:
+                    uploads.append((file.filename, None, storage_error(e, "Failed to upload file")))
+                    continue
+                data = read_fully(file, self.batch_max_file_size + 1)
+                if len(data) > self.batch_max_file_size:
+                    self.memory_budget.release(reserved)
+                    logger.warning(user_session.user + " sent " + str(file.filename) + " in a batch upload but it is too large")
+                    uploads.append((file.filename, None, Response(message="File is too large for a batch upload",status_code=400)))
+                    continue
+                self.memory_budget.release(reserved - min(reserved, 2 * len(data)))
+                reserved = min(reserved, 2 * len(data))
+
+                file_session = UserStorageSession(user_session.path, user_session.user)
+                future = self.upload_executor.submit(self.upload_blob, BufferedFile(file.filename, data),
+                                                     fields.get('subfolder', ''), file_session, len(data), True)
+                future.add_done_callback(lambda future, reserved=reserved: self.memory_budget.release(reserved))
+                uploads.append((file.filename, file_session, future))
+                running.add(future)
+                if len(running) >= self.batch_concurrency:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+        finally:
+            # Files already received are uploaded even if the rest of the request is invalid
+            wait(running)
+
+        for filename, file_session, upload in uploads:
+            response = upload if isinstance(upload, Response) else upload.result()
+            if response.status_code != 200:
+                user_session.upload_results.append(dict(filename=filename, error=response.message))
+            else:
+                user_session.upload_results.append(dict(filename=filename, message=response.message,
+                                                        blob=file_session.blob_table[-1]))
+                user_session.blob_table += file_session.blob_table
+
+        failed = sum(1 for result in user_session.upload_results if 'error' in result)
+        if failed:
+            return Response(message=str(failed) + " of " + str(len(uploads)) + " files failed to upload",status_code=200)
+        return Response(message="Uploaded " + str(len(uploads)) + " files successfully",status_code=200)
+
+    # Upload a stream of unknown length and return the size and hex MD5 of the file uploaded
+    # The stream is read in blocks of max_block_size. Streams no larger than max_single_put_size are sent
+    # in a single request, anything larger is staged as blocks with up to max_concurrency block uploads
+    # running at once, and the blocks are then committed in order. Blocks are only read once a block upload
+    # can start, so at most the larger of max_single_put_size + max_block_size (the blocks read to tell
+    # the two cases apart) and (max_concurrency + 1) * max_block_size bytes of the file are held in memory.
+    # The MD5 is computed as the stream is read and stored as the Content-MD5 of the blob.
+    # With compress the stream is gzip compressed as it is read, see upload_properties.
+    # The blob is only created if it does not exist yet (If-None-Match: *), otherwise the service
+    # fails the request with 409 or 412, which callers report as an existing file
+    def upload_stream(self, blob_client, stream, metadata, settings, tags=None, compress=False):
+        if compress:
+            stream = GzipStream(stream)
+        md5 = hashlib.md5()
+        blocks = deque()
+        buffered = 0
+        while buffered <= settings['max_single_put_size']:
+            block = read_fully(stream, settings['max_block_size'])
+            if not block:
+                break
+            md5.update(block)
+            blocks.append(block)
+            buffered += len(block)
+
+        if buffered <= settings['max_single_put_size']:
+            metadata, content_settings, size, content_md5 = upload_properties(stream, metadata, buffered, md5)
+            data = b"".join(blocks)
+            with track_storage('upload'):
+                blob_client.upload_blob(data, metadata=metadata, tags=tags, content_settings=content_settings,
+                                        match_condition=MatchConditions.IfMissing)
+            return size, content_md5
+
+        upload_id = str(uuid.uuid4())
+        block_list = []
+        size = 0
+        with ThreadPoolExecutor(max_workers=settings['max_concurrency']) as executor:
+            running = set()
+            while blocks:
+                block = blocks.popleft()
+                block_id = chunk_block_id(upload_id, len(block_list))
+                block_list.append(BlobBlock(block_id=block_id))
+                size += len(block)
+                running.add(executor.submit(stage_block, blob_client, block_id, block))
+                if len(running) >= settings['max_concurrency']:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+
+                if not blocks:
+                    block = read_fully(stream, settings['max_block_size'])
+                    if block:
+                        md5.update(block)
+                        blocks.append(block)
+            for future in running:
+                future.result()
+
+        metadata, content_settings, size, content_md5 = upload_properties(stream, metadata, size, md5)
+        with track_storage('commit'):
+            blob_client.commit_block_list(block_list, metadata=metadata, tags=tags, content_settings=content_settings,
+                                          match_condition=MatchConditions.IfMissing)
+        return size, content_md5
+
+    # True if an upload to the blob is stored compressed, by its folder and the content type of its name
+    def compress_upload(self, blob_name):
+        return (any(blob_name.startswith(path) for path in self.compressed_paths) and
+                compressible(blob_name, self.compress_content_types))
+
+    # Get the block upload settings for an upload of the expected size
+    # In adaptive mode small files use a single request and larger files use larger blocks
+    # and more concurrent block uploads, within the UPLOAD_MAX_BUFFER memory budget
+    def get_upload_settings(self, size_hint):
+        settings = dict(self.upload_settings)
+        if self.upload_tuning != 'adaptive' or not size_hint:
+            return settings
+
+        if size_hint <= settings['max_single_put_size']:
+            settings['max_concurrency'] = 1
+            return settings
+
+        # Aim for at most 1000 blocks, but always stay below the 50000 blocks allowed per blob
+        block_size = settings['max_block_size']
+        while size_hint > block_size * 1000 and block_size * 2 * (settings['max_concurrency'] + 1) <= self.upload_max_buffer:
+            block_size *= 2
+        while size_hint > block_size * 50000:
+            block_size *= 2
+        settings['max_block_size'] = block_size
+        settings['max_concurrency'] = max(1, min(settings['max_concurrency'], math.ceil(size_hint / block_size)))
+        return settings
+
+    # Stage one chunk of a chunked Dropzone upload as an uncommitted block of the blob
+    # The chunk is streamed straight to the block upload when its length is known,
+    # blocks are only committed by commit_chunks. A chunk of a file that is stored compressed
+    # is compressed in memory as a gzip member of its own. Its block is then smaller than the
+    # chunk, so the size of the chunk is kept in the block id, see chunk_block_id.
+    # When duplicate uploads are copied, the chunk is hashed as it passes through and its hash is
+    # recorded in the inventory until the upload is committed, see commit_chunks.
+    def stage_chunk(self, file, subfolder, user_session: UserStorageSession, upload_id, chunk_index, length=None):
+        blob_name = upload_blob_name(file.filename, subfolder, user_session)
+        if blob_name is None:
+            return Response(message="Must select a file to upload first!",status_code=400)
+        try:
+            block_id = chunk_block_id(upload_id, chunk_index)
+        except (TypeError, ValueError):
+            logger.warning(user_session.user + " sent invalid chunk parameters for: " + blob_name)
+            return Response(message="Invalid chunk parameters",status_code=400)
+
+        try:
+            blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=blob_name)
+            # Fail fast on the first chunk rather than after the whole file has been sent
+            if int(chunk_index) == 0:
+                try:
+                    with track_storage('get_properties'):
+                        properties = blob_client.get_blob_properties()
+                    if properties['size'] > 0:
+                        logger.warning(blob_name + " already exists. Skipping upload.")
+                        return Response(message=file.filename + " already exists in the selected path",status_code=409,error_flag=2)
+                except ResourceNotFoundError:
+                    pass
+            elapsed_time = time.time()
+            md5 = hashlib.md5()
+            if self.compress_upload(blob_name):
+                # The chunk and its compressed copy are held in memory, so it is read up to the chunk size
+                if length is not None and length > self.batch_max_file_size:
+                    return self.chunk_too_large(blob_name, user_session)
+                with self.memory_budget.reserve(2 * ((length or self.batch_max_file_size) + 1)):
+                    data = read_fully(file.stream, self.batch_max_file_size + 1)
+                    if len(data) > self.batch_max_file_size:
+                        return self.chunk_too_large(blob_name, user_session)
+                    block_id = chunk_block_id(upload_id, chunk_index, len(data))
+                    md5.update(data)
+                    block = gzip_chunk(data)
+                    with track_storage('stage_block'):
+                        blob_client.stage_block(block_id, block, length=len(block))
+            else:
+                stream = HashingStream(file.stream, md5) if self.upload_dedupe else file.stream
+                # The chunk is sent to storage while it is received, so this also times the browser
+                with track_storage('stage_chunk'):
+                    blob_client.stage_block(block_id, stream, length=length)
+            record_upload(file.stream.bytes_read, time.time() - elapsed_time)
+        except Exception as e:
+            return storage_error(e, "Failed to upload file chunk")
+
+        if self.upload_dedupe:
+            try:
+                self.inventory.add_chunk(blob_name, block_id[:32], int(chunk_index), file.stream.bytes_read, md5.digest())
+            except Exception as e:
+                # The upload still succeeds, it is only never copied for a duplicate
+                logger.error("Failed to record the hash of a chunk of " + blob_name + ": " + str(e))
+
+        return Response(message="Chunk uploaded",status_code=200)
+
+    def chunk_too_large(self, blob_name, user_session: UserStorageSession):
+        logger.warning(user_session.user + " sent a chunk larger than the chunk size for: " + blob_name)
+        return Response(message="File chunk is too large",status_code=400)
+
+    # Find the chunks of an upload that are already staged so an interrupted upload can resume
+    def list_staged_chunks(self, filename, subfolder, user_session: UserStorageSession, upload_id):
+        blob_name = upload_blob_name(filename, subfolder, user_session)
+        if blob_name is None:
+            return Response(message="Must select a file to upload first!",status_code=400)
+        try:
+            prefix = chunk_block_id(upload_id, 0)[:32]
+        except (TypeError, ValueError):
+            return Response(message="Invalid chunk parameters",status_code=400)
+
+        try:
+            blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=blob_name)
+            with track_storage('list_blocks'):
+                committed, uncommitted = blob_client.get_block_list('uncommitted')
+        except ResourceNotFoundError:
+            # Nothing has been staged for this blob yet
+            return Response()
+        except Exception as e:
+            return storage_error(e, "Failed to get upload status")
+
+        for block in uncommitted:
+            if block.id.startswith(prefix):
+                chunk_index, size = staged_chunk(block)
+                user_session.staged_chunks[chunk_index] = size
+        return Response()
+
+    # Commit the staged chunks of an upload in order, creating the blob with the uploading user's metadata
+    # The commit only succeeds if the blob does not exist yet. The size of the file is the sum of the sizes
+    # of the staged chunks, as listed by the storage service, never a size sent by the client.
+    # For a compressed file the size goes to the metadata, as the content of the blob is the compressed file
+    # The chunks are sent by separate requests, so the MD5 of the file is not known here. When duplicate uploads
+    # are copied, the hashes stage_chunk recorded for the chunks are combined into the hash of the file instead,
+    # see chunked_md5. The MD5 the page sends is never stored, it is only compared with that hash.
+    def commit_chunks(self, filename, subfolder, user_session: UserStorageSession, upload_id, total_chunks,
+                      content_md5=None):
+        blob_name = upload_blob_name(filename, subfolder, user_session)
+        if blob_name is None:
+            return Response(message="Must select a file to upload first!",status_code=400)
+        try:
+            prefix = chunk_block_id(upload_id, 0)[:32]
+            total_chunks = int(total_chunks)
+            if not 0 < total_chunks <= 50000:
+                raise ValueError("Chunk count out of range: " + str(total_chunks))
+            content_md5 = parse_md5(content_md5) if content_md5 else None
+        except (TypeError, ValueError):
+            logger.warning(user_session.user + " sent invalid chunk parameters for: " + blob_name)
+            return Response(message="Invalid chunk parameters",status_code=400)
+
+        try:
+            blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=blob_name)
+            try:
+                with track_storage('list_blocks'):
+                    committed, uncommitted = blob_client.get_block_list('uncommitted')
+            except ResourceNotFoundError:
+                uncommitted = []
+            staged = {}
+            for block in uncommitted:
+                if block.id.startswith(prefix):
+                    chunk_index, size = staged_chunk(block)
+                    staged[chunk_index] = (block.id, size)
+            if any(i not in staged for i in range(total_chunks)):
+                logger.warning(user_session.user + " finalized chunked upload of: " + blob_name + " but not all chunks were staged")
+                return Response(message="Uploaded file was not found",status_code=400)
+            block_list = [BlobBlock(block_id=staged[i][0]) for i in range(total_chunks)]
+            size = sum(staged[i][1] for i in range(total_chunks))
+            logger.info(user_session.user + " committing " + str(len(block_list)) + " chunks to Azure Storage for: " + blob_name)
+
+            # create metadata including the uploading user's id
+            metadata = {'uploaded_by': user_session.user}
+            content_settings = None
+            if self.compress_upload(blob_name):
+                metadata[ORIGINAL_SIZE_KEY] = str(size)
+                content_settings = ContentSettings(content_encoding=CONTENT_ENCODING)
+            chunk_md5 = self.chunk_md5(blob_name, prefix, [staged[i][1] for i in range(total_chunks)])
+            if chunk_md5:
+                metadata[CHUNK_MD5_KEY] = chunk_md5
+                if content_md5 and content_md5 != chunk_md5:
+                    logger.warning("Content of " + blob_name + " does not match the MD5 computed by the page")
             elapsed_time = time.time()
-            blob_client.upload_blob(file, metadata=metadata)
+            with track_storage('commit'):
+                blob_client.commit_block_list(block_list, metadata=metadata,
+                                              tags=self.upload_tags(user_session.user),
+                                              content_settings=content_settings,
+                                              match_condition=MatchConditions.IfMissing)
             elapsed_time = round(time.time() - elapsed_time, 2)
-            logger.info("Upload succeeded after " + str(elapsed_time) + " seconds for: " + filename)
+            logger.info("Commit succeeded after " + str(elapsed_time) + " seconds for: " + blob_name)
+
+            # Update the table display and any cached listings with the new blob
+            entry = BlobEntry(blob_name, size, user_session.user)
+            user_session.blob_table.append(entry.row(user_session.user))
+            self.cache_blob_added(entry, chunk_md5)
+            self.remove_chunk_hashes(blob_name, prefix)
+        except (ResourceExistsError, ResourceModifiedError):
+            logger.warning(blob_name + " already exists. Skipping upload.")
+            return Response(message=filename + " already exists in the selected path",status_code=409,error_flag=2)
+        except Exception as e:
+            return storage_error(e, "Failed to upload file")
+
+        return Response(message="Uploaded File Successfully",status_code=200)
 
-            # Update the table display with the new blob
-            user_session.blob_table.append(dict(name=blob_client.get_blob_properties().name,
-                                                        size=blob_client.get_blob_properties().size,
-                                                        uploaded_by=user_session.user,
-                                                        delete_enabled=True))
+    # Finish an upload without its content by copying a blob the user already uploaded with the same content
+    # The page sends the MD5 and size of the file before sending the file, and the inventory is searched for
+    # blobs of the user with that hash under any of the paths given, the paths of the user's folders.
+    # Only the user's own uploads are copied, so a hash sent by someone else can never be used to place
+    # their content under this user's name. The copy is made by the storage service, and only if the source
+    # still has the content that was checked. Returns 404 if there is no copy to make and the file has to be sent.
+    def copy_duplicate(self, filename, subfolder, user_session: UserStorageSession, content_md5, size, paths):
+        if not self.upload_dedupe:
+            return Response(message="Duplicate uploads are not copied",status_code=404)
+        blob_name = upload_blob_name(filename, subfolder, user_session)
+        if blob_name is None:
+            return Response(message="Must select a file to upload first!",status_code=400)
+        try:
+            content_md5 = parse_md5(content_md5 or "")
+            size = int(size)
+        except (TypeError, ValueError):
+            logger.warning(user_session.user + " sent invalid content hash parameters for: " + blob_name)
+            return Response(message="Invalid content hash parameters",status_code=400)
 
+        try:
+            sources = [name for name in self.inventory.find_content(content_md5, size, user_session.user)
+                       if any(name.startswith(path) for path in paths)]
         except Exception as e:
             logger.error(e)
-            return Response(message="Failed to upload file",status_code=400,error_flag=1)
+            sources = []
+        for source in sources:
+            source_client = self.container_client.get_blob_client(source)
+            try:
+                with track_storage('get_properties'):
+                    properties = source_client.get_blob_properties()
+            except ResourceNotFoundError:
+                continue
+            except Exception as e:
+                logger.error(e)
+                break
+            uploaded_by = (properties.metadata or {}).get('uploaded_by', '').lower()
+            if (blob_content_md5(properties) != content_md5 or logical_size(properties) != size or
+                    uploaded_by != user_session.user):
+                continue
+            return self.copy_blob(source_client, properties, blob_name, filename, user_session, content_md5)
+
+        return Response(message="No file with the same content was found",status_code=404)
+
+    # Copy a checked source blob to a new blob of the user and wait for the copy to finish
+    def copy_blob(self, source_client, properties, blob_name, filename, user_session: UserStorageSession, content_md5):
+        blob_client = self.container_client.get_blob_client(blob_name)
+        logger.info(user_session.user + " uploading " + blob_name + " as a copy of " + source_client.blob_name)
+        elapsed_time = time.time()
+        try:
+            # The metadata of a compressed source describes the file it holds and is kept
+            metadata = dict(properties.metadata or {}, uploaded_by=user_session.user)
+            with track_storage('copy'):
+                copy = blob_client.start_copy_from_url(source_client.url, metadata=metadata,
+                                                       tags=self.upload_tags(user_session.user),
+                                                       source_etag=properties.etag,
+                                                       source_match_condition=MatchConditions.IfNotModified,
+                                                       match_condition=MatchConditions.IfMissing)
+            status = copy['copy_status']
+            # Copies within the account are usually done right away, larger ones finish in the background
+            while status == 'pending' and time.time() - elapsed_time < DEDUPE_COPY_TIMEOUT:
+                time.sleep(0.5)
+                with track_storage('get_properties'):
+                    status = blob_client.get_blob_properties().copy.status
+        except (ResourceExistsError, ResourceModifiedError) as e:
+            # The source may have changed since it was checked, so the file is sent instead if the target is free
+            logger.warning("Copy of " + source_client.blob_name + " to " + blob_name + " failed: " + str(e))
+            if self.blob_exists(blob_name):
+                return Response(message=filename + " already exists in the selected path",status_code=409,error_flag=2)
+            return Response(message="No file with the same content was found",status_code=404)
+        except Exception as e:
+            return storage_error(e, "Failed to upload file")
 
+        if status != 'success':
+            logger.warning("Copy of " + source_client.blob_name + " to " + blob_name + " ended with status " + str(status))
+            try:
+                if status == 'pending':
+                    blob_client.abort_copy(copy['copy_id'])
+                blob_client.delete_blob()
+            except Exception as e:
+                logger.error(e)
+            return Response(message="No file with the same content was found",status_code=404)
 
+        logger.info("Copy succeeded after " + str(round(time.time() - elapsed_time, 2)) + " seconds for: " + blob_name)
+        entry = BlobEntry(blob_name, logical_size(properties), user_session.user)
+        user_session.blob_table.append(entry.row(user_session.user))
+        self.cache_blob_added(entry, content_md5)
         return Response(message="Uploaded File Successfully",status_code=200)
 
     # Delete specified blob
+    # The user must have access to the blob path and must be the user that uploaded the blob
+    # according to the blob's own metadata, so no listing of the folder is needed
     def delete_blob(self, user_session: UserStorageSession, blob_name):
+        response, properties = self.check_delete(user_session, blob_name)
+        if response.status_code != 200:
+            return response
+
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=blob_name)
+        try:
+            logger.info(user_session.user + " deleting blob: " + blob_name)
+            # Only delete the blob that was checked, not one that replaced it in the meantime
+            with track_storage('delete'):
+                blob_client.delete_blob(delete_snapshots=False, etag=properties.etag,
+                                        match_condition=MatchConditions.IfNotModified)
+        except Exception as e:
+            return storage_error(e, "Failed to delete file")
+        self.cache_blob_removed(blob_name)
+
+        return Response(message="File deleted successfully",status_code=200)
+
+    # Delete several blobs at once, adding the outcome of each blob to user_session.delete_results
+    # Ownership of all blobs is checked with up to delete_concurrency property requests at once and
+    # the blobs that may be deleted are then sent as Blob Batch requests of up to DELETE_BATCH_SIZE deletes.
+    # Like delete_blob, each delete only succeeds if the blob still has the etag that was checked, so a blob
+    # replaced in the meantime, possibly by another user, is not deleted.
+    def delete_blobs(self, user_session: UserStorageSession, blob_names):
+        blob_names = list(dict.fromkeys(name for name in blob_names if name))
+        if not blob_names:
+            logger.warning(user_session.user + " sent bulk delete request without specified blob names")
+            return Response(message="No files specified for deletion",status_code=400)
+        if len(blob_names) > MAX_BULK_DELETE:
+            return Response(message="Cannot delete more than " + str(MAX_BULK_DELETE) + " files at once",status_code=400)
+
+        with ThreadPoolExecutor(max_workers=min(self.delete_concurrency, len(blob_names))) as executor:
+            checks = list(executor.map(lambda name: self.check_delete(user_session, name), blob_names))
+
+        results = {}
+        allowed = []
+        for blob_name, (check, properties) in zip(blob_names, checks):
+            if check.status_code == 200:
+                allowed.append(dict(name=blob_name, etag=properties.etag, match_condition=MatchConditions.IfNotModified))
+            else:
+                results[blob_name] = check.message
+
+        logger.info(user_session.user + " deleting " + str(len(allowed)) + " blobs in batches")
+        for start in range(0, len(allowed), DELETE_BATCH_SIZE):
+            batch = allowed[start:start + DELETE_BATCH_SIZE]
+            try:
+                with track_storage('delete_batch'):
+                    parts = list(self.container_client.delete_blobs(*batch, raise_on_any_failure=False))
+                statuses = [part.status_code for part in parts]
+            except Exception as e:
+                logger.error(e)
+                statuses = [None] * len(batch)
+
+            for blob, status in zip(batch, statuses):
+                blob_name = blob['name']
+                if status == 202:
+                    results[blob_name] = None
+                    self.cache_blob_removed(blob_name)
+                elif status == 412:
+                    logger.warning(blob_name + " changed before it was deleted")
+                    results[blob_name] = "File was changed while it was being deleted"
+                else:
+                    logger.warning("Batch delete of " + blob_name + " failed with status " + str(status))
+                    results[blob_name] = "Failed to delete file"
+
+        user_session.delete_results += [dict(name=name, deleted=results[name] is None, error=results[name])
+                                        for name in blob_names]
+        deleted = sum(1 for result in user_session.delete_results if result['deleted'])
+        return Response(message="Deleted " + str(deleted) + " of " + str(len(blob_names)) + " files",status_code=200)
+
+    # Check that a blob may be deleted by the user
+    # Returns a Response and the properties of the blob, which are None if it may not be deleted
+    def check_delete(self, user_session: UserStorageSession, blob_name):
         if blob_name is None:
             logger.warning(user_session.user + " sent delete request without specified blob name")
-            return Response(message="No file specified for deletion",status_code=400)
+            return Response(message="No file specified for deletion",status_code=400), None
+        if not blob_name.startswith(user_session.path):
+            logger.warning(user_session.user + " sent delete request for: " + blob_name + " outside of path: " + user_session.path)
+            return Response(message="File to delete was not found in the specified location",status_code=400), None
+
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=blob_name)
+        try:
+            with track_storage('get_properties'):
+                properties = blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            logger.warning(user_session.user + " sent delete request for: " + blob_name + " but blob was not found")
+            return Response(message="File to delete was not found in the specified location",status_code=400), None
+        except Exception as e:
+            return storage_error(e, "Failed to delete file"), None
+
+        uploaded_by = (properties.metadata or {}).get('uploaded_by', '').lower()
+        if uploaded_by != user_session.user:
+            logger.warning(user_session.user + " sent delete request for: " + blob_name + " uploaded by another user")
+            return Response(message="Only the user that uploaded a file can delete it",status_code=403), None
+
+        return Response(), properties
+
+    # Blob index tags written with an upload by user, or None if tags are not enabled
+    def upload_tags(self, user):
+        if not self.blob_tags:
+            return None
+        return {'uploaded_by': tag_value(user)}
+
+    # Get a page of the blobs the user uploaded under the user path and an optional name prefix
+    # With blob index tags the service finds the user's blobs, so the cost depends on the number of files
+    # of the user rather than the size of the folder. Pages may be empty while the continuation token is
+    # set, as the service finds the user's blobs in the whole container. The size of each blob is then
+    # read with up to delete_concurrency property requests at once. Without tags the folder listing is
+    # filtered instead and returned as a single page.
+    def list_user_blobs_page(self, user_session: UserStorageSession, prefix="", continuation=None):
+        if not self.blob_tags:
+            try:
+                blobs, folders = self.cached_tree(user_session.path)
+            except Exception as e:
+                return storage_error(e, "Failed to get Blob List")
+            user_session.blob_table += [blob.row(user_session.user) for blob in blobs
+                                        if blob.uploaded_by == user_session.user and
+                                        blob.name.startswith(user_session.path + prefix)]
+            return Response()
+
+        expression = "@container='" + self.container_name + "' AND \"uploaded_by\"='" + tag_value(user_session.user) + "'"
+        try:
+            pages = self.blob_service_client.find_blobs_by_tags(expression, results_per_page=self.api_page_size).by_page(
+                continuation_token=continuation)
+            with track_storage('find_by_tags'):
+                page = next(pages, [])
+            names = [blob.name for blob in page if blob.name.startswith(user_session.path + prefix)]
+            if names:
+                with ThreadPoolExecutor(max_workers=min(self.delete_concurrency, len(names))) as executor:
+                    sizes = list(executor.map(self.blob_size, names))
+                for name, size in zip(names, sizes):
+                    # Blobs deleted since they were found are left out
+                    if size is not None:
+                        user_session.blob_table.append(BlobEntry(name, size, user_session.user).row(user_session.user))
+            user_session.continuation = pages.continuation_token
+        except Exception as e:
+            return storage_error(e, "Failed to get Blob List")
+
+        return Response()
+
+    # Size of the file of a blob in bytes, or None if it does not exist
+    def blob_size(self, blob_name):
+        blob_client = self.container_client.get_blob_client(blob_name)
+        try:
+            with track_storage('get_properties'):
+                return logical_size(blob_client.get_blob_properties())
+        except ResourceNotFoundError:
+            return None
+
+    # Write the uploaded_by blob index tag on blobs uploaded before tags were enabled, keeping their other tags
+    # Blobs are tagged with up to concurrency requests at once. Returns the number of blobs tagged and failed.
+    def backfill_tags(self, concurrency=16):
+        results = []
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            running = set()
+            for blob in self.container_client.list_blobs(include=['metadata', 'tags'],
+                                                         results_per_page=self.list_page_size):
+                uploaded_by = (blob.metadata or {}).get('uploaded_by', '').lower()
+                tags = blob.tags or {}
+                if not uploaded_by or tags.get('uploaded_by') == tag_value(uploaded_by):
+                    continue
+                running.add(executor.submit(self.set_tags, blob.name, dict(tags, uploaded_by=tag_value(uploaded_by))))
+                if len(running) >= concurrency:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    results += [future.result() for future in done]
+            results += [future.result() for future in wait(running).done]
+
+        tagged = results.count(True)
+        failed = len(results) - tagged
+        logger.info("Tagged " + str(tagged) + " blobs with their upload user, " + str(failed) + " failed")
+        return tagged, failed
+
+    # Replace the tags of a blob, returns whether it succeeded
+    def set_tags(self, blob_name, tags):
+        try:
+            with track_storage('set_tags'):
+                self.container_client.get_blob_client(blob_name).set_blob_tags(tags)
+        except Exception as e:
+            logger.error("Failed to tag " + blob_name + ": " + str(e))
+            return False
+        return True
+
+    # Prepare the download of a blob in user_session.download, streamed from storage one chunk at a time
+    # byte_range is the parsed Range header, only a single range is served and other requests get the
+    # whole blob. if_none_match and if_range are the parsed conditional headers of the request.
+    # Blobs stored compressed are decompressed as they are sent, always as a whole since ranges of the
+    # file cannot be read from the compressed blob.
+    def download_blob(self, user_session: UserStorageSession, blob_name, byte_range=None, if_none_match=None, if_range=None):
+        if not blob_name or not blob_name.startswith(user_session.path):
+            logger.warning(user_session.user + " sent download request for: " + str(blob_name) + " outside of path: " + user_session.path)
+            return Response(message="File to download was not found in the specified location",status_code=404)
+
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=blob_name)
+        try:
+            with track_storage('get_properties'):
+                properties = blob_client.get_blob_properties()
+        except ResourceNotFoundError:
+            return Response(message="File to download was not found in the specified location",status_code=404)
+        except Exception as e:
+            return storage_error(e, "Failed to download file")
+
+        etag = properties.etag.strip('"')
+        compressed = is_compressed(properties)
+        headers = {'ETag': '"' + etag + '"',
+                   'Last-Modified': http_date(properties.last_modified),
+                   'Accept-Ranges': 'none' if compressed else 'bytes'}
+        if compressed:
+            byte_range = None
+        if if_none_match and if_none_match.contains_weak(etag):
+            user_session.download = dict(status=304, headers=headers, body=[])
+            return Response()
+
+        status = 200
+        start, stop = 0, logical_size(properties)
+        offset, length = None, None
+        # A range is only served if the If-Range etag, when there is one, matches, and a date is never trusted
+        if_range_matches = if_range is None or (if_range.date is None and if_range.etag in (None, etag))
+        if byte_range is not None and len(byte_range.ranges) == 1 and if_range_matches:
+            content_range = byte_range.range_for_length(properties.size)
+            if content_range is None:
+                headers['Content-Range'] = 'bytes */' + str(properties.size)
+                user_session.download = dict(status=416, headers=headers, body=[])
+                return Response()
+            status = 206
+            start, stop = content_range
+            offset, length = start, stop - start
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, stop - 1, properties.size)
+
+        reserved = 0
+        try:
+            # The chunk read from storage and the one being sent to the client are held in memory
+            reserved = self.memory_budget.acquire(2 * self.download_chunk_size)
+            # Only send the content the headers were built for, even if the blob changes in the meantime
+            if compressed:
+                body = iter_gunzip(self.download_raw(blob_name, properties.etag))
+            else:
+                with track_storage('download_first_chunk'):
+                    downloader = blob_client.download_blob(offset=offset, length=length, etag=properties.etag,
+                                                           match_condition=MatchConditions.IfNotModified)
+                body = track_storage_items('download_chunk', downloader.chunks())
+        except Exception as e:
+            self.memory_budget.release(reserved)
+            return storage_error(e, "Failed to download file")
+
+        logger.info(user_session.user + " downloading " + blob_name + " bytes " + str(start) + "-" + str(stop))
+        headers.update({'Content-Type': properties.content_settings.content_type or 'application/octet-stream',
+                        'Content-Disposition': attachment(blob_name.split("/")[-1])})
+        if compressed:
+            # The length of the file is only known if it was recorded when the blob was uploaded
+            if ORIGINAL_SIZE_KEY in (properties.metadata or {}):
+                headers['Content-Length'] = str(logical_size(properties))
         else:
-            delete_count = 0
-            for blob in user_session.blob_table:
-                if blob['name'] == blob_name and blob['uploaded_by'] == user_session.user:
-                    delete_count += 1
-                    blob_client = self.blob_service_client.get_blob_client(container=self.container_name,
-                                                                           blob=blob_name)
-                    logger.info(user_session.user + " deleting blob: " + blob_name)
-                    blob_client.delete_blob(delete_snapshots=False)
-                    user_session.blob_table.remove(blob)
-
-            if delete_count < 1:
-                logger.warning(user_session.user + " sent delete request for: " + blob_name + " but blob was not found")
-                return Response(message="File to delete was not found in the specified location",status_code=400)
+            headers['Content-Length'] = str(stop - start)
+        user_session.download = dict(status=status, headers=headers, body=ReservedBody(self.memory_budget, body, reserved))
+        return Response()
 
-        return Response(message="File deleted successfully",status_code=200)
+    # Read the stored content of a blob in chunks, as it is stored, if its etag still matches
+    # The storage client reads blobs in ranges through requests, which undoes a gzip Content-Encoding of
+    # every ranged response on its own, and that fails for each range but the first. Compressed blobs are
+    # read with a SAS that has the service send the responses with the identity Content-Encoding instead,
+    # so the ranges come back untouched. The blob itself keeps its gzip Content-Encoding.
+    # The first chunk is read right away and the others as the chunks are iterated, each read is timed on its own.
+    def download_raw(self, blob_name, etag):
+        sas_token = self.blob_sas(blob_name, BlobSasPermissions(read=True), RAW_DOWNLOAD_SAS_MINUTES,
+                                  content_encoding=RAW_CONTENT_ENCODING)
+        blob_client = BlobClient(self.account_url, self.container_name, blob_name, credential=sas_token,
+                                 **self.client_options)
+        with track_storage('download_first_chunk'):
+            downloader = blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+        return track_storage_items('download_chunk', downloader.chunks())
+
+    # Prepare the download of all blobs under a prefix of the user's path as a ZIP archive in user_session.download
+    # The archive is built while it is sent, with the next blobs read from storage concurrently,
+    # so memory use is bounded by the prefetch settings rather than the size of the folder
+    def download_folder(self, user_session: UserStorageSession, prefix=""):
+        folder = user_session.path.rstrip("/").split("/")[-1] or self.container_name
+        # Each blob being read holds its queued chunks and the chunk waiting to be queued,
+        # and one more chunk is being written to the archive
+        try:
+            reserved = self.memory_budget.acquire((self.zip_concurrency * (self.zip_prefetch_chunks + 1) + 1) *
+                                                  self.download_chunk_size)
+        except MemoryBudgetExceeded as e:
+            return storage_error(e, "Failed to download folder")
+        logger.info(user_session.user + " downloading folder: " + user_session.path + prefix)
+        user_session.download = dict(status=200,
+                                     headers={'Content-Type': 'application/zip',
+                                              'Content-Disposition': attachment(folder + ".zip")},
+                                     body=ReservedBody(self.memory_budget,
+                                                       iter_zip(self.zip_entries(user_session.path, prefix)), reserved))
+        return Response()
+
+    # ZIP entries for the blobs under path + prefix, named by their path relative to path
+    def zip_entries(self, path, prefix):
+        pages = self.container_client.list_blobs(name_starts_with=path + prefix, include='metadata',
+                                                 results_per_page=self.list_page_size).by_page()
+        blobs = (blob for page in track_storage_items('list', pages) for blob in page)
+        pending = deque()
+        cancelled = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.zip_concurrency, thread_name_prefix="azure-storage-zip")
+        try:
+            while True:
+                while len(pending) < self.zip_concurrency:
+                    blob = next(blobs, None)
+                    if blob is None:
+                        break
+                    chunks = queue.Queue(maxsize=self.zip_prefetch_chunks)
+                    executor.submit(self.fetch_chunks, blob, chunks, cancelled)
+                    pending.append((blob, chunks))
+                if not pending:
+                    break
+
+                blob, chunks = pending.popleft()
+                yield remove_prefix(blob.name, path), logical_size(blob), blob.last_modified, iter_chunks(chunks)
+        except Exception as e:
+            # The response has already started, so all that can be done is to end it early
+            logger.error(e)
+            raise
+        finally:
+            # Stop the downloads still running if the client went away
+            cancelled.set()
+            executor.shutdown(wait=False)
+
+    # Read a blob into a bounded queue of chunks, ending with None or the exception that stopped the download
+    # A compressed blob is decompressed here, so the file is added to the archive
+    def fetch_chunks(self, blob, chunks, cancelled):
+        try:
+            blob_client = self.container_client.get_blob_client(blob.name)
+            if is_compressed(blob):
+                content = iter_gunzip(self.download_raw(blob.name, blob.etag))
+            else:
+                with track_storage('download_first_chunk'):
+                    downloader = blob_client.download_blob(etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+                content = track_storage_items('download_chunk', downloader.chunks())
+            for chunk in content:
+                if not put_chunk(chunks, chunk, cancelled):
+                    return
+            put_chunk(chunks, None, cancelled)
+        except Exception as e:
+            put_chunk(chunks, e, cancelled)
+
+    # Issue a short lived SAS URL that only allows creating the single blob being uploaded,
+    # so the browser can send the file straight to storage instead of through the app.
+    # The browser only stages the blocks, named after the upload id issued with the SAS,
+    # and complete_direct_upload commits them with the uploading user's metadata.
+    def create_upload_sas(self, filename, subfolder, user_session: UserStorageSession):
+        blob_name = upload_blob_name(filename, subfolder, user_session)
+        if blob_name is None:
+            return Response(message="Must select a file to upload first!",status_code=400)
+
+        try:
+            blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=blob_name)
+            try:
+                # Check if blob already exists
+                with track_storage('get_properties'):
+                    properties = blob_client.get_blob_properties()
+                if properties['size'] > 0:
+                    logger.warning(blob_name + " already exists. Skipping upload.")
+                    return Response(message=filename + " already exists in the selected path",status_code=409,error_flag=2)
+            except ResourceNotFoundError:
+                pass
+
+            # Create permission does not allow overwriting an existing blob
+            sas_token = self.blob_sas(blob_name, BlobSasPermissions(create=True), self.upload_sas_minutes)
+        except Exception as e:
+            return storage_error(e, "Failed to authorize upload")
+
+        logger.info(user_session.user + " authorized for direct upload of: " + blob_name)
+        user_session.upload_url = blob_client.url + "?" + sas_token
+        user_session.upload_id = str(uuid.uuid4())
+        return Response(message="Upload authorized",status_code=200)
+
+    # Commit the blocks the browser staged with a SAS URL, creating the blob with the uploading user's metadata
+    # The owner is decided here rather than by the browser: only blocks of the upload id are committed, the
+    # commit only succeeds if the blob does not exist yet, and the size is the size of the staged blocks.
+    # A blob the browser committed itself has no uploader, so it is never taken over by a later commit.
+    # The content never passes through the app, so when duplicate uploads are copied the hash of the chunks the
+    # page sends is stored as is. It is only a hint for finding the user's own files, see copy_duplicate.
+    def complete_direct_upload(self, filename, subfolder, user_session: UserStorageSession, upload_id, block_count,
+                               content_type=None, content_md5=None):
+        blob_name = upload_blob_name(filename, subfolder, user_session)
+        if blob_name is None:
+            return Response(message="Must select a file to upload first!",status_code=400)
+        try:
+            block_ids = [chunk_block_id(upload_id, i) for i in range(int(block_count))]
+            content_md5 = parse_md5(content_md5) if content_md5 else None
+        except (TypeError, ValueError):
+            logger.warning(user_session.user + " sent invalid direct upload parameters for: " + blob_name)
+            return Response(message="Invalid upload parameters",status_code=400)
+
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=blob_name)
+        try:
+            with track_storage('list_blocks'):
+                committed, uncommitted = blob_client.get_block_list('uncommitted')
+        except ResourceNotFoundError:
+            uncommitted = []
+        except Exception as e:
+            return storage_error(e, "Failed to upload file")
+
+        staged = {block.id: block.size for block in uncommitted}
+        if any(block_id not in staged for block_id in block_ids):
+            logger.warning(user_session.user + " finalized direct upload of: " + blob_name + " but not all blocks were staged")
+            return Response(message="Uploaded file was not found",status_code=400)
+
+        metadata = {'uploaded_by': user_session.user}
+        if self.upload_dedupe and content_md5:
+            metadata[CHUNK_MD5_KEY] = content_md5
+        else:
+            content_md5 = None
+        try:
+            with track_storage('commit'):
+                blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids],
+                                              metadata=metadata,
+                                              tags=self.upload_tags(user_session.user),
+                                              content_settings=ContentSettings(content_type=content_type or None),
+                                              match_condition=MatchConditions.IfMissing)
+        except (ResourceExistsError, ResourceModifiedError):
+            logger.warning(blob_name + " already exists. Skipping upload.")
+            return Response(message=filename + " already exists in the selected path",status_code=409,error_flag=2)
+        except Exception as e:
+            return storage_error(e, "Failed to upload file")
+        logger.info(user_session.user + " uploaded " + blob_name + " directly to Azure Storage")
+
+        # Update the table display and any cached listings with the new blob
+        entry = BlobEntry(blob_name, sum(staged[block_id] for block_id in block_ids), user_session.user)
+        user_session.blob_table.append(entry.row(user_session.user))
+        self.cache_blob_added(entry, content_md5)
+        return Response(message="Uploaded File Successfully",status_code=200)
+
+    # Hash of a chunked upload from the hashes of its chunks recorded by stage_chunk, or None if it is not known
+    def chunk_md5(self, blob_name, upload_id, sizes):
+        if not self.upload_dedupe:
+            return None
+        try:
+            return self.inventory.chunk_md5(blob_name, upload_id, sizes)
+        except Exception as e:
+            logger.error("Failed to read the chunk hashes of " + blob_name + ": " + str(e))
+            return None
+
+    def remove_chunk_hashes(self, blob_name, upload_id):
+        if self.upload_dedupe:
+            try:
+                self.inventory.remove_chunks(blob_name, upload_id)
+            except Exception as e:
+                logger.error(e)
+
+    # Sign a SAS for a blob valid for the given minutes with a user delegation key of the app's credential,
+    # or with the account key if the app was given one, such as the key of a local storage emulator
+    def blob_sas(self, blob_name, permission, minutes, **kwargs):
+        if isinstance(self.token_credential, dict):
+            kwargs['account_key'] = self.token_credential['account_key']
+        else:
+            kwargs['user_delegation_key'] = self.get_delegation_key(minutes)
+        return generate_blob_sas(self.blob_service_client.account_name, self.container_name, blob_name,
+                                 permission=permission, expiry=datetime.utcnow() + timedelta(minutes=minutes), **kwargs)
+
+    # Get the user delegation key for signing SAS tokens valid for the given minutes from the app's credential
+    # A key is requested for a few hours and reused until it is close to expiring
+    def get_delegation_key(self, minutes):
+        with self.delegation_key_lock:
+            now = datetime.utcnow()
+            if self.delegation_key is None or self.delegation_key_expiry - now < timedelta(minutes=minutes):
+                self.delegation_key_expiry = now + timedelta(hours=4)
+                self.delegation_key = self.blob_service_client.get_user_delegation_key(
+                    key_start_time=now - timedelta(minutes=5),
+                    key_expiry_time=self.delegation_key_expiry)
+            return self.delegation_key
+
+    # Keep cached listings of every configured path containing the blob and the inventory in line with our own writes
+    def cache_blob_added(self, entry, content_md5=None):
+        if self.inventory is not None:
+            try:
+                self.inventory.add(entry, content_md5)
+            except Exception as e:
+                logger.error("Failed to add " + entry.name + " to the inventory: " + str(e))
+        for prefix in self.cached_prefixes(entry.name):
+            # Include every parent folder of the blob relative to the cached path
+            parts = remove_prefix(entry.name, prefix).split("/")[:-1]
+            folders = ["/".join(parts[:i + 1]) for i in range(len(parts))]
+            self.listing_cache.add_blob(prefix, entry, folders)
+
+    def cache_blob_removed(self, blob_name):
+        if self.inventory is not None:
+            try:
+                self.inventory.remove(blob_name)
+            except Exception as e:
+                logger.error("Failed to remove " + blob_name + " from the inventory: " + str(e))
+        for prefix in self.cached_prefixes(blob_name):
+            self.listing_cache.remove_blob(prefix, blob_name)
+
+    def cached_prefixes(self, blob_name):
+        return [prefix for prefix in self.app_config['PATHS'].values() if blob_name.startswith(prefix)]
+
+
+# Virtual directory used to rebuild the folder tree from a flat blob listing
+class _FolderNode:
+
+    def __init__(self, name):
+        self.name = name
+        self.blobs = []
+        self.children = {}
+
+    def child(self, name):
+        node = self.children.get(name)
+        if node is None:
+            # Relative folder names are joined with "/" to match the listing prefixes
+            node = _FolderNode(name if not self.name else self.name + "/" + name)
+            self.children[name] = node
+        return node
+
+    # Get the node of a folder path relative to this node, given with a trailing "/"
+    def descendant(self, folder):
+        node = self
+        for name in folder.split("/")[:-1]:
+            node = node.child(name)
+        return node
+
+    # Blobs of a folder come first, then its direct subfolders are listed before
+    # each of them is expanded in turn
+    def flatten(self, blobs, folders):
+        blobs += self.blobs
+        folders += [node.name for node in self.children.values()]
+        for node in self.children.values():
+            node.flatten(blobs, folders)
+
+
+# Metadata, content settings, size and hex MD5 of the file of an upload once its stream has been read
+# md5 is the hash of the uploaded content and size its length. For a compressed upload the content is
+# the compressed file, which gets the gzip Content-Encoding, and the size and MD5 of the file itself
+# are kept in the metadata, as the file table and the content hash index describe the file.
+def upload_properties(stream, metadata, size, md5):
+    if isinstance(stream, GzipStream):
+        return (dict(metadata, **stream.metadata()),
+                ContentSettings(content_md5=bytearray(md5.digest()), content_encoding=CONTENT_ENCODING),
+                stream.original_size, stream.original_md5.hexdigest())
+    return metadata, md5_settings(md5.hexdigest()), size, md5.hexdigest()
+
+
+# Most memory upload_stream holds for an upload with the given settings: the blocks it reads and a copy
+# of each on its way to storage. A file no larger than size_hint never needs more than twice its size.
+def upload_memory(settings, size_hint=None):
+    buffered = max(settings['max_single_put_size'] + settings['max_block_size'],
+                   (settings['max_concurrency'] + 1) * settings['max_block_size'])
+    if size_hint:
+        buffered = min(buffered, size_hint)
+    return 2 * buffered
+
+
+# Content settings of a blob with the given hex MD5 as its Content-MD5
+def md5_settings(content_md5):
+    return ContentSettings(content_md5=bytearray.fromhex(content_md5))
+
+
+# Response for a storage call that failed with e
+# Requests failed by the circuit breaker, their deadline or throttling that outlasted the retries
+# get a 503, so the user knows to try again later, as do requests that found no memory for their content
+def storage_error(e, message, error_flag=0):
+    if isinstance(e, MemoryBudgetExceeded):
+        logger.warning(e)
+        return Response(message="The server is busy, please try again shortly", status_code=503, error_flag=error_flag)
+    logger.error(e)
+    if isinstance(e, StorageUnavailableError) or getattr(e, 'error_code', None) in THROTTLING_ERROR_CODES:
+        return Response(message="Storage is busy, please try again shortly", status_code=503, error_flag=error_flag)
+    return Response(message=message, status_code=400, error_flag=error_flag)
+
+
+# Lowercase hex MD5 sent by a client, raises ValueError if it is not one
+def parse_md5(value):
+    digest = bytes.fromhex(value)
+    if len(digest) != 16:
+        raise ValueError("Invalid MD5: " + value)
+    return digest.hex()
+
+
+# Blob index tag values only allow letters, digits, space and + - . / : = _, other characters of
+# the user name such as @ are written as =XX escapes of their UTF-8 bytes, with = escaped as well
+def tag_value(user):
+    value = ""
+    for char in user:
+        if char.isascii() and (char.isalnum() or char in " +-./:_"):
+            value += char
+        else:
+            value += "".join("=%02X" % byte for byte in char.encode('utf-8'))
+    return value
+
+
+# Build the folder tree under a path from blob entries in name order
+# Returns the blob entries and the relative folder names in the order of a recursive walk of the path
+def folder_tree(path, entries):
+    root = _FolderNode("")
+    node, node_folder = root, ""
+    for entry in entries:
+        # Walk down to the virtual directory holding the blob, creating nodes as needed
+        # Blobs are listed by name, so most blobs are in the folder of the blob before them
+        relative = remove_prefix(entry.name, path)
+        folder = relative[:relative.rfind("/") + 1]
+        if folder != node_folder:
+            node, node_folder = root.descendant(folder), folder
+        node.blobs.append(entry)
+
+    blobs = []
+    folders = []
+    root.flatten(blobs, folders)
+    return blobs, folders
+
+
+# Get the blob name for an uploaded file in the user path and optional subfolder
+# Returns None if no usable file name was sent
+def upload_blob_name(filename, subfolder, user_session: UserStorageSession):
+    filename = secure_filename(filename or "")
+    if not filename:
+        return None
+    if subfolder == '':
+        return user_session.path + filename
+    return user_session.path + subfolder + "/" + filename
+
+
+# File of a batch upload read into memory, provides the filename and read method used by upload_blob
+class BufferedFile(io.BytesIO):
+
+    def __init__(self, filename, data):
+        super().__init__(data)
+        self.filename = filename
+
+
+# Add a chunk to the queue of a folder download, giving up once the download has been cancelled
+# Stream that updates md5 with the data read from stream
+class HashingStream:
+
+    def __init__(self, stream, md5):
+        self.stream = stream
+        self.md5 = md5
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.md5.update(data)
+        return data
+
+
+def put_chunk(chunks, chunk, cancelled):
+    while not cancelled.is_set():
+        try:
+            chunks.put(chunk, timeout=1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# Chunks of a blob read by AzureStorage.fetch_chunks
+def iter_chunks(chunks):
+    while True:
+        chunk = chunks.get()
+        if chunk is None:
+            return
+        if isinstance(chunk, Exception):
+            logger.error(chunk)
+            raise chunk
+        yield chunk
+
+
+# Stage one block of upload_stream, run on the thread pool of the upload
+def stage_block(blob_client, block_id, block):
+    with track_storage('stage_block'):
+        blob_client.stage_block(block_id, block, length=len(block))
+
+
+# Content-Disposition header that makes the browser save the response with the given file name
+def attachment(filename):
+    return "attachment; filename*=UTF-8''" + url_quote(filename, safe="")
+
+
+# Read from a stream until size bytes have been read or the stream ends
+def read_fully(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+# Block ids of a blob must all have the same length, so the id is the Dropzone upload
+# uuid as 32 hex digits followed by the zero padded chunk index
+# The block of a compressed chunk is smaller than the chunk, so its id ends with the size of the chunk
+# as 10 more digits. Every chunk of a compressed file is compressed, so its ids have the same length too.
+# Raises ValueError for an invalid uuid or a chunk index outside the 50000 blocks allowed per blob,
+# and TypeError for a missing one
+def chunk_block_id(upload_id, chunk_index, chunk_size=None):
+    chunk_index = int(chunk_index)
+    if not 0 <= chunk_index < 50000:
+        raise ValueError("Chunk index out of range: " + str(chunk_index))
+    block_id = "{:032x}{:08d}".format(uuid.UUID(upload_id).int, chunk_index)
+    if chunk_size is not None:
+        block_id += "{:010d}".format(chunk_size)
+    return block_id
+
+
+# Chunk index and size of the file content of a block staged by stage_chunk
+def staged_chunk(block):
+    if len(block.id) > 40:
+        return int(block.id[32:40]), int(block.id[40:])
+    return int(block.id[32:40]), block.size
+
+
+# Build the user independent table entry for a listed blob
+def blob_entry(blob):
+    # Try to get metadata for blob if it exists to find the original upload user
+    metadata = getattr(blob, 'metadata', None)
+    if not metadata or 'uploaded_by' not in metadata:
+        logger.warning("Metadata missing from blob: " + blob.name + " Setting user to null")
+        uploaded_by = ""
+    else:
+        uploaded_by = metadata['uploaded_by'].lower()
+
+    return BlobEntry(blob.name, logical_size(blob), uploaded_by)
 
 
-# function to get unique values
-def unique(list1):
-    # insert the list to the set 
-    list_set = set(list1)
-    # convert the set to the list and return
-    return (list(list_set))
+# Check the ROLES config against PATHS and remove duplicate folders of a role, keeping their order
+def compile_role_folders(roles, paths):
+    role_folders = {}
+    for role, folders in roles.items():
+        missing = [folder for folder in folders if folder not in paths]
+        if missing:
+            raise ValueError("Folders of role " + role + " missing from PATHS: " + ", ".join(missing))
+        role_folders[role] = list(dict.fromkeys(folders))
+    return role_folders
 
 
 # Remove prefix from string
@@ -0,0 +1,98 @@
+import hashlib
+import mimetypes
+import zlib
+
+# Blobs stored compressed have this Content-Encoding and keep the size and MD5 of the
+# uncompressed file in their metadata
+CONTENT_ENCODING = 'gzip'
+ORIGINAL_SIZE_KEY = 'original_size'
+ORIGINAL_MD5_KEY = 'original_md5'
+# wbits of zlib for a gzip header and trailer around the deflate stream
+GZIP_WBITS = 31
+
+
+# File object that gzip compresses another file object as it is read
+# The size and MD5 of the uncompressed content read so far are kept for the blob metadata.
+class GzipStream:
+
+    def __init__(self, stream, level=6, buffer_size=64 * 1024):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+        self.buffer = bytearray()
+        self.eof = False
+        self.original_size = 0
+        self.original_md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            data = self.stream.read(self.buffer_size)
+            if data:
+                self.original_size += len(data)
+                self.original_md5.update(data)
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    # Metadata recording the uncompressed content, only complete once the stream has been read to its end
+    def metadata(self):
+        return {ORIGINAL_SIZE_KEY: str(self.original_size), ORIGINAL_MD5_KEY: self.original_md5.hexdigest()}
+
+
+# Compress one chunk of a chunked upload as a gzip member of its own
+# The members of all chunks form a valid gzip stream once the blocks are committed in order
+def gzip_chunk(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+# Decompress the chunks of a gzip stream of one or more members, with at most out_size bytes per piece
+# so a highly compressed chunk does not expand in memory all at once
+def iter_gunzip(chunks, out_size=1024 * 1024):
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    for chunk in chunks:
+        while True:
+            data = decompressor.decompress(chunk, out_size)
+            if data:
+                yield data
+            if decompressor.eof:
+                # The next member starts right after the end of this one
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                if not chunk:
+                    break
+            elif decompressor.unconsumed_tail or len(data) == out_size:
+                chunk = decompressor.unconsumed_tail
+            else:
+                break
+
+
+# True if the blob or blob properties are of a blob stored compressed
+def is_compressed(blob):
+    settings = getattr(blob, 'content_settings', None)
+    return settings is not None and settings.content_encoding == CONTENT_ENCODING
+
+
+# Size of the file a blob holds, which is the uncompressed size of a compressed blob
+def logical_size(blob):
+    if is_compressed(blob):
+        try:
+            return int((blob.metadata or {})[ORIGINAL_SIZE_KEY])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return blob.size
+
+
+# Content types of a file name that are compressed, given as full types or prefixes ending in /
+def compressible(filename, content_types):
+    content_type = mimetypes.guess_type(filename)[0]
+    if content_type is None:
+        return False
+    return any(content_type == allowed or (allowed.endswith("/") and content_type.startswith(allowed))
+               for allowed in content_types)
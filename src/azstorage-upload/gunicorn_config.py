@@ -1,4 +1,5 @@
 # Gunicorn configuration file.
+import os
 
 #
 # Server socket
@@ -21,6 +22,10 @@
 bind = '0.0.0.0:8000'
 # backlog = 2048
 
+# Port the master process serves the Prometheus metrics of all workers on, see when_ready
+# The service and ingress only route to the app port, so the metrics stay inside the cluster
+metrics_port = int(os.getenv('METRICS_PORT', 9100))
+
 #
 # Worker processes
 #
@@ -64,9 +69,18 @@ bind = '0.0.0.0:8000'
 #
 #       A positive integer. Generally set in the 1-5 seconds range.
 #
+#   threads - The number of worker threads for handling requests
+#       with the gthread worker class. Each thread handles one
+#       request at a time, so this bounds the concurrent uploads
+#       and listings served by one worker process.
+#
+#       A positive integer generally in the 2-4 x $(NUM_CORES) range.
+#
 
-workers = 1
-# worker_class = 'sync'
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+# Threaded workers keep serving other users while a request waits on storage
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', 8))
 # worker_connections = 1000
 timeout = 180
 # keepalive = 2
@@ -183,6 +197,36 @@ proc_name = 'azstorage'
 #       A callable that takes a server instance as the sole argument.
 #
 
+# Prometheus metrics of the workers are kept in files in prometheus_multiproc_dir
+# Files of an earlier run are removed on start, and the files of a worker that exits
+# are marked dead so its gauges no longer count towards the totals of the live workers.
+# The master only uses prometheus_client, importing the app's metrics module would add
+# metric files of the master process itself.
+def on_starting(server):
+    metrics_dir = os.environ.get('prometheus_multiproc_dir')
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+# Serve the metrics of all workers on metrics_port from a thread of the master process
+def when_ready(server):
+    if not os.environ.get('prometheus_multiproc_dir'):
+        server.log.warning("prometheus_multiproc_dir is not set, metrics are not served")
+        return
+    from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(metrics_port, registry=registry)
+    server.log.info("Serving metrics on port %s", metrics_port)
+
+
+def child_exit(server, worker):
+    if os.environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
 # def post_fork(server, worker):
 #     server.log.info("Worker spawned (pid: %s)", worker.pid)
 
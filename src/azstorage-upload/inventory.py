@@ -0,0 +1,303 @@
+from listing_cache import BlobEntry
+from compression import is_compressed, logical_size, ORIGINAL_MD5_KEY
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import logging
+
+logger = logging.getLogger('azure_storage_app')
+
+# Continuation tokens of listing pages served from the inventory start with this prefix,
+# so they can be told apart from the continuation tokens of the storage service
+INVENTORY_TOKEN_PREFIX = "inventory:"
+
+# Metadata key of the hash of a file uploaded in chunks, see chunked_md5
+CHUNK_MD5_KEY = 'chunk_md5'
+
+# Storage discards uncommitted blocks after a week, the hashes of their chunks are kept as long
+CHUNK_HASH_RETENTION = 7 * 24 * 60 * 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    name TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_modified REAL,
+    etag TEXT,
+    uploaded_by TEXT NOT NULL,
+    updated REAL NOT NULL,
+    deleted REAL,
+    content_md5 TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunk_hashes (
+    blob TEXT NOT NULL,
+    upload_id TEXT NOT NULL,
+    chunk_index INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    md5 BLOB NOT NULL,
+    staged REAL NOT NULL,
+    PRIMARY KEY (blob, upload_id, chunk_index)
+) WITHOUT ROWID;
+"""
+
+
+# Local SQLite index of the blobs of the container
+# The index is filled by a full listing of the container in a background thread and kept current
+# by our own uploads and deletes, which are written to it right away. Changes made outside of the
+# app are picked up by a reconciliation listing every reconcile_interval seconds that only writes
+# the blobs whose etag or last modified time changed. The index is local to the pod, so it is only
+# used with a single replica.
+# Folder listings and listing pages are served from the index once a listing has completed
+# within the last two reconcile intervals. The database file can be shared by the worker
+# processes of a pod, only one of them runs each reconciliation.
+# The index also keeps the hashes of the chunks of uploads in progress until they are committed.
+class Inventory:
+
+    def __init__(self, path, reconcile_interval):
+        self.path = path
+        self.reconcile_interval = reconcile_interval
+        self._local = threading.local()
+        self._thread = None
+        with self.connection() as db:
+            db.executescript(_SCHEMA)
+            # Indexes created before content hashes were kept get the column, and their etags are
+            # cleared so the next reconciliation writes the hash of every blob
+            if "content_md5" not in [row[1] for row in db.execute("PRAGMA table_info(blobs)")]:
+                db.execute("ALTER TABLE blobs ADD COLUMN content_md5 TEXT")
+                db.execute("UPDATE blobs SET etag = NULL")
+            db.execute("CREATE INDEX IF NOT EXISTS blobs_content_md5 ON blobs (content_md5)")
+
+    # Each thread uses its own connection to the database
+    def connection(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    # Start reconciling in a background thread, list_blobs returns an iterable of every blob
+    # of the container with its metadata
+    def start(self, list_blobs):
+        self._thread = threading.Thread(target=self.run, args=(list_blobs,), name="azure-storage-inventory",
+                                        daemon=True)
+        self._thread.start()
+
+    def run(self, list_blobs):
+        while True:
+            try:
+                if self.claim_reconcile():
+                    self.reconcile(list_blobs())
+            except Exception as e:
+                logger.error("Inventory reconciliation failed: " + str(e))
+            time.sleep(min(self.reconcile_interval, 60))
+
+    # True if the index is recent enough to serve listings from
+    def ready(self):
+        synced = self.get_meta('synced')
+        return synced is not None and time.time() - synced < 2 * self.reconcile_interval
+
+    def get_meta(self, key):
+        row = self.connection().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    # Claim the next reconciliation once the interval has passed since the last one was started,
+    # so only one of the processes sharing the database lists the container
+    def claim_reconcile(self):
+        now = time.time()
+        with self.connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            claimed = db.execute("SELECT value FROM meta WHERE key = 'claimed'").fetchone()
+            if claimed and now - claimed[0] < self.reconcile_interval:
+                return False
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('claimed', ?)", (now,))
+        return True
+
+    # Bring the index in line with a full listing of the container, given in name order
+    # Each listed page is compared with the indexed blobs in the same name range, blobs that are new or
+    # changed are written and indexed blobs missing from the listing are removed. Blobs written by our
+    # own uploads and deletes after the listing started are left alone, the listing may have passed them.
+    def reconcile(self, blobs):
+        started = time.time()
+        added = changed = removed = listed = 0
+        db = self.connection()
+        after = None
+        page = []
+        for blob in blobs:
+            page.append(blob)
+            if len(page) == 5000:
+                counts = self._reconcile_page(db, page, after, started)
+                added, changed, removed = added + counts[0], changed + counts[1], removed + counts[2]
+                listed += len(page)
+                after = page[-1].name
+                page = []
+        counts = self._reconcile_page(db, page, after, started, last=True)
+        added, changed, removed = added + counts[0], changed + counts[1], removed + counts[2]
+        listed += len(page)
+
+        with db:
+            # Deletes of ours from before the listing started are confirmed by it and no longer need to be kept
+            db.execute("DELETE FROM blobs WHERE deleted IS NOT NULL AND deleted < ?", (started,))
+            # Chunks of uploads that were never committed
+            db.execute("DELETE FROM chunk_hashes WHERE staged < ?", (started - CHUNK_HASH_RETENTION,))
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('synced', ?)", (started,))
+        logger.info("Inventory reconciled " + str(listed) + " blobs in " + str(round(time.time() - started, 2)) +
+                    " seconds: " + str(added) + " added, " + str(changed) + " changed, " + str(removed) + " removed")
+
+    def _reconcile_page(self, db, page, after, started, last=False):
+        # Indexed blobs from after the previous page up to the end of this page, or to the end of the
+        # index for the last page, so blobs deleted between two pages are found as well
+        query = "SELECT name, etag, last_modified, updated, deleted FROM blobs WHERE 1"
+        args = []
+        if after is not None:
+            query += " AND name > ?"
+            args.append(after)
+        if not last:
+            query += " AND name <= ?"
+            args.append(page[-1].name)
+        indexed = {row[0]: row[1:] for row in db.execute(query, args)}
+
+        writes = []
+        added = changed = 0
+        for blob in page:
+            last_modified = blob.last_modified.timestamp() if blob.last_modified else None
+            row = indexed.pop(blob.name, None)
+            if row is not None:
+                etag, indexed_last_modified, updated, deleted = row
+                # Deleted by us while the listing was running
+                if deleted is not None and deleted >= started:
+                    continue
+                if deleted is None and etag == blob.etag and indexed_last_modified == last_modified:
+                    continue
+                changed += 1
+            else:
+                added += 1
+            writes.append((blob.name, logical_size(blob), last_modified, blob.etag, uploaded_by(blob), started,
+                           blob_content_md5(blob)))
+
+        # Indexed blobs that are no longer listed, unless written by us since the listing started
+        stale = [(name, started) for name, row in indexed.items() if row[2] < started]
+        # The conditions keep writes of ours made since the rows were read
+        with db:
+            db.executemany("INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?, NULL, ?) ON CONFLICT (name) DO UPDATE SET "
+                           "size = excluded.size, last_modified = excluded.last_modified, etag = excluded.etag, "
+                           "uploaded_by = excluded.uploaded_by, updated = excluded.updated, deleted = NULL, "
+                           "content_md5 = excluded.content_md5 WHERE blobs.updated < excluded.updated", writes)
+            db.executemany("DELETE FROM blobs WHERE name = ? AND updated < ?", stale)
+        return added, changed, len(stale)
+
+    # Record a blob written by the app, the etag is filled in by the next reconciliation
+    # content_md5 is the hex MD5 of the content, if it is known
+    def add(self, entry: BlobEntry, content_md5=None):
+        now = time.time()
+        with self.connection() as db:
+            db.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, NULL, ?, ?, NULL, ?)",
+                       (entry.name, entry.size, now, entry.uploaded_by, now, content_md5))
+
+    # Record the MD5 digest and size of a chunk the app staged for an upload, a chunk sent again replaces it
+    def add_chunk(self, blob_name, upload_id, chunk_index, size, md5):
+        with self.connection() as db:
+            db.execute("INSERT OR REPLACE INTO chunk_hashes VALUES (?, ?, ?, ?, ?, ?)",
+                       (blob_name, upload_id, chunk_index, size, md5, time.time()))
+
+    # Hash of an upload from the recorded hashes of its chunks, given the size of each staged chunk in order
+    # None if a chunk was not recorded or was recorded with another size than the block that was staged
+    def chunk_md5(self, blob_name, upload_id, sizes):
+        chunks = {row[0]: row[1:] for row in self.connection().execute(
+            "SELECT chunk_index, size, md5 FROM chunk_hashes WHERE blob = ? AND upload_id = ?", (blob_name, upload_id))}
+        if any(chunks.get(i, (None,))[0] != size for i, size in enumerate(sizes)):
+            return None
+        return chunked_md5(chunks[i][1] for i in range(len(sizes)))
+
+    def remove_chunks(self, blob_name, upload_id):
+        with self.connection() as db:
+            db.execute("DELETE FROM chunk_hashes WHERE blob = ? AND upload_id = ?", (blob_name, upload_id))
+
+    # Record a blob deleted by the app, it is kept as deleted until a listing started after the delete
+    def remove(self, name):
+        now = time.time()
+        with self.connection() as db:
+            db.execute("UPDATE blobs SET deleted = ?, updated = ? WHERE name = ?", (now, now, name))
+
+    # Blob entries under a path in name order
+    def entries(self, path):
+        query = "SELECT name, size, uploaded_by FROM blobs WHERE deleted IS NULL"
+        args = []
+        if path:
+            query += " AND name >= ? AND name < ?"
+            args += [path, prefix_end(path)]
+        return [BlobEntry(*row) for row in self.connection().execute(query + " ORDER BY name", args)]
+
+    # Names of the blobs uploaded by user with the given content hash and size, in name order
+    def find_content(self, content_md5, size, user):
+        return [row[0] for row in self.connection().execute(
+            "SELECT name FROM blobs WHERE content_md5 = ? AND size = ? AND uploaded_by = ? AND deleted IS NULL "
+            "ORDER BY name", (content_md5, size, user))]
+
+    # One page of blob entries under a prefix and the continuation token of the next page, or None
+    def page(self, prefix, continuation, page_size):
+        query = "SELECT name, size, uploaded_by FROM blobs WHERE deleted IS NULL AND name >= ?"
+        args = [prefix]
+        if prefix:
+            query += " AND name < ?"
+            args.append(prefix_end(prefix))
+        if continuation:
+            query += " AND name > ?"
+            args.append(continuation[len(INVENTORY_TOKEN_PREFIX):])
+        rows = self.connection().execute(query + " ORDER BY name LIMIT ?", args + [page_size + 1]).fetchall()
+        entries = [BlobEntry(*row) for row in rows[:page_size]]
+        if len(rows) > page_size:
+            return entries, INVENTORY_TOKEN_PREFIX + entries[-1].name
+        return entries, None
+
+
+# Lowercase upload user from the metadata of a listed blob
+def uploaded_by(blob):
+    metadata = getattr(blob, 'metadata', None) or {}
+    return metadata.get('uploaded_by', '').lower()
+
+
+# Hex MD5 of the file a listed blob holds, or None if it is not known
+# For a file uploaded in chunks this is the hash of its chunks kept in its metadata. For a compressed
+# blob it is the MD5 of the uncompressed file kept in its metadata.
+def blob_content_md5(blob):
+    metadata = getattr(blob, 'metadata', None) or {}
+    if CHUNK_MD5_KEY in metadata:
+        return metadata[CHUNK_MD5_KEY]
+    if is_compressed(blob):
+        return metadata.get(ORIGINAL_MD5_KEY)
+    settings = getattr(blob, 'content_settings', None)
+    if settings is None or not settings.content_md5:
+        return None
+    return bytes(settings.content_md5).hex()
+
+
+# Hex MD5 of the concatenated MD5 digests of the chunks of a file
+# Chunks are hashed as they pass through the app, so a file sent in chunks gets a hash without ever
+# being held or read back in one piece. The upload page computes the same hash for the chunk size it uses.
+def chunked_md5(digests):
+    return hashlib.md5(b"".join(digests)).hexdigest()
+
+
+# First string after every string starting with prefix
+def prefix_end(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def is_inventory_token(continuation):
+    return bool(continuation) and continuation.startswith(INVENTORY_TOKEN_PREFIX)
+
+
+# Create the inventory configured in the app config, or None if it is disabled
+def build_inventory(app_config):
+    if not app_config.get('INVENTORY_INDEX', False):
+        return None
+    path = app_config.get('INVENTORY_PATH', '/tmp/azstorage-inventory.db')
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    return Inventory(path, app_config.get('INVENTORY_RECONCILE_INTERVAL', 15 * 60))
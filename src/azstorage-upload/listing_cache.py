@@ -0,0 +1,257 @@
+from collections import OrderedDict
+from bisect import bisect_left
+import json
+import threading
+import time
+import logging
+
+from metrics import LISTING_CACHE_LOOKUPS
+
+logger = logging.getLogger('azure_storage_app')
+
+
+# Blob of a folder listing as kept by listings and the listing cache
+# Only the name, size in bytes and upload user are stored, in slots rather than a dict per blob.
+# The file name, folder and displayed size are derived when a row of the file table is built.
+class BlobEntry:
+
+    __slots__ = ('name', 'size', 'uploaded_by')
+
+    def __init__(self, name, size, uploaded_by):
+        self.name = name
+        self.size = size
+        self.uploaded_by = uploaded_by
+
+    @property
+    def filename(self):
+        return self.name[self.name.rfind("/") + 1:]
+
+    @property
+    def path(self):
+        index = self.name.rfind("/")
+        return self.name[:index] if index >= 0 else self.name
+
+    # Row of the file table, deletion is enabled if the blob was uploaded by user
+    def row(self, user):
+        # Convert size to KB
+        size = int(self.size / 1024)
+        if size == 0:
+            size = "<1"
+
+        return dict(filename=self.filename,
+                    path=self.path,
+                    name=self.name,
+                    size=size,
+                    uploaded_by=self.uploaded_by,
+                    delete_enabled=(self.uploaded_by == user))
+
+
+# Base class for caching folder listings keyed by the container path prefix
+# A cached listing holds the user independent blob entries and the folder list
+# returned by AzureStorage.list_tree. Backends implement _load, _store and _delete.
+class ListingCache:
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    # Returns a (blobs, folders) tuple or None if the prefix is not cached or has expired
+    # Hits and misses are counted by the azstorage_listing_cache_lookups_total metric
+    def get(self, prefix):
+        listing = self._load(prefix)
+        LISTING_CACHE_LOOKUPS.labels('miss' if listing is None else 'hit').inc()
+        return listing
+
+    def set(self, prefix, blobs, folders):
+        self._store(prefix, (blobs, folders))
+
+    def invalidate(self, prefix):
+        self._delete(prefix)
+
+    # Write-through hooks used after an upload or delete. Backends that cannot
+    # update an entry atomically simply drop it so the next listing is fresh.
+    def add_blob(self, prefix, entry, folders):
+        self.invalidate(prefix)
+
+    def remove_blob(self, prefix, name):
+        self.invalidate(prefix)
+
+    def _load(self, prefix):
+        raise NotImplementedError
+
+    def _store(self, prefix, listing):
+        raise NotImplementedError
+
+    def _delete(self, prefix):
+        raise NotImplementedError
+
+
+# Cache that never stores anything, used when caching is disabled
+class NullListingCache(ListingCache):
+
+    def _load(self, prefix):
+        return None
+
+    def _store(self, prefix, listing):
+        pass
+
+    def _delete(self, prefix):
+        pass
+
+
+# In-process cache with a TTL and least recently used eviction once max_entries is reached
+# Shared by all request threads of a worker, so every access is done under a lock
+class MemoryListingCache(ListingCache):
+
+    def __init__(self, ttl, max_entries):
+        super().__init__(ttl, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Readers get copies of the cached lists, as uploads and deletes update them in place
+    def _load(self, prefix):
+        with self._lock:
+            item = self._entries.get(prefix)
+            if item is None:
+                return None
+            expires, (blobs, folders) = item
+            if expires < time.monotonic():
+                del self._entries[prefix]
+                return None
+            self._entries.move_to_end(prefix)
+            return list(blobs), list(folders)
+
+    def _store(self, prefix, listing):
+        blobs, folders = listing
+        with self._lock:
+            self._entries[prefix] = (time.monotonic() + self.ttl, (list(blobs), list(folders)))
+            self._entries.move_to_end(prefix)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _delete(self, prefix):
+        with self._lock:
+            self._entries.pop(prefix, None)
+
+    # Cached blobs are kept in the order of a recursive walk, so a blob is inserted at its position
+    # found by binary search instead of copying the list
+    def add_blob(self, prefix, entry, folders):
+        with self._lock:
+            item = self._entries.get(prefix)
+            if item is None:
+                return
+            blobs, cached_folders = item[1]
+            index = bisect_left(_WalkKeys(blobs), walk_key(entry.name))
+            if index < len(blobs) and blobs[index].name == entry.name:
+                blobs[index] = entry
+            else:
+                blobs.insert(index, entry)
+            cached_folders += [folder for folder in folders if folder not in cached_folders]
+
+    def remove_blob(self, prefix, name):
+        with self._lock:
+            item = self._entries.get(prefix)
+            if item is None:
+                return
+            blobs = item[1][0]
+            index = bisect_left(_WalkKeys(blobs), walk_key(name))
+            if index < len(blobs) and blobs[index].name == name:
+                del blobs[index]
+
+
+# Sort key of a blob name in the order of a recursive walk of its folders: the blobs of a folder come
+# before its subfolders, and subfolders in the order the flat listing sorted by name first reaches them
+def walk_key(name):
+    parts = name.split("/")
+    return tuple((1, part + "/") for part in parts[:-1]) + ((0, parts[-1]),)
+
+
+# Walk keys of a list of blob entries, computed as bisect reads them
+class _WalkKeys:
+
+    __slots__ = ('blobs',)
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def __len__(self):
+        return len(self.blobs)
+
+    def __getitem__(self, index):
+        return walk_key(self.blobs[index].name)
+
+
+# Cache shared by all workers and pods through Redis
+# Entries expire with the Redis TTL and the oldest entries are evicted once more than
+# max_entries listings are stored, using a sorted set of keys scored by insert time
+class RedisListingCache(ListingCache):
+
+    def __init__(self, ttl, max_entries, url, namespace):
+        super().__init__(ttl, max_entries)
+        # Only required when the shared cache is configured
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.namespace = "azstorage:listing:" + namespace + ":"
+        self.index_key = self.namespace + "index"
+
+    def _load(self, prefix):
+        try:
+            value = self.redis.get(self.namespace + prefix)
+        except Exception as e:
+            logger.error(e)
+            return None
+        if value is None:
+            return None
+        listing = json.loads(value)
+        # Listings stored in an older format are treated as missing
+        if 'entries' not in listing:
+            return None
+        return [BlobEntry(*entry) for entry in listing['entries']], listing['folders']
+
+    def _store(self, prefix, listing):
+        blobs, folders = listing
+        key = self.namespace + prefix
+        try:
+            pipe = self.redis.pipeline()
+            # Blob entries are stored as [name, size, uploaded_by] lists
+            entries = [[blob.name, blob.size, blob.uploaded_by] for blob in blobs]
+            pipe.set(key, json.dumps(dict(entries=entries, folders=folders), separators=(',', ':')), ex=self.ttl)
+            pipe.zadd(self.index_key, {key: time.time()})
+            pipe.execute()
+
+            # Evict the oldest listings beyond the configured size
+            overflow = self.redis.zcard(self.index_key) - self.max_entries
+            if overflow > 0:
+                oldest = self.redis.zrange(self.index_key, 0, overflow - 1)
+                pipe = self.redis.pipeline()
+                pipe.delete(*oldest)
+                pipe.zrem(self.index_key, *oldest)
+                pipe.execute()
+        except Exception as e:
+            logger.error(e)
+
+    def _delete(self, prefix):
+        key = self.namespace + prefix
+        try:
+            pipe = self.redis.pipeline()
+            pipe.delete(key)
+            pipe.zrem(self.index_key, key)
+            pipe.execute()
+        except Exception as e:
+            logger.error(e)
+
+
+# Create the listing cache selected in the app config
+def build_listing_cache(app_config):
+    cache_type = app_config.get('LISTING_CACHE_TYPE', 'memory')
+    ttl = app_config.get('LISTING_CACHE_TTL', 60)
+    max_entries = app_config.get('LISTING_CACHE_MAX_ENTRIES', 32)
+
+    if cache_type == 'memory':
+        return MemoryListingCache(ttl, max_entries)
+    if cache_type == 'redis':
+        return RedisListingCache(ttl, max_entries, app_config['LISTING_CACHE_REDIS_URL'],
+                                 app_config['CONTAINER_NAME'])
+    if cache_type == 'none':
+        return NullListingCache(ttl, max_entries)
+    raise ValueError("Unknown LISTING_CACHE_TYPE: " + cache_type)
@@ -0,0 +1,76 @@
+from metrics import MEMORY_RESERVED
+from contextlib import contextmanager
+import threading
+import time
+
+
+# Raised when the memory for an upload or download was not released by other requests in time
+class MemoryBudgetExceeded(Exception):
+    pass
+
+
+# Bytes of file content a worker process may hold in memory at once, shared by all uploads and downloads
+# Each upload or download reserves the most memory it can hold before it starts and releases it once it is
+# done, waiting up to timeout seconds for other requests to release theirs. A reservation larger than the
+# budget is cut to the budget, so it runs once nothing else is reserved. A budget of 0 disables this.
+class MemoryBudget:
+
+    def __init__(self, size, timeout=30):
+        self.size = size
+        self.timeout = timeout
+        self.reserved = 0
+        self.condition = threading.Condition()
+
+    # Reserve size bytes and return the number of bytes reserved, which is what release must be given
+    def acquire(self, size):
+        if not self.size:
+            return 0
+        size = min(size, self.size)
+        deadline = time.monotonic() + self.timeout
+        with self.condition:
+            while self.reserved + size > self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise MemoryBudgetExceeded("No memory for " + str(size) + " bytes within " +
+                                               str(self.timeout) + " seconds")
+                self.condition.wait(remaining)
+            self.reserved += size
+        MEMORY_RESERVED.inc(size)
+        return size
+
+    def release(self, size):
+        if not size:
+            return
+        with self.condition:
+            self.reserved -= size
+            self.condition.notify_all()
+        MEMORY_RESERVED.dec(size)
+
+    @contextmanager
+    def reserve(self, size):
+        size = self.acquire(size)
+        try:
+            yield
+        finally:
+            self.release(size)
+
+
+# Response body that releases its reservation when it ends or is closed by the server, even if it was never started
+class ReservedBody:
+
+    def __init__(self, budget, body, size):
+        self.budget = budget
+        self.body = body
+        self.size = size
+
+    def __iter__(self):
+        try:
+            yield from self.body
+        finally:
+            self.close()
+
+    def close(self):
+        size, self.size = self.size, 0
+        self.budget.release(size)
+        if hasattr(self.body, 'close'):
+            self.body.close()
@@ -0,0 +1,70 @@
+from prometheus_client import Counter, Gauge, Histogram
+from contextlib import contextmanager
+import time
+
+# Prometheus metrics of the app
+# Under gunicorn every worker process writes its metrics to files in the directory set by the
+# prometheus_multiproc_dir environment variable, and the gunicorn master serves the totals of
+# all workers on its own port, see when_ready in gunicorn_config.py
+
+STORAGE_LATENCY = Histogram('azstorage_storage_request_seconds',
+                            'Latency of Azure Storage calls by operation and outcome',
+                            ['operation', 'outcome'])
+UPLOAD_BYTES = Counter('azstorage_upload_bytes_total', 'Bytes uploaded to Azure Storage through the app')
+UPLOAD_THROUGHPUT = Histogram('azstorage_upload_throughput_mbps', 'Throughput of uploads to Azure Storage in MB/s',
+                              buckets=(0.5, 1, 2, 5, 10, 20, 50, 100, 200, float('inf')))
+LISTING_BLOBS = Histogram('azstorage_listing_blobs', 'Number of blobs returned by a folder listing',
+                          buckets=(10, 100, 500, 1000, 5000, 10000, 50000, 100000, float('inf')))
+LISTING_FOLDERS = Histogram('azstorage_listing_folders', 'Number of folders found by a folder listing',
+                            buckets=(1, 10, 50, 100, 500, 1000, 5000, float('inf')))
+LISTING_CACHE_LOOKUPS = Counter('azstorage_listing_cache_lookups_total', 'Folder listing cache lookups by result',
+                                ['result'])
+VALIDATE_USER = Counter('azstorage_validate_user_total', 'Outcomes of user authorization checks', ['outcome'])
+STORAGE_RETRIES = Counter('azstorage_storage_retries_total', 'Retried Azure Storage requests by the status code or error '
+                          'of the failed attempt', ['reason'])
+STORAGE_FAST_FAILURES = Counter('azstorage_storage_fast_failures_total', 'Azure Storage requests failed without being '
+                                'sent or retried, because the circuit breaker was open or the deadline would pass',
+                                ['reason'])
+STORAGE_CIRCUIT_STATE = Gauge('azstorage_storage_circuit_state', 'State of the storage circuit breaker of each worker, '
+                              '0 closed, 1 half open and 2 open', multiprocess_mode='liveall')
+REQUESTS_IN_FLIGHT = Gauge('azstorage_requests_in_flight', 'Requests being handled', multiprocess_mode='livesum')
+STORAGE_READY = Gauge('azstorage_storage_ready', 'Whether the storage clients of each worker are warmed up',
+                      multiprocess_mode='liveall')
+MEMORY_RESERVED = Gauge('azstorage_memory_reserved_bytes', 'Memory reserved by uploads and downloads of each worker, '
+                        'see MEMORY_BUDGET', multiprocess_mode='liveall')
+
+
+# Time a storage call, labelled with the name of the exception if it fails
+@contextmanager
+def track_storage(operation):
+    start = time.perf_counter()
+    outcome = 'success'
+    try:
+        yield
+    except Exception as e:
+        outcome = type(e).__name__
+        raise
+    finally:
+        STORAGE_LATENCY.labels(operation, outcome).observe(time.perf_counter() - start)
+
+
+# Iterate over the items of a storage iterable, such as the pages of a listing or the chunks of a download,
+# timing only the storage call that gets each item and not the work done with it in between
+def track_storage_items(operation, items):
+    items = iter(items)
+    while True:
+        with track_storage(operation):
+            item = next(items, None)
+        if item is None:
+            return
+        yield item
+
+
+def record_upload(size, elapsed_time):
+    UPLOAD_BYTES.inc(size)
+    UPLOAD_THROUGHPUT.observe(size / 1048576 / max(elapsed_time, 0.001))
+
+
+def record_listing(blob_count, folder_count):
+    LISTING_BLOBS.observe(blob_count)
+    LISTING_FOLDERS.observe(folder_count)
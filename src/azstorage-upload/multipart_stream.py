@@ -0,0 +1,191 @@
+from werkzeug.http import parse_options_header
+
+# Largest part header and form field value accepted, anything bigger is rejected
+MAX_HEADER_SIZE = 16 * 1024
+MAX_FIELD_SIZE = 64 * 1024
+
+
+# Incremental parser for multipart/form-data request bodies
+# Reads the body in fixed size buffers so memory use does not depend on the size of the
+# uploaded file, and nothing is spooled to local disk the way request.files does.
+# Form fields must come before the file part, which is how Dropzone sends them.
+class MultipartStream:
+
+    def __init__(self, stream, boundary, buffer_size=64 * 1024):
+        self.stream = stream
+        self.fields = {}
+        self.buffer_size = buffer_size
+        self.delimiter = b"\r\n--" + boundary
+        # Pretend the body starts with a line break so the first boundary matches the delimiter
+        self.buffer = bytearray(b"\r\n")
+        # No delimiter starts before this offset of the buffer, so each byte is only searched once
+        self.scanned = 0
+        self.eof = False
+        self.part_done = True
+
+    # Parse the form fields up to the first file part
+    # Returns a dict of the fields and the file part, or None if the body contains no file
+    def parse(self):
+        return next(self.files(), (self.fields, None))
+
+    # Yield every file part of the body in order along with the form fields sent before it
+    # A file part that has not been read to its end when the next one is requested is skipped
+    def files(self):
+        self.skip_preamble()
+        while self.next_part():
+            headers = self.read_headers()
+            disposition, options = parse_options_header(headers.get('content-disposition', ''))
+            if disposition != 'form-data' or 'name' not in options:
+                raise ValueError("Invalid multipart part")
+            if 'filename' in options:
+                yield self.fields, FilePart(self, options['name'], options['filename'], headers.get('content-type'))
+                while self.read(self.buffer_size):
+                    pass
+                continue
+
+            value = self.read_part(MAX_FIELD_SIZE)
+            self.fields[options['name']] = value.decode('utf-8')
+
+    # Discard everything up to the first boundary
+    def skip_preamble(self):
+        self.part_done = False
+        while self.read(self.buffer_size):
+            pass
+
+    # Move past the delimiter of the part just read
+    # Returns False once the closing delimiter of the body has been reached
+    def next_part(self):
+        while len(self.buffer) < 2 and self.fill():
+            pass
+        if self.buffer[:2] == b"--":
+            return False
+        if self.buffer[:2] != b"\r\n":
+            raise ValueError("Invalid multipart boundary")
+        self.discard(2)
+        self.part_done = False
+        return True
+
+    def read_headers(self):
+        while True:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end != -1:
+                break
+            if len(self.buffer) > MAX_HEADER_SIZE or not self.fill():
+                raise ValueError("Invalid multipart headers")
+
+        headers = {}
+        for line in bytes(self.buffer[:end]).decode('utf-8').split("\r\n"):
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        self.discard(end + 4)
+        return headers
+
+    # Read a whole part, failing if it is larger than max_size
+    def read_part(self, max_size):
+        value = bytearray()
+        while True:
+            data = self.read(self.buffer_size)
+            if not data:
+                return bytes(value)
+            value += data
+            if len(value) > max_size:
+                raise ValueError("Multipart field too large")
+
+    # Read up to size bytes of the current part, returns b"" at the end of the part
+    def read(self, size):
+        while not self.part_done:
+            end = self.find_delimiter()
+            if end == 0:
+                self.discard(len(self.delimiter))
+                self.part_done = True
+                break
+            if end > 0:
+                return self.take(min(end, size))
+
+            # Keep enough bytes back to match a delimiter split across two reads
+            safe = len(self.buffer) - len(self.delimiter) + 1
+            if safe >= size or (safe > 0 and self.eof):
+                return self.take(min(safe, size))
+            if not self.fill():
+                raise ValueError("Unexpected end of multipart body")
+        return b""
+
+    # Position of the next delimiter in the buffer or -1, searching only the bytes not searched before
+    # and the last bytes before them, which may hold the start of a delimiter split across two reads
+    def find_delimiter(self):
+        end = self.buffer.find(self.delimiter, self.scanned)
+        if end == -1:
+            self.scanned = max(len(self.buffer) - len(self.delimiter) + 1, 0)
+        else:
+            self.scanned = end
+        return end
+
+    def take(self, size):
+        data = bytes(self.buffer[:size])
+        self.discard(size)
+        return data
+
+    def discard(self, size):
+        del self.buffer[:size]
+        self.scanned = max(self.scanned - size, 0)
+
+    def fill(self):
+        if self.eof:
+            return False
+        data = self.stream.read(self.buffer_size)
+        if not data:
+            self.eof = True
+            return False
+        self.buffer += data
+        return True
+
+
+# File part of a multipart body, read straight from the request stream
+# Provides the filename attribute and read method used for uploads in place of a FileStorage object
+class FilePart:
+
+    def __init__(self, multipart, name, filename, content_type):
+        self.multipart = multipart
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.bytes_read = 0
+
+    # Read up to size bytes, or the rest of the file if size is negative
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = bytearray()
+            while True:
+                chunk = self.multipart.read(self.multipart.buffer_size)
+                if not chunk:
+                    break
+                data += chunk
+            data = bytes(data)
+        else:
+            data = self.multipart.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    # Used by the chunked upload path, which passes the stream of the file straight to the block upload
+    @property
+    def stream(self):
+        return self
+
+
+# Start parsing a multipart/form-data request without reading the file into memory or to disk
+# Returns the form fields sent before the file and the file part, raises ValueError for invalid bodies
+def parse_upload_request(request, buffer_size=64 * 1024):
+    return upload_multipart(request, buffer_size).parse()
+
+
+# Iterate over the files of a multipart/form-data request with several files, see MultipartStream.files
+# Raises ValueError for invalid bodies, either when called or while iterating
+def iter_upload_files(request, buffer_size=64 * 1024):
+    return upload_multipart(request, buffer_size).files()
+
+
+def upload_multipart(request, buffer_size):
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype != 'multipart/form-data' or not options.get('boundary'):
+        raise ValueError("Upload must be sent as multipart/form-data")
+    return MultipartStream(request.stream, options['boundary'].encode('latin-1'), buffer_size)
@@ -0,0 +1,212 @@
+from flask.sessions import SessionInterface, SessionMixin, session_json_serializer
+from flask_session import Session
+from werkzeug.datastructures import CallbackDict
+import json
+import secrets
+import threading
+import time
+import logging
+
+logger = logging.getLogger('azure_storage_app')
+
+# MSAL token cache sections needed to acquire tokens silently, the id token is dropped since its
+# claims are already kept in the session and app metadata is only an optimization for app families
+TOKEN_CACHE_SECTIONS = ('Account', 'AccessToken', 'RefreshToken')
+# Requests to these paths never use the session, so they neither load it nor extend its expiry
+SESSIONLESS_PATHS = ('/healthz', '/readyz', '/assets/', '/static/')
+# Seconds between expiry extensions of an unchanged session by a worker
+TOUCH_INTERVAL = 60
+# Seconds to wait for Redis to connect or respond before a session request is given up
+REDIS_TIMEOUT = 2
+
+
+# Server side session, the cookie only holds the random session id
+class StoreSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+# Base class for keeping sessions in a key-value store with a TTL
+# Sessions are serialized with Flask's tagged JSON and expire once they have not been used for ttl
+# seconds. The expiry of an unchanged session is extended at most once every touch_interval seconds
+# by each worker. Backends implement _load, _store, _touch and _delete, and list the errors raised
+# while the store can't be reached in unavailable_errors. Requests then continue with an empty session.
+class SessionStore(SessionInterface):
+
+    serializer = session_json_serializer
+    session_class = StoreSession
+    unavailable_errors = ()
+
+    def __init__(self, ttl, touch_interval=TOUCH_INTERVAL):
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self._touched = {}
+        self._touched_lock = threading.Lock()
+        self._next_touch_sweep = time.monotonic() + touch_interval
+
+    def open_session(self, app, request):
+        if request.path.startswith(SESSIONLESS_PATHS):
+            return self.make_null_session(app)
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            try:
+                value = self._load(sid)
+            except self.unavailable_errors as e:
+                # The session id is kept, so the session is found again once the store is back
+                logger.warning("Session store unavailable, continuing without the session: " + str(e))
+                return self.session_class(sid=sid, new=True)
+            if value is not None:
+                try:
+                    return self.session_class(self.serializer.loads(value), sid=sid)
+                except ValueError as e:
+                    logger.warning("Discarding unreadable session: " + str(e))
+        return self.session_class(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:
+                try:
+                    self._delete(session.sid)
+                except self.unavailable_errors as e:
+                    logger.warning("Session store unavailable, the session was not deleted: " + str(e))
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+
+        # Unchanged sessions only have their expiry extended
+        try:
+            if session.modified:
+                self._store(session.sid, self.serializer.dumps(dict(session)))
+            elif self.claim_touch(session.sid):
+                self._touch(session.sid)
+        except self.unavailable_errors as e:
+            logger.warning("Session store unavailable, the session was not saved: " + str(e))
+        if session.new or session.modified or session.permanent:
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+    # True if the session was not touched by this worker within the last touch_interval seconds
+    # Sessions touched longer ago than that are forgotten by a sweep at most once every touch_interval
+    def claim_touch(self, sid):
+        now = time.monotonic()
+        with self._touched_lock:
+            if now >= self._next_touch_sweep:
+                self._touched = {key: touched for key, touched in self._touched.items()
+                                 if now - touched < self.touch_interval}
+                self._next_touch_sweep = now + self.touch_interval
+            if now - self._touched.get(sid, now - self.touch_interval) < self.touch_interval:
+                return False
+            self._touched[sid] = now
+            return True
+
+    def _load(self, sid):
+        raise NotImplementedError
+
+    def _store(self, sid, value):
+        raise NotImplementedError
+
+    def _touch(self, sid):
+        raise NotImplementedError
+
+    def _delete(self, sid):
+        raise NotImplementedError
+
+
+# Sessions kept in the memory of the worker process, for tests and single process runs
+# Expired sessions are removed by a sweep at most once every sweep_interval seconds
+class MemorySessionStore(SessionStore):
+
+    def __init__(self, ttl, sweep_interval=60):
+        super().__init__(ttl)
+        self.sweep_interval = sweep_interval
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def _load(self, sid):
+        with self._lock:
+            item = self._sessions.get(sid)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._sessions[sid]
+                return None
+            return value
+
+    def _store(self, sid, value):
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[sid] = (now + self.ttl, value)
+            if now >= self._next_sweep:
+                self._sessions = {key: item for key, item in self._sessions.items() if item[0] >= now}
+                self._next_sweep = now + self.sweep_interval
+
+    def _touch(self, sid):
+        with self._lock:
+            item = self._sessions.get(sid)
+            if item is not None:
+                self._sessions[sid] = (time.monotonic() + self.ttl, item[1])
+
+    def _delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+
+# Sessions shared by all workers and pods through Redis, which expires them with its own TTL
+# Requests wait at most REDIS_TIMEOUT seconds for Redis, so an outage logs users out instead of hanging requests
+class RedisSessionStore(SessionStore):
+
+    def __init__(self, ttl, url, namespace):
+        super().__init__(ttl)
+        # Only required when the shared session store is configured
+        import redis
+        self.redis = redis.Redis.from_url(url, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT)
+        self.unavailable_errors = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+        self.namespace = "azstorage:session:" + namespace + ":"
+
+    def _load(self, sid):
+        return self.redis.get(self.namespace + sid)
+
+    def _store(self, sid, value):
+        self.redis.set(self.namespace + sid, value, ex=self.ttl)
+
+    def _touch(self, sid):
+        self.redis.expire(self.namespace + sid, self.ttl)
+
+    def _delete(self, sid):
+        self.redis.delete(self.namespace + sid)
+
+
+# Keep only the token cache sections needed for silent token requests, serialized without whitespace
+def compact_token_cache(serialized):
+    cache = json.loads(serialized)
+    return json.dumps({section: cache[section] for section in TOKEN_CACHE_SECTIONS if cache.get(section)},
+                      separators=(',', ':'))
+
+
+# Set up the session store selected in the app config
+# "filesystem" keeps the Flask-Session store on the local disk of the pod
+def init_session(app):
+    store_type = app.config.get('SESSION_STORE', 'filesystem')
+    ttl = int(app.permanent_session_lifetime.total_seconds())
+
+    if store_type == 'filesystem':
+        Session(app)
+    elif store_type == 'redis':
+        app.session_interface = RedisSessionStore(ttl, app.config['SESSION_REDIS_URL'], app.config['CONTAINER_NAME'])
+    elif store_type == 'memory':
+        app.session_interface = MemorySessionStore(ttl)
+    else:
+        raise ValueError("Unknown SESSION_STORE: " + store_type)
@@ -0,0 +1,121 @@
+// Incremental MD5 of byte arrays, used by the upload page to hash large files chunk by chunk
+// before they are sent. Web Crypto has no MD5, which is the hash the app keeps for uploaded files.
+(function(global) {
+  var S = [7, 12, 17, 22, 7, 12, 17, 22, 7, 12, 17, 22, 7, 12, 17, 22,
+           5, 9, 14, 20, 5, 9, 14, 20, 5, 9, 14, 20, 5, 9, 14, 20,
+           4, 11, 16, 23, 4, 11, 16, 23, 4, 11, 16, 23, 4, 11, 16, 23,
+           6, 10, 15, 21, 6, 10, 15, 21, 6, 10, 15, 21, 6, 10, 15, 21];
+  var K = new Int32Array(64);
+  for (var i = 0; i < 64; i++) {
+    K[i] = Math.floor(Math.abs(Math.sin(i + 1)) * 4294967296) | 0;
+  }
+
+  function MD5() {
+    this.state = new Int32Array([0x67452301, 0xefcdab89 | 0, 0x98badcfe | 0, 0x10325476]);
+    this.buffer = new Uint8Array(64);
+    this.buffered = 0;
+    this.length = 0;
+    this.words = new Int32Array(16);
+  }
+
+  // Process one 64 byte block starting at offset
+  MD5.prototype.block = function(bytes, offset) {
+    var x = this.words;
+    for (var j = 0; j < 16; j++) {
+      var o = offset + j * 4;
+      x[j] = bytes[o] | (bytes[o + 1] << 8) | (bytes[o + 2] << 16) | (bytes[o + 3] << 24);
+    }
+    var a = this.state[0], b = this.state[1], c = this.state[2], d = this.state[3];
+    for (var i = 0; i < 64; i++) {
+      var f, g;
+      if (i < 16) {
+        f = (b & c) | (~b & d);
+        g = i;
+      } else if (i < 32) {
+        f = (d & b) | (~d & c);
+        g = (5 * i + 1) & 15;
+      } else if (i < 48) {
+        f = b ^ c ^ d;
+        g = (3 * i + 5) & 15;
+      } else {
+        f = c ^ (b | ~d);
+        g = (7 * i) & 15;
+      }
+      var t = d;
+      d = c;
+      c = b;
+      var sum = (a + f + K[i] + x[g]) | 0;
+      b = (b + ((sum << S[i]) | (sum >>> (32 - S[i])))) | 0;
+      a = t;
+    }
+    this.state[0] = (this.state[0] + a) | 0;
+    this.state[1] = (this.state[1] + b) | 0;
+    this.state[2] = (this.state[2] + c) | 0;
+    this.state[3] = (this.state[3] + d) | 0;
+  };
+
+  MD5.prototype.update = function(bytes) {
+    var offset = 0;
+    this.length += bytes.length;
+    if (this.buffered) {
+      offset = Math.min(64 - this.buffered, bytes.length);
+      this.buffer.set(bytes.subarray(0, offset), this.buffered);
+      this.buffered += offset;
+      if (this.buffered < 64) {
+        return this;
+      }
+      this.block(this.buffer, 0);
+      this.buffered = 0;
+    }
+    for (; offset + 64 <= bytes.length; offset += 64) {
+      this.block(bytes, offset);
+    }
+    this.buffer.set(bytes.subarray(offset), 0);
+    this.buffered = bytes.length - offset;
+    return this;
+  };
+
+  // Finish the hash and return it as 16 bytes
+  MD5.prototype.digest = function() {
+    var bits = this.length * 8;
+    var padding = new Uint8Array((this.buffered < 56 ? 56 : 120) - this.buffered + 8);
+    padding[0] = 0x80;
+    for (var i = 0; i < 8; i++) {
+      padding[padding.length - 8 + i] = Math.floor(bits / Math.pow(2, 8 * i)) & 0xff;
+    }
+    this.update(padding);
+    var bytes = new Uint8Array(16);
+    for (var j = 0; j < 16; j++) {
+      bytes[j] = (this.state[j >> 2] >>> ((j & 3) * 8)) & 0xff;
+    }
+    return bytes;
+  };
+
+  // Finish the hash and return it as lowercase hex
+  MD5.prototype.hex = function() {
+    var bytes = this.digest();
+    var hex = "";
+    for (var j = 0; j < 16; j++) {
+      hex += ("0" + bytes[j].toString(16)).slice(-2);
+    }
+    return hex;
+  };
+
+  // Hash a File or Blob as the app hashes a file uploaded in chunks of chunkSize: the hex MD5
+  // of the MD5 digests of the chunks, which the app records as each chunk passes through
+  MD5.chunks = function(file, chunkSize) {
+    var hash = new MD5();
+    var read = function(offset) {
+      if (offset >= file.size) {
+        return Promise.resolve(hash.hex());
+      }
+      return file.slice(offset, offset + chunkSize).arrayBuffer().then(function(buffer) {
+        hash.update(new MD5().update(new Uint8Array(buffer)).digest());
+        return read(offset + chunkSize);
+      });
+    };
+    return read(0);
+  };
+
+  global.MD5 = MD5;
+})(window);
@@ -0,0 +1,172 @@
+from azure.storage.blob import ExponentialRetry
+from metrics import STORAGE_RETRIES, STORAGE_FAST_FAILURES, STORAGE_CIRCUIT_STATE
+from urllib.parse import urlsplit
+import random
+import threading
+import time
+import logging
+
+logger = logging.getLogger('azure_storage_app')
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+# Value of the circuit state gauge for each state
+CIRCUIT_STATE_VALUES = {CIRCUIT_CLOSED: 0, CIRCUIT_HALF_OPEN: 1, CIRCUIT_OPEN: 2}
+
+
+# Raised instead of sending a storage request that can't succeed in time, either because the circuit
+# breaker is open or because the request deadline would pass before the next retry
+class StorageUnavailableError(Exception):
+    pass
+
+
+# Circuit breaker for the requests of a worker to the storage account
+# After failure_threshold failed attempts in a row, such as ServerBusy and OperationTimedOut responses
+# of a throttling account, the circuit opens and requests fail at once for reset_timeout seconds.
+# Then one trial request is let through, its success closes the circuit and its failure opens it again.
+# A failure_threshold of 0 disables the breaker.
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=10, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+        STORAGE_CIRCUIT_STATE.set(CIRCUIT_STATE_VALUES[self.state])
+
+    # True if a request may be sent now
+    def allow(self):
+        if self.failure_threshold <= 0:
+            return True
+        with self.lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            # In the half open state the trial request is running, it gets reset_timeout seconds as well
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.opened_at = time.monotonic()
+            self._set_state(CIRCUIT_HALF_OPEN)
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state != CIRCUIT_CLOSED:
+                self._set_state(CIRCUIT_CLOSED)
+
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self.lock:
+            self.failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or (self.state == CIRCUIT_CLOSED and
+                                                   self.failures >= self.failure_threshold):
+                self.opened_at = time.monotonic()
+                self._set_state(CIRCUIT_OPEN)
+
+    def _set_state(self, state):
+        if state == CIRCUIT_OPEN:
+            logger.warning("Storage circuit breaker opened after " + str(self.failures) + " failed requests, "
+                           "failing storage requests for " + str(self.reset_timeout) + " seconds")
+        else:
+            logger.info("Storage circuit breaker " + state.replace("_", " "))
+        self.state = state
+        STORAGE_CIRCUIT_STATE.set(CIRCUIT_STATE_VALUES[state])
+
+
+# Retry policy of the storage clients
+# Failed attempts are retried up to retry_total times after a random wait of up to initial_backoff
+# doubled for each retry and at most max_backoff seconds, so retries of many requests spread out.
+# A request is not retried if the wait would end past its deadline of deadline seconds, nor while
+# the circuit breaker is open. connection_timeout and read_timeout bound each attempt, including the first,
+# and are shortened to the time left before the deadline.
+class StorageRetry(ExponentialRetry):
+
+    def __init__(self, circuit_breaker, retry_total=3, initial_backoff=0.5, max_backoff=8, deadline=30,
+                 connection_timeout=10, read_timeout=30, **kwargs):
+        super().__init__(initial_backoff=initial_backoff, retry_total=retry_total, random_jitter_range=0, **kwargs)
+        self.circuit_breaker = circuit_breaker
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.connection_timeout = connection_timeout
+        self.read_timeout = read_timeout
+
+    def configure_retries(self, request):
+        settings = super().configure_retries(request)
+        settings['deadline'] = time.monotonic() + self.deadline
+        settings['request'] = request.http_request
+        settings['options'] = request.context.options
+        # Timeouts given for this request, if any, before they are shortened
+        options = settings['options']
+        settings['timeouts'] = dict(connection_timeout=options.get('connection_timeout', self.connection_timeout),
+                                    read_timeout=options.get('read_timeout', self.read_timeout))
+        self.limit_timeouts(settings, self.deadline)
+        return settings
+
+    # Shorten the timeouts of the next attempt so it does not wait past the deadline, remaining seconds away
+    def limit_timeouts(self, settings, remaining):
+        for key, timeout in settings['timeouts'].items():
+            settings['options'][key] = max(min(timeout, remaining), 1)
+
+    def get_backoff_time(self, settings):
+        return random.uniform(0, min(self.max_backoff, self.initial_backoff * 2 ** (settings['count'] - 1)))
+
+    # Called for every failed attempt, including the last one
+    def increment(self, settings, request, response=None, error=None):
+        self.circuit_breaker.record_failure()
+        # Errors the base policy does not know are not added to the history
+        settings['error'] = error
+        return super().increment(settings, request, response=response, error=error)
+
+    def check_circuit(self):
+        if not self.circuit_breaker.allow():
+            STORAGE_FAST_FAILURES.labels('circuit_open').inc()
+            raise StorageUnavailableError("Storage circuit breaker is open, not sending request")
+
+    # Wait before the next retry, raises StorageUnavailableError if it would end past the deadline
+    def next_backoff(self, settings):
+        backoff = self.get_backoff_time(settings)
+        remaining = settings['deadline'] - time.monotonic()
+        history = settings['history']
+        if history and history[-1].http_response is not None:
+            reason = str(history[-1].http_response.status_code)
+        else:
+            reason = type(history[-1].error if history else settings.get('error')).__name__
+        http_request = history[-1].http_request if history else settings['request']
+        request = http_request.method + " " + urlsplit(http_request.url).path
+
+        if backoff >= remaining:
+            STORAGE_FAST_FAILURES.labels('deadline').inc()
+            raise StorageUnavailableError("Storage request " + request + " failed with " + reason +
+                                          " and its deadline passes before it can be retried")
+        self.limit_timeouts(settings, remaining - backoff)
+        STORAGE_RETRIES.labels(reason).inc()
+        logger.warning("Retrying storage request " + request + " after " + reason + " in " + str(round(backoff, 2)) +
+                       " seconds (retry " + str(settings['count']) + ")")
+        return backoff
+
+    def sleep(self, settings, transport):
+        transport.sleep(self.next_backoff(settings))
+        self.check_circuit()
+
+    def send(self, request):
+        self.check_circuit()
+        response = super().send(request)
+        # Responses that are not retried tell the account is serving requests
+        status = response.http_response.status_code
+        if status < 500 and status != 408:
+            self.circuit_breaker.record_success()
+        return response
+
+
+# Retry policy settings of the app config, passed as keyword arguments to the policy
+def retry_settings(app_config):
+    return dict(retry_total=app_config.get('STORAGE_RETRY_TOTAL', 3),
+                initial_backoff=app_config.get('STORAGE_RETRY_BACKOFF', 0.5),
+                max_backoff=app_config.get('STORAGE_RETRY_MAX_BACKOFF', 8),
+                deadline=app_config.get('STORAGE_REQUEST_DEADLINE', 30),
+                connection_timeout=app_config.get('STORAGE_CONNECTION_TIMEOUT', 10),
+                read_timeout=app_config.get('STORAGE_READ_TIMEOUT', 30))
@@ -0,0 +1,40 @@
+import zipfile
+
+
+# Output of a ZIP archive that is collected in memory until it is sent instead of written to a file
+# zipfile writes a data descriptor after each entry when the output cannot seek, so entries
+# can be sent as they are written without a temp file or knowing the archive size up front
+class _ZipSink:
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        parts, self.parts = self.parts, []
+        return parts
+
+
+# Build a ZIP archive while it is sent, yielding the archive in pieces
+# entries is an iterable of (name, size, last_modified, chunks) with the content of each entry
+# given as an iterable of bytes, so only the chunk being written is held in memory. Entries are
+# stored without compression, which keeps the cost of building the archive at copying the data.
+def iter_zip(entries):
+    sink = _ZipSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+        for name, size, last_modified, chunks in entries:
+            info = zipfile.ZipInfo(name, date_time=last_modified.timetuple()[:6])
+            # The expected size decides whether the entry needs ZIP64 headers
+            info.file_size = size
+            with archive.open(info, 'w') as entry:
+                for chunk in chunks:
+                    entry.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
@@ -0,0 +1,382 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, parse_qsl, unquote
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from email.utils import formatdate
+from collections import Counter
+import base64
+import hashlib
+import itertools
+import random
+import re
+import threading
+import time
+
+# Name and key of the storage account served, the same as the Azurite emulator so the
+# account key credential of the storage SDK signs requests without any extra setup
+ACCOUNT_NAME = "devstoreaccount1"
+ACCOUNT_KEY = "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
+
+
+# In-memory stand-in for the parts of the Blob REST API used by AzureStorage
+# Supports Get Container Properties, List Blobs with prefix, marker, maxresults, metadata and tags, Get Blob Properties,
+# Get Blob with a range, Put Blob, Put Block, Put Block List, Get Block List of uncommitted blocks, Copy Blob within the account, Delete Blob,
+# Set Blob Metadata, Set Blob Properties, Set Blob Tags and
+# Find Blobs by Tags with equality conditions joined by AND, with If-None-Match and If-Match conditions.
+# Content-MD5 is kept like the service does: computed for Put Blob and taken from the request otherwise.
+# Content-Encoding is stored as sent, and the rsce parameter of a SAS overrides it in downloads. Every request waits latency seconds before it is answered to simulate the
+# round trip to a storage account, and requests are counted by operation in counts. A busy_rate fraction of the
+# requests, picked at random, is answered with 503 ServerBusy like a throttling account.
+class FakeBlobService(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, host="127.0.0.1", port=0, busy_rate=0.0):
+        super().__init__((host, port), _BlobRequestHandler)
+        self.latency = latency
+        self.busy_rate = busy_rate
+        self.random = random.Random(0)
+        self.containers = {}
+        self.counts = Counter()
+        self.staged_blocks = {}
+        self.lock = threading.Lock()
+        self._etags = itertools.count(1)
+        self._thread = None
+
+    @property
+    def account_url(self):
+        return "http://%s:%d/%s" % (self.server_address[0], self.server_address[1], ACCOUNT_NAME)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-blob-service", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # Add blobs without going through the API, for setting up listings
+    def seed(self, container, names, size=0, metadata=None, tags=None):
+        content = b"\0" * size
+        with self.lock:
+            blobs = self.containers.setdefault(container, {})
+            for name in names:
+                blobs[name] = self.new_blob(content, dict(metadata or {}), dict(tags or {}))
+
+    def clear(self):
+        with self.lock:
+            self.containers.clear()
+            self.staged_blocks.clear()
+
+    def new_blob(self, content, metadata, tags=None, content_md5=None):
+        return dict(content=content, metadata=metadata, tags=tags or {}, content_md5=content_md5, content_encoding=None,
+                    etag='"0x8D8%013X"' % next(self._etags),
+                    last_modified=formatdate(usegmt=True))
+
+    def reset_counts(self):
+        with self.lock:
+            counts = dict(self.counts)
+            self.counts.clear()
+        return counts
+
+
+class _BlobRequestHandler(BaseHTTPRequestHandler):
+
+    # Keep connections open between requests like the storage service does
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        # Path style URL of an emulator: /<account>/<container>/<blob name>
+        parts = unquote(url.path).lstrip("/").split("/", 2)
+        container = parts[1] if len(parts) > 1 else ""
+        blob_name = parts[2] if len(parts) > 2 else ""
+
+        time.sleep(self.server.latency)
+        server = self.server
+        with server.lock:
+            if server.busy_rate and server.random.random() < server.busy_rate:
+                self.count("server_busy")
+                return self.error(503, "ServerBusy")
+            if not container:
+                if method == "GET" and query.get('comp') == "blobs":
+                    self.count("find_by_tags")
+                    return self.find_blobs(query)
+                self.count("unsupported")
+                return self.error(400, "UnsupportedOperation")
+
+            blobs = server.containers.setdefault(container, {})
+            if not blob_name:
+                if method == "GET" and query.get('comp') == "list":
+                    self.count("list")
+                    return self.list_blobs(container, blobs, query)
+                if method in ("GET", "HEAD") and query.get('restype') == "container" and 'comp' not in query:
+                    self.count("get_container_properties")
+                    return self.send(200, {'ETag': '"0x1"', 'Last-Modified': formatdate(usegmt=True)},
+                                     head=method == "HEAD")
+                self.count("unsupported")
+                return self.error(400, "UnsupportedOperation")
+
+            blob = blobs.get(blob_name)
+            if method == "HEAD":
+                self.count("get_properties")
+                if blob is None:
+                    return self.error(404, "BlobNotFound")
+                failed = self.condition_failed(blob)
+                if failed:
+                    return self.error(*failed)
+                return self.send(200, blob_headers(blob, content_length=len(blob['content'])), b"", head=True)
+            if method == "GET" and 'comp' not in query:
+                self.count("download")
+                if blob is None:
+                    return self.error(404, "BlobNotFound")
+                failed = self.condition_failed(blob)
+                if failed:
+                    return self.error(*failed)
+                return self.download(blob, query)
+            if method == "DELETE":
+                self.count("delete")
+                if blob is None:
+                    return self.error(404, "BlobNotFound")
+                failed = self.condition_failed(blob)
+                if failed:
+                    return self.error(*failed)
+                del blobs[blob_name]
+                return self.send(202, {})
+            if method == "PUT" and query.get('comp') == "tags":
+                self.count("set_tags")
+                if blob is None:
+                    return self.error(404, "BlobNotFound")
+                blob['tags'] = parse_tags(ElementTree.fromstring(body))
+                return self.send(204, {})
+            if method == "PUT" and query.get('comp') in ("metadata", "properties"):
+                self.count("set_" + query['comp'])
+                if blob is None:
+                    return self.error(404, "BlobNotFound")
+                failed = self.condition_failed(blob)
+                if failed:
+                    return self.error(*failed)
+                if query['comp'] == "metadata":
+                    blob['metadata'] = {key[len("x-ms-meta-"):].lower(): value for key, value in self.headers.items()
+                                        if key.lower().startswith("x-ms-meta-")}
+                else:
+                    blob['content_md5'] = self.headers.get('x-ms-blob-content-md5')
+                    blob['content_encoding'] = self.headers.get('x-ms-blob-content-encoding')
+                blob['etag'] = self.server.new_blob(b"", {})['etag']
+                blob['last_modified'] = formatdate(usegmt=True)
+                return self.send(200, {'ETag': blob['etag'], 'Last-Modified': blob['last_modified']})
+            if method == "PUT" and query.get('comp') == "block":
+                self.count("put_block")
+                server.staged_blocks[(container, blob_name, query['blockid'])] = body
+                return self.send(201, {})
+            if method == "GET" and query.get('comp') == "blocklist":
+                self.count("get_block_list")
+                staged = [(block_id, data) for (block_container, block_blob, block_id), data
+                          in sorted(server.staged_blocks.items()) if (block_container, block_blob) == (container, blob_name)]
+                if blob is None and not staged:
+                    return self.error(404, "BlobNotFound")
+                xml = ('<?xml version="1.0" encoding="utf-8"?><BlockList><CommittedBlocks /><UncommittedBlocks>' +
+                       "".join('<Block><Name>%s</Name><Size>%d</Size></Block>' % (escape(block_id), len(data))
+                               for block_id, data in staged) + '</UncommittedBlocks></BlockList>')
+                return self.send(200, {'Content-Type': "application/xml"}, xml.encode())
+            if method == "PUT" and query.get('comp') == "blocklist":
+                self.count("put_block_list")
+                failed = self.condition_failed(blob)
+                if failed:
+                    return self.error(*failed)
+                block_ids = [element.text for element in ElementTree.fromstring(body)]
+                try:
+                    content = b"".join(server.staged_blocks.pop((container, blob_name, block_id))
+                                       for block_id in block_ids)
+                except KeyError:
+                    return self.error(400, "InvalidBlockList")
+                return self.create(blobs, blob_name, content)
+            if method == "PUT" and 'comp' not in query and 'x-ms-copy-source' in self.headers:
+                self.count("copy")
+                failed = self.condition_failed(blob)
+                if failed:
+                    return self.error(*failed)
+                return self.copy(blobs, blob_name)
+            if method == "PUT" and 'comp' not in query:
+                self.count("put_blob")
+                failed = self.condition_failed(blob)
+                if failed:
+                    return self.error(*failed)
+                return self.create(blobs, blob_name, body,
+                                   base64.b64encode(hashlib.md5(body).digest()).decode())
+
+            self.count("unsupported")
+            return self.error(400, "UnsupportedOperation")
+
+    def count(self, operation):
+        self.server.counts[operation] += 1
+
+    # If-None-Match: * only creates missing blobs, If-Match only changes the given version
+    # Returns the status and error code of a failed condition, or None
+    def condition_failed(self, blob):
+        if self.headers.get('If-None-Match') == "*" and blob is not None:
+            return 409, "BlobAlreadyExists"
+        if_match = self.headers.get('If-Match')
+        if if_match and (blob is None or if_match not in ("*", blob['etag'])):
+            return 412, "ConditionNotMet"
+        return None
+
+    def create(self, blobs, blob_name, content, content_md5=None):
+        metadata = {key[len("x-ms-meta-"):].lower(): value for key, value in self.headers.items()
+                    if key.lower().startswith("x-ms-meta-")}
+        tags = dict(parse_qsl(self.headers.get('x-ms-tags', "")))
+        content_md5 = self.headers.get('x-ms-blob-content-md5') or content_md5
+        blob = blobs[blob_name] = self.server.new_blob(content, metadata, tags, content_md5)
+        blob['content_encoding'] = self.headers.get('x-ms-blob-content-encoding')
+        return self.send(201, {'ETag': blob['etag'], 'Last-Modified': blob['last_modified'],
+                               'x-ms-request-server-encrypted': "true"})
+
+    # Copies finish right away, the content and Content-MD5 of the source are copied and the metadata
+    # and tags of the request replace those of the source
+    def copy(self, blobs, blob_name):
+        source_path = unquote(urlsplit(self.headers['x-ms-copy-source']).path).lstrip("/").split("/", 2)
+        source = self.server.containers.get(source_path[1], {}).get(source_path[2]) if len(source_path) == 3 else None
+        if source is None:
+            return self.error(404, "CannotVerifyCopySource")
+        source_if_match = self.headers.get('x-ms-source-if-match')
+        if source_if_match and source_if_match != source['etag']:
+            return self.error(412, "SourceConditionNotMet")
+        metadata = {key[len("x-ms-meta-"):].lower(): value for key, value in self.headers.items()
+                    if key.lower().startswith("x-ms-meta-")}
+        tags = dict(parse_qsl(self.headers.get('x-ms-tags', "")))
+        blob = blobs[blob_name] = self.server.new_blob(source['content'], metadata or dict(source['metadata']),
+                                                       tags, source['content_md5'])
+        blob['content_encoding'] = source['content_encoding']
+        return self.send(202, {'ETag': blob['etag'], 'Last-Modified': blob['last_modified'],
+                               'x-ms-copy-id': "copy-" + blob['etag'].strip('"'), 'x-ms-copy-status': "success"})
+
+    # The whole blob, or the range of x-ms-range or Range
+    def download(self, blob, query):
+        content = blob['content']
+        byte_range = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('x-ms-range') or self.headers.get('Range') or "")
+        if byte_range is None:
+            headers = blob_headers(blob, content_length=len(content), content_encoding=query.get('rsce'))
+            del headers['Content-Length']
+            return self.send(200, headers, content)
+        start = int(byte_range.group(1))
+        end = min(int(byte_range.group(2)) if byte_range.group(2) else len(content) - 1, len(content) - 1)
+        if start >= len(content):
+            return self.error(416, "InvalidRange")
+        headers = blob_headers(blob, content_length=end - start + 1, content_encoding=query.get('rsce'))
+        del headers['Content-Length']
+        headers['Content-Range'] = "bytes %d-%d/%d" % (start, end, len(content))
+        return self.send(206, headers, content[start:end + 1])
+
+    def list_blobs(self, container, blobs, query):
+        prefix = query.get('prefix', "")
+        marker = query.get('marker', "")
+        max_results = int(query.get('maxresults', 5000))
+        include_metadata = "metadata" in query.get('include', "")
+        include_tags = "tags" in query.get('include', "")
+
+        names = sorted(name for name in blobs if name.startswith(prefix) and name > marker)
+        page, rest = names[:max_results], names[max_results:]
+        xml = ['<?xml version="1.0" encoding="utf-8"?>',
+               '<EnumerationResults ServiceEndpoint="%s/" ContainerName="%s">' % (self.server.account_url,
+                                                                                  escape(container)),
+               '<Prefix>%s</Prefix><Marker>%s</Marker><MaxResults>%d</MaxResults><Blobs>' % (
+                   escape(prefix), escape(marker), max_results)]
+        for name in page:
+            blob = blobs[name]
+            xml.append('<Blob><Name>%s</Name><Properties><Last-Modified>%s</Last-Modified><Etag>%s</Etag>'
+                       '<Content-Length>%d</Content-Length><Content-Type>application/octet-stream</Content-Type>'
+                       '<BlobType>BlockBlob</BlobType><LeaseStatus>unlocked</LeaseStatus>'
+                       '<LeaseState>available</LeaseState><ServerEncrypted>true</ServerEncrypted>'
+                       '<Content-MD5>%s</Content-MD5><Content-Encoding>%s</Content-Encoding></Properties>' % (
+                           escape(name), blob['last_modified'], escape(blob['etag']), len(blob['content']),
+                           blob['content_md5'] or "", blob['content_encoding'] or ""))
+            if include_metadata:
+                xml.append('<Metadata>' + "".join('<%s>%s</%s>' % (key, escape(value), key)
+                                                  for key, value in blob['metadata'].items()) + '</Metadata>')
+            if include_tags and blob['tags']:
+                xml.append(tags_xml(blob['tags']))
+            xml.append('</Blob>')
+        xml.append('</Blobs><NextMarker>%s</NextMarker></EnumerationResults>' % (escape(page[-1]) if rest else ""))
+        return self.send(200, {'Content-Type': "application/xml"}, "".join(xml).encode())
+
+    # Blobs of every container whose tags match all conditions of the where expression
+    def find_blobs(self, query):
+        conditions = re.findall(r'("[^"]*"|@container)\s*=\s*\'([^\']*)\'', query.get('where', ""))
+        marker = query.get('marker', "")
+        max_results = int(query.get('maxresults', 5000))
+        found = []
+        for container, blobs in sorted(self.server.containers.items()):
+            for name in sorted(blobs):
+                tags = blobs[name]['tags']
+                if all(value == container if key == "@container" else tags.get(key.strip('"')) == value
+                       for key, value in conditions) and container + "/" + name > marker:
+                    found.append((container, name))
+        page, rest = found[:max_results], found[max_results:]
+        xml = ['<?xml version="1.0" encoding="utf-8"?>',
+               '<EnumerationResults ServiceEndpoint="%s/"><Where>%s</Where><Blobs>' % (
+                   self.server.account_url, escape(query.get('where', "")))]
+        for container, name in page:
+            xml.append('<Blob><Name>%s</Name><ContainerName>%s</ContainerName></Blob>' % (escape(name),
+                                                                                          escape(container)))
+        xml.append('</Blobs><NextMarker>%s</NextMarker></EnumerationResults>' % (
+            escape(page[-1][0] + "/" + page[-1][1]) if rest else ""))
+        return self.send(200, {'Content-Type': "application/xml"}, "".join(xml).encode())
+
+    def error(self, status, code):
+        body = ('<?xml version="1.0" encoding="utf-8"?><Error><Code>%s</Code><Message>%s</Message></Error>'
+                % (code, code)).encode()
+        return self.send(status, {'Content-Type': "application/xml", 'x-ms-error-code': code}, body,
+                         head=self.command == "HEAD")
+
+    def send(self, status, headers, body=b"", head=False):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('x-ms-version', "2019-07-07")
+        if not head:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+
+def parse_tags(element):
+    return {tag.findtext('Key'): tag.findtext('Value') or "" for tag in element.iter('Tag')}
+
+
+def tags_xml(tags):
+    return '<Tags><TagSet>' + "".join('<Tag><Key>%s</Key><Value>%s</Value></Tag>' % (escape(key), escape(value))
+                                      for key, value in tags.items()) + '</TagSet></Tags>'
+
+
+def blob_headers(blob, content_length, content_encoding=None):
+    headers = {'Content-Length': str(content_length), 'Content-Type': "application/octet-stream",
+               'ETag': blob['etag'], 'Last-Modified': blob['last_modified'], 'x-ms-blob-type': "BlockBlob",
+               'x-ms-creation-time': blob['last_modified'], 'x-ms-lease-state': "available",
+               'x-ms-lease-status': "unlocked", 'x-ms-server-encrypted': "true"}
+    if blob['content_md5']:
+        headers['Content-MD5'] = blob['content_md5']
+    if content_encoding or blob['content_encoding']:
+        headers['Content-Encoding'] = content_encoding or blob['content_encoding']
+    for key, value in blob['metadata'].items():
+        headers['x-ms-meta-' + key] = value
+    return headers
@@ -0,0 +1,203 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from fake_blob_service import FakeBlobService, ACCOUNT_NAME, ACCOUNT_KEY
+
+# The app modules are imported from the source folder
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "src", "azstorage-upload")
+sys.path.insert(0, APP_DIR)
+
+from azstorage import AzureStorage, UserStorageSession, BufferedFile  # noqa: E402
+
+CONTAINER = "benchmark"
+USER = "benchmark@example.com"
+PATH = "bench/"
+# Folders per level of the generated folder trees
+FANOUT = 4
+
+
+# Configure options from cmd line
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time AzureStorage operations against a local fake blob service")
+    parser.add_argument("--latency-ms", type=float, nargs="+", default=[0, 20],
+                        help="Latency added to every storage request")
+    parser.add_argument("--blob-counts", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="Number of blobs in the listed folder")
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 4],
+                        help="Levels of subfolders the listed blobs are spread over")
+    parser.add_argument("--file-sizes", type=int, nargs="+", default=[64 * 1024, 4 * 1024 * 1024, 32 * 1024 * 1024],
+                        help="Sizes in bytes of the uploaded files")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each measurement")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Slowdown of the median against the baseline reported as a regression")
+    return parser.parse_args()
+
+
+# Storage of the app connected to the fake service, with the listing cache turned off
+# so every listing goes to the service
+def build_storage(service):
+    app_config = dict(STORAGE_URL=service.account_url, CONTAINER_NAME=CONTAINER, TENANT_ID="", CLIENT_ID="",
+                      CLIENT_SECRET="", ROLES={}, PATHS={}, LISTING_CACHE_TYPE="none")
+    return AzureStorage(app_config, credential=dict(account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY))
+
+
+# Blob names spread evenly over a tree of FANOUT folders per level, depth levels deep
+def blob_names(count, depth):
+    names = []
+    for i in range(count):
+        folders = ["folder%d" % (i // FANOUT ** level % FANOUT) for level in range(depth)]
+        names.append(PATH + "".join(folder + "/" for folder in folders) + "file%06d.txt" % i)
+    return names
+
+
+# Time runs of an operation and count the storage requests each run makes
+# operation is called with the run number and must raise if it fails
+def measure(service, name, params, repeat, operation):
+    timings = []
+    service.reset_counts()
+    for run in range(repeat):
+        start = time.perf_counter()
+        operation(run)
+        timings.append(time.perf_counter() - start)
+    requests = {key: count / repeat for key, count in sorted(service.reset_counts().items())}
+
+    result = dict(operation=name, params=params, runs=repeat,
+                  median_seconds=statistics.median(timings), min_seconds=min(timings), max_seconds=max(timings),
+                  requests=requests)
+    logging.info("%s %s: median %.4f s, %s requests", name, params, result['median_seconds'], requests)
+    return result
+
+
+def check(response):
+    if response.status_code != 200:
+        raise RuntimeError("Storage operation failed: " + response.message)
+
+
+def bench_list_blobs(service, storage, latency_ms, blob_counts, depths, repeat):
+    results = []
+    for count in blob_counts:
+        for depth in depths:
+            service.clear()
+            service.seed(CONTAINER, blob_names(count, depth), metadata={'uploaded_by': USER})
+            results.append(measure(service, "list_blobs", dict(latency_ms=latency_ms, blob_count=count, depth=depth),
+                                   repeat, lambda run: list_all(storage)))
+    return results
+
+
+# List every page of the folder the way the file table does, building every row
+def list_all(storage):
+    continuation = None
+    while True:
+        user_session = UserStorageSession(PATH, USER)
+        check(storage.list_blobs_page(user_session, continuation=continuation))
+        continuation = user_session.continuation
+        if continuation is None:
+            return
+
+
+def bench_upload_blob(service, storage, latency_ms, file_sizes, repeat):
+    results = []
+    service.clear()
+    for size in file_sizes:
+        data = os.urandom(size)
+
+        def upload(run):
+            file = BufferedFile("upload_%d_%d.bin" % (size, run), data)
+            check(storage.upload_blob(file, "", UserStorageSession(PATH, USER), size_hint=size))
+
+        result = measure(service, "upload_blob", dict(latency_ms=latency_ms, file_size=size), repeat, upload)
+        result['median_mb_per_second'] = size / 1048576 / max(result['median_seconds'], 1e-9)
+        results.append(result)
+    return results
+
+
+def bench_delete_blob(service, storage, latency_ms, repeat):
+    service.clear()
+    names = [PATH + "delete%06d.txt" % i for i in range(repeat)]
+    service.seed(CONTAINER, names, size=1024, metadata={'uploaded_by': USER})
+    return [measure(service, "delete_blob", dict(latency_ms=latency_ms), repeat,
+                    lambda run: check(storage.delete_blob(UserStorageSession(PATH, USER), names[run])))]
+
+
+def run(args):
+    results = []
+    for latency_ms in args.latency_ms:
+        service = FakeBlobService(latency=latency_ms / 1000).start()
+        try:
+            storage = build_storage(service)
+            results += bench_list_blobs(service, storage, latency_ms, args.blob_counts, args.depths, args.repeat)
+            results += bench_upload_blob(service, storage, latency_ms, args.file_sizes, args.repeat)
+            results += bench_delete_blob(service, storage, latency_ms, args.repeat)
+            storage.upload_executor.shutdown()
+        finally:
+            service.stop()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=APP_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Key that identifies the same measurement in two result files
+def result_key(result):
+    return result['operation'], tuple(sorted(result['params'].items()))
+
+
+# Print how each measurement changed against the baseline, returns the number of regressions
+# A measurement regressed if its median slowed by more than the tolerance or it made more requests
+def compare(results, baseline, tolerance):
+    baseline_results = {result_key(result): result for result in baseline['results']}
+    regressions = 0
+    for result in results:
+        before = baseline_results.get(result_key(result))
+        if before is None:
+            continue
+        change = result['median_seconds'] / max(before['median_seconds'], 1e-9) - 1
+        more_requests = sum(result['requests'].values()) > sum(before['requests'].values())
+        regressed = change > tolerance or more_requests
+        regressions += regressed
+        print("%-12s %-60s %9.4f s -> %9.4f s %+7.1f%%%s" % (
+            result['operation'], json.dumps(result['params'], sort_keys=True), before['median_seconds'],
+            result['median_seconds'], change * 100, "  REGRESSION" if regressed else ""), file=sys.stderr)
+    return regressions
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger('azure_storage_app').setLevel(logging.WARNING)
+    logging.getLogger('azure').setLevel(logging.WARNING)
+
+    started = datetime.now(timezone.utc).isoformat()
+    results = run(args)
+    report = dict(started=started, commit=git_commit(),
+                  python=platform.python_version(), platform=platform.platform(), results=results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import os
+import sys
+import pytest
+
+# The app modules and the fake blob service of the benchmarks are imported as top level modules
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "..", "src", "azstorage-upload"))
+sys.path.insert(0, os.path.join(TESTS_DIR, "..", "benchmark"))
+
+
+# In-memory blob service for tests of AzureStorage, see tests/benchmark/fake_blob_service.py
+@pytest.fixture()
+def blob_service():
+    from fake_blob_service import FakeBlobService
+    service = FakeBlobService().start()
+    yield service
+    service.stop()
+
+
+# AzureStorage of a container of the fake blob service, extra settings are added to the app config
+@pytest.fixture()
+def make_storage(blob_service):
+    from fake_blob_service import ACCOUNT_NAME, ACCOUNT_KEY
+    from azstorage import AzureStorage
+
+    def make(**settings):
+        app_config = dict(STORAGE_URL=blob_service.account_url, CONTAINER_NAME="container", TENANT_ID="",
+                          CLIENT_ID="", CLIENT_SECRET="", ROLES={}, PATHS={}, LISTING_CACHE_TYPE="none")
+        app_config.update(settings)
+        return AzureStorage(app_config, credential=dict(account_name=ACCOUNT_NAME, account_key=ACCOUNT_KEY))
+    return make
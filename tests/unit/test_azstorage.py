@@ -0,0 +1,111 @@
+import hashlib
+import io
+import os
+import uuid
+import pytest
+from azstorage import UserStorageSession
+from compression import CONTENT_ENCODING
+from inventory import CHUNK_MD5_KEY, chunked_md5
+
+CHUNK_SIZE = 1024 * 1024
+USER = "a@x.com"
+
+
+# File part of a chunk upload request, see multipart_stream.FilePart
+class ChunkPart:
+
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.data = io.BytesIO(data)
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.data.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    @property
+    def stream(self):
+        return self
+
+
+@pytest.fixture()
+def storage(make_storage, tmp_path):
+    return make_storage(UPLOAD_CHUNK_SIZE=CHUNK_SIZE, INVENTORY_INDEX=True, INVENTORY_PATH=str(tmp_path / "inventory.db"),
+                        INVENTORY_RECONCILE_INTERVAL=3600, UPLOAD_DEDUPE=True)
+
+
+def chunks_of(data):
+    return [data[i:i + CHUNK_SIZE] for i in range(0, len(data), CHUNK_SIZE)]
+
+
+# Send a file in chunks the way the upload page does and commit it
+def chunked_upload(storage, filename, folder, data, page_md5=None):
+    user_session = UserStorageSession(folder, USER)
+    upload_id = str(uuid.uuid4())
+    chunks = chunks_of(data)
+    for i, chunk in enumerate(chunks):
+        response = storage.stage_chunk(ChunkPart(filename, chunk), "", user_session, upload_id, i, len(chunk))
+        assert response.status_code == 200, response.message
+    return storage.commit_chunks(filename, "", user_session, upload_id, len(chunks), page_md5)
+
+
+def test_chunked_upload(storage, blob_service):
+    data = os.urandom(2 * CHUNK_SIZE + 100)
+    response = chunked_upload(storage, "a.bin", "f/", data)
+    assert response.status_code == 200, response.message
+    assert blob_service.containers["container"]["f/a.bin"]["content"] == data
+
+
+def test_commit_missing_chunk(storage):
+    user_session = UserStorageSession("f/", USER)
+    upload_id = str(uuid.uuid4())
+    storage.stage_chunk(ChunkPart("a.bin", b"data"), "", user_session, upload_id, 0, 4)
+    response = storage.commit_chunks("a.bin", "", user_session, upload_id, 2)
+    assert response.status_code == 400
+
+
+# Chunks are hashed as they are staged and the file gets the hash of its chunks without being read back
+def test_chunk_hashes_recorded(storage, blob_service):
+    data = os.urandom(2 * CHUNK_SIZE + 100)
+    expected = chunked_md5(hashlib.md5(chunk).digest() for chunk in chunks_of(data))
+    assert chunked_upload(storage, "a.bin", "f/", data).status_code == 200
+    assert blob_service.counts["download"] == 0
+    properties = storage.container_client.get_blob_client("f/a.bin").get_blob_properties()
+    assert properties.metadata[CHUNK_MD5_KEY] == expected
+    assert storage.inventory.find_content(expected, len(data), USER) == ["f/a.bin"]
+
+
+def test_copy_duplicate(storage, blob_service):
+    data = os.urandom(CHUNK_SIZE + 1)
+    content_md5 = chunked_md5(hashlib.md5(chunk).digest() for chunk in chunks_of(data))
+    chunked_upload(storage, "a.bin", "f/", data)
+
+    user_session = UserStorageSession("g/", USER)
+    response = storage.copy_duplicate("b.bin", "", user_session, content_md5, len(data), ["f/", "g/"])
+    assert response.status_code == 200, response.message
+    assert blob_service.containers["container"]["g/b.bin"]["content"] == data
+    # Only the user's own uploads are copied
+    response = storage.copy_duplicate("c.bin", "", UserStorageSession("g/", "b@x.com"), content_md5, len(data),
+                                      ["f/", "g/"])
+    assert response.status_code == 404
+
+
+def test_compressed_chunks(storage, blob_service):
+    storage.compressed_paths = ["t/"]
+    text = b"".join(b"line %d\n" % i for i in range(300000))
+    assert chunked_upload(storage, "a.txt", "t/", text).status_code == 200
+    properties = storage.container_client.get_blob_client("t/a.txt").get_blob_properties()
+    assert properties.content_settings.content_encoding == CONTENT_ENCODING
+    assert int(properties.metadata['original_size']) == len(text)
+    assert properties.metadata[CHUNK_MD5_KEY] == chunked_md5(hashlib.md5(chunk).digest() for chunk in chunks_of(text))
+
+
+def test_compressed_chunk_too_large(storage):
+    storage.compressed_paths = ["t/"]
+    user_session = UserStorageSession("t/", USER)
+    chunk = b"a" * (CHUNK_SIZE + 1)
+    for length in (len(chunk), None):
+        response = storage.stage_chunk(ChunkPart("a.txt", chunk), "", user_session, str(uuid.uuid4()), 0, length)
+        assert response.status_code == 400
+    assert storage.memory_budget.reserved == 0
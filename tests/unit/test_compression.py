@@ -0,0 +1,71 @@
+import gzip
+import hashlib
+import io
+import os
+from types import SimpleNamespace
+from compression import (GzipStream, gzip_chunk, iter_gunzip, is_compressed, logical_size, compressible,
+                         CONTENT_ENCODING, ORIGINAL_SIZE_KEY, ORIGINAL_MD5_KEY)
+
+TEXT = b"".join(b"line %d of a compressible text file\n" % i for i in range(100000))
+
+
+def read_all(stream, size):
+    data = b""
+    while True:
+        chunk = stream.read(size)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_gzip_stream_round_trip():
+    stream = GzipStream(io.BytesIO(TEXT), buffer_size=1000)
+    compressed = read_all(stream, 4096)
+    assert len(compressed) < len(TEXT) / 5
+    assert gzip.decompress(compressed) == TEXT
+    assert stream.metadata() == {ORIGINAL_SIZE_KEY: str(len(TEXT)), ORIGINAL_MD5_KEY: hashlib.md5(TEXT).hexdigest()}
+
+
+# The chunks of a chunked upload are compressed one by one, and their gzip members joined in order
+# are the compressed file
+def test_gzip_members_round_trip():
+    chunks = [TEXT[i:i + 100000] for i in range(0, len(TEXT), 100000)]
+    compressed = b"".join(gzip_chunk(chunk) for chunk in chunks)
+    assert gzip.decompress(compressed) == TEXT
+    # The blob is read back in pieces that do not line up with the members
+    pieces = [compressed[i:i + 777] for i in range(0, len(compressed), 777)]
+    assert b"".join(iter_gunzip(pieces)) == TEXT
+
+
+def test_gunzip_bounds_output_pieces():
+    data = b"\0" * 5000000
+    pieces = list(iter_gunzip([gzip_chunk(data)], out_size=65536))
+    assert b"".join(pieces) == data
+    assert max(len(piece) for piece in pieces) <= 65536
+
+
+def test_gunzip_empty_members():
+    assert b"".join(iter_gunzip([gzip_chunk(b""), gzip_chunk(b"abc"), gzip_chunk(b"")])) == b"abc"
+
+
+def test_gunzip_random_data():
+    data = os.urandom(300000)
+    assert b"".join(iter_gunzip([gzip_chunk(data)], out_size=1000)) == data
+
+
+def test_logical_size():
+    compressed = SimpleNamespace(size=10, content_settings=SimpleNamespace(content_encoding=CONTENT_ENCODING),
+                                 metadata={ORIGINAL_SIZE_KEY: "1000"})
+    plain = SimpleNamespace(size=10, content_settings=SimpleNamespace(content_encoding=None), metadata={})
+    unknown = SimpleNamespace(size=10, content_settings=SimpleNamespace(content_encoding=CONTENT_ENCODING),
+                              metadata=None)
+    assert is_compressed(compressed) and not is_compressed(plain)
+    assert (logical_size(compressed), logical_size(plain), logical_size(unknown)) == (1000, 10, 10)
+
+
+def test_compressible():
+    content_types = ["text/", "application/json"]
+    assert compressible("a.csv", content_types)
+    assert compressible("a.json", content_types)
+    assert not compressible("a.zip", content_types)
+    assert not compressible("no_extension", content_types)
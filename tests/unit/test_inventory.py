@@ -0,0 +1,124 @@
+import hashlib
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+from listing_cache import BlobEntry
+from inventory import Inventory, INVENTORY_TOKEN_PREFIX, CHUNK_MD5_KEY, blob_content_md5, chunked_md5
+
+MODIFIED = datetime(2020, 6, 1, tzinfo=timezone.utc)
+
+
+# Listed blob with the attributes the inventory reads
+def listed_blob(name, size=10, etag="1", uploaded_by="a@x.com", content_md5=None, metadata=None):
+    return SimpleNamespace(name=name, size=size, last_modified=MODIFIED, etag=etag,
+                           metadata=dict(metadata or {}, uploaded_by=uploaded_by),
+                           content_settings=SimpleNamespace(content_encoding=None, content_md5=content_md5))
+
+
+@pytest.fixture()
+def inventory(tmp_path):
+    return Inventory(str(tmp_path / "inventory.db"), reconcile_interval=60)
+
+
+def names(entries):
+    return [entry.name for entry in entries]
+
+
+def test_reconcile_adds_changes_and_removes(inventory):
+    inventory.reconcile([listed_blob("a/1"), listed_blob("a/2"), listed_blob("b/1")])
+    assert names(inventory.entries("")) == ["a/1", "a/2", "b/1"]
+    assert inventory.ready()
+
+    inventory.reconcile([listed_blob("a/1", size=20, etag="2"), listed_blob("b/1"), listed_blob("c/1")])
+    assert [(entry.name, entry.size) for entry in inventory.entries("")] == [("a/1", 20), ("b/1", 10), ("c/1", 10)]
+    assert names(inventory.entries("a/")) == ["a/1"]
+
+
+# Blobs missing between two listing pages are found as well, pages are 5000 blobs
+def test_reconcile_removes_across_pages(inventory):
+    inventory.reconcile([listed_blob("%05d" % i) for i in range(12000)])
+    listing = [listed_blob("%05d" % i) for i in range(12000) if i not in (4999, 5000, 11999)]
+    inventory.reconcile(listing)
+    assert len(inventory.entries("")) == 11997
+    assert "05000" not in names(inventory.entries(""))
+
+
+# Our own writes made while a listing runs are newer than the listing and kept
+def test_reconcile_keeps_writes_during_listing(inventory):
+    inventory.reconcile([listed_blob("a"), listed_blob("b")])
+
+    def listing():
+        yield listed_blob("a")
+        inventory.add(BlobEntry("c", 5, "a@x.com"))
+        inventory.remove("b")
+        yield listed_blob("b")
+
+    inventory.reconcile(listing())
+    assert names(inventory.entries("")) == ["a", "c"]
+    # Listings started after the writes are trusted again
+    inventory.reconcile([listed_blob("a")])
+    assert names(inventory.entries("")) == ["a"]
+
+
+def test_claim_reconcile_once_per_interval(inventory, tmp_path):
+    other = Inventory(str(tmp_path / "inventory.db"), reconcile_interval=60)
+    assert inventory.claim_reconcile()
+    assert not other.claim_reconcile()
+    assert not inventory.claim_reconcile()
+
+
+def test_not_ready_before_listing(inventory):
+    assert not inventory.ready()
+
+
+def test_pages(inventory):
+    inventory.reconcile([listed_blob("p/%d" % i) for i in range(5)] + [listed_blob("q/1")])
+    entries, continuation = inventory.page("p/", None, 2)
+    assert names(entries) == ["p/0", "p/1"] and continuation == INVENTORY_TOKEN_PREFIX + "p/1"
+    entries, continuation = inventory.page("p/", continuation, 2)
+    entries, continuation = inventory.page("p/", continuation, 2)
+    assert names(entries) == ["p/4"] and continuation is None
+
+
+def test_find_content_of_user(inventory):
+    digest = hashlib.md5(b"content").digest()
+    inventory.reconcile([listed_blob("a/1", content_md5=bytearray(digest)),
+                         listed_blob("a/2", content_md5=bytearray(digest), uploaded_by="b@x.com"),
+                         listed_blob("a/3", size=11, content_md5=bytearray(digest))])
+    assert inventory.find_content(digest.hex(), 10, "a@x.com") == ["a/1"]
+    inventory.remove("a/1")
+    assert inventory.find_content(digest.hex(), 10, "a@x.com") == []
+
+
+def test_chunk_hash_of_blob_preferred():
+    blob = listed_blob("a", content_md5=bytearray(16), metadata={CHUNK_MD5_KEY: "ab" * 16})
+    assert blob_content_md5(blob) == "ab" * 16
+    assert blob_content_md5(listed_blob("b", content_md5=bytearray(16))) == "00" * 16
+    assert blob_content_md5(listed_blob("c")) is None
+
+
+def test_chunk_ledger(inventory):
+    chunks = [b"a" * 100, b"b" * 100, b"c" * 50]
+    for i, chunk in enumerate(chunks):
+        inventory.add_chunk("f/x.bin", "upload", i, len(chunk), hashlib.md5(chunk).digest())
+    expected = chunked_md5(hashlib.md5(chunk).digest() for chunk in chunks)
+    assert inventory.chunk_md5("f/x.bin", "upload", [100, 100, 50]) == expected
+    # A chunk sent again replaces the one recorded before
+    inventory.add_chunk("f/x.bin", "upload", 2, 50, hashlib.md5(b"d" * 50).digest())
+    assert inventory.chunk_md5("f/x.bin", "upload", [100, 100, 50]) != expected
+    # Unknown chunks, other sizes than staged and other uploads give no hash
+    assert inventory.chunk_md5("f/x.bin", "upload", [100, 100, 50, 10]) is None
+    assert inventory.chunk_md5("f/x.bin", "upload", [100, 100, 60]) is None
+    assert inventory.chunk_md5("f/y.bin", "upload", [100, 100, 50]) is None
+    inventory.remove_chunks("f/x.bin", "upload")
+    assert inventory.chunk_md5("f/x.bin", "upload", [100]) is None
+
+
+def test_reconcile_purges_old_chunks(inventory):
+    inventory.add_chunk("f/x.bin", "old", 0, 1, bytes(16))
+    inventory.add_chunk("f/x.bin", "new", 0, 1, bytes(16))
+    with inventory.connection() as db:
+        db.execute("UPDATE chunk_hashes SET staged = staged - 8 * 24 * 60 * 60 WHERE upload_id = 'old'")
+    inventory.reconcile([])
+    assert inventory.chunk_md5("f/x.bin", "old", [1]) is None
+    assert inventory.chunk_md5("f/x.bin", "new", [1]) is not None
@@ -0,0 +1,64 @@
+import threading
+import time
+import pytest
+from memory_budget import MemoryBudget, MemoryBudgetExceeded, ReservedBody
+
+
+def test_acquire_and_release():
+    budget = MemoryBudget(100, timeout=0.1)
+    assert budget.acquire(60) == 60
+    assert budget.acquire(40) == 40
+    with pytest.raises(MemoryBudgetExceeded):
+        budget.acquire(1)
+    budget.release(60)
+    with budget.reserve(50):
+        assert budget.reserved == 90
+    assert budget.reserved == 40
+
+
+# A reservation larger than the budget is cut to the budget, so it runs once nothing else is reserved
+def test_large_reservation_cut_to_budget():
+    budget = MemoryBudget(100, timeout=0.1)
+    assert budget.acquire(1000) == 100
+    budget.release(100)
+    assert budget.reserved == 0
+
+
+def test_waits_for_release():
+    budget = MemoryBudget(100, timeout=5)
+    budget.acquire(100)
+    threading.Timer(0.1, budget.release, args=(100,)).start()
+    started = time.monotonic()
+    assert budget.acquire(50) == 50
+    assert 0.05 < time.monotonic() - started < 5
+
+
+def test_disabled():
+    budget = MemoryBudget(0)
+    assert budget.acquire(10 ** 12) == 0
+    budget.release(0)
+
+
+def test_reserved_body_released_after_iteration():
+    budget = MemoryBudget(100)
+    body = ReservedBody(budget, iter([b"a", b"b"]), budget.acquire(80))
+    assert b"".join(body) == b"ab"
+    assert budget.reserved == 0
+
+
+# The server closes the body of a response it did not send, such as the response to a client that went away
+def test_reserved_body_released_on_close():
+    closed = []
+
+    class Body:
+        def __iter__(self):
+            yield b"a"
+
+        def close(self):
+            closed.append(True)
+
+    budget = MemoryBudget(100)
+    body = ReservedBody(budget, Body(), budget.acquire(80))
+    body.close()
+    body.close()
+    assert budget.reserved == 0 and closed == [True, True]
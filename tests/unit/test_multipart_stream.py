@@ -0,0 +1,116 @@
+import io
+import os
+import pytest
+from multipart_stream import MultipartStream, MAX_FIELD_SIZE
+
+BOUNDARY = b"----dropzoneboundary"
+
+
+# Body of a multipart/form-data request with the fields and then the files, given as (name, filename, content)
+def multipart_body(fields, files, boundary=BOUNDARY):
+    body = b""
+    for name, value in fields.items():
+        body += (b"--" + boundary + b"\r\nContent-Disposition: form-data; name=\"" + name.encode() + b"\"\r\n\r\n" +
+                 value.encode() + b"\r\n")
+    for name, filename, content in files:
+        body += (b"--" + boundary + b"\r\nContent-Disposition: form-data; name=\"" + name.encode() +
+                 b"\"; filename=\"" + filename.encode() + b"\"\r\nContent-Type: application/octet-stream\r\n\r\n" +
+                 content + b"\r\n")
+    return body + b"--" + boundary + b"--\r\n"
+
+
+# Stream that returns at most read_size bytes per read, like a request body arriving in pieces
+class TrickleStream:
+
+    def __init__(self, data, read_size):
+        self.data = io.BytesIO(data)
+        self.read_size = read_size
+
+    def read(self, size=-1):
+        return self.data.read(min(size, self.read_size) if size >= 0 else self.read_size)
+
+
+def read_all(part, size):
+    data = b""
+    while True:
+        chunk = part.read(size)
+        if not chunk:
+            return data
+        data += chunk
+
+
+def test_parse_fields_and_file():
+    content = os.urandom(200000)
+    body = multipart_body({"dzuuid": "abc", "subfolder": "a/b"}, [("file", "data.bin", content)])
+    fields, part = MultipartStream(io.BytesIO(body), BOUNDARY, buffer_size=4096).parse()
+    assert fields == {"dzuuid": "abc", "subfolder": "a/b"}
+    assert part.filename == "data.bin"
+    assert part.content_type == "application/octet-stream"
+    assert read_all(part, 1000) == content
+    assert part.bytes_read == len(content)
+
+
+# Every split of the delimiter across two reads of the request stream must still be found
+@pytest.mark.parametrize("read_size", [1, 7, 23, 64, 1000])
+def test_delimiter_split_across_reads(read_size):
+    content = os.urandom(3000)
+    body = multipart_body({"name": "value"}, [("file", "a.bin", content)])
+    fields, part = MultipartStream(TrickleStream(body, read_size), BOUNDARY, buffer_size=64).parse()
+    assert fields == {"name": "value"}
+    assert read_all(part, 100) == content
+
+
+# Content that holds the start of the delimiter without the whole of it is file data
+def test_partial_delimiter_in_content():
+    content = b"x\r\n--" + BOUNDARY[:-1] + b"z\r\n-" + b"\r\n--" + BOUNDARY[:5]
+    body = multipart_body({}, [("file", "a.bin", content)])
+    for buffer_size in (8, 16, 4096):
+        fields, part = MultipartStream(io.BytesIO(body), BOUNDARY, buffer_size=buffer_size).parse()
+        assert part.read() == content
+
+
+def test_empty_file():
+    body = multipart_body({}, [("file", "empty.txt", b"")])
+    fields, part = MultipartStream(io.BytesIO(body), BOUNDARY).parse()
+    assert part.read() == b""
+
+
+def test_no_file():
+    body = multipart_body({"a": "1"}, [])
+    fields, part = MultipartStream(io.BytesIO(body), BOUNDARY).parse()
+    assert fields == {"a": "1"}
+    assert part is None
+
+
+# Files of a batch upload are yielded in order, and a file that is not read to its end is skipped
+def test_several_files():
+    files = [("file[0]", "a.bin", os.urandom(5000)), ("file[1]", "b.bin", os.urandom(10)),
+             ("file[2]", "c.bin", os.urandom(7000))]
+    body = multipart_body({"subfolder": "s"}, files)
+    parts = MultipartStream(TrickleStream(body, 333), BOUNDARY, buffer_size=512).files()
+    fields, part = next(parts)
+    assert (fields, part.filename, read_all(part, 100)) == ({"subfolder": "s"}, "a.bin", files[0][2])
+    fields, part = next(parts)
+    assert part.read(3) == files[1][2][:3]
+    fields, part = next(parts)
+    assert (part.filename, part.read()) == ("c.bin", files[2][2])
+    assert next(parts, None) is None
+
+
+def test_field_too_large():
+    body = multipart_body({"big": "x" * (MAX_FIELD_SIZE + 1)}, [("file", "a.bin", b"data")])
+    with pytest.raises(ValueError):
+        MultipartStream(io.BytesIO(body), BOUNDARY).parse()
+
+
+def test_truncated_body():
+    body = multipart_body({}, [("file", "a.bin", os.urandom(1000))])[:-100]
+    fields, part = MultipartStream(io.BytesIO(body), BOUNDARY, buffer_size=64).parse()
+    with pytest.raises(ValueError):
+        read_all(part, 100)
+
+
+def test_invalid_part_headers():
+    body = b"--" + BOUNDARY + b"\r\nContent-Disposition: attachment\r\n\r\ndata\r\n--" + BOUNDARY + b"--\r\n"
+    with pytest.raises(ValueError):
+        MultipartStream(io.BytesIO(body), BOUNDARY).parse()
@@ -0,0 +1,114 @@
+from flask import Flask, session
+from session_store import MemorySessionStore, RedisSessionStore, compact_token_cache
+
+
+# Memory store that counts how often each operation reaches the store
+class CountingStore(MemorySessionStore):
+
+    def __init__(self, ttl, touch_interval=60):
+        super().__init__(ttl)
+        self.touch_interval = touch_interval
+        self.calls = []
+
+    def _load(self, sid):
+        self.calls.append('load')
+        return super()._load(sid)
+
+    def _store(self, sid, value):
+        self.calls.append('store')
+        super()._store(sid, value)
+
+    def _touch(self, sid):
+        self.calls.append('touch')
+        super()._touch(sid)
+
+
+def make_app(store):
+    app = Flask(__name__)
+    app.secret_key = "secret"
+    app.session_interface = store
+
+    @app.route('/login/<user>')
+    def login(user):
+        session['user'] = user
+        return "ok"
+
+    @app.route('/logout')
+    def logout():
+        session.clear()
+        return "ok"
+
+    @app.route('/user')
+    def user():
+        return str(session.get('user'))
+
+    @app.route('/healthz')
+    def healthz():
+        return "ok"
+
+    return app
+
+
+def test_session_round_trip():
+    client = make_app(MemorySessionStore(60)).test_client()
+    assert client.get('/user').data == b"None"
+    client.get('/login/alice')
+    assert client.get('/user').data == b"alice"
+    client.get('/logout')
+    assert client.get('/user').data == b"None"
+
+
+def test_expired_session():
+    store = MemorySessionStore(0)
+    client = make_app(store).test_client()
+    client.get('/login/alice')
+    assert client.get('/user').data == b"None"
+
+
+# An unchanged session has its expiry extended at most once per touch interval
+def test_touch_interval():
+    store = CountingStore(60, touch_interval=60)
+    client = make_app(store).test_client()
+    client.get('/login/alice')
+    for i in range(5):
+        client.get('/user')
+    assert store.calls.count('touch') == 1
+    assert store.calls.count('store') == 1
+    store.touch_interval = 0
+    client.get('/user')
+    assert store.calls.count('touch') == 2
+
+
+def test_sessionless_paths():
+    store = CountingStore(60)
+    client = make_app(store).test_client()
+    client.get('/login/alice')
+    calls = len(store.calls)
+    response = client.get('/healthz')
+    assert 'Set-Cookie' not in response.headers
+    assert len(store.calls) == calls
+
+
+def test_unreadable_session_discarded():
+    store = MemorySessionStore(60)
+    client = make_app(store).test_client()
+    store._store("broken", b"not json")
+    client.set_cookie("localhost", "session", "broken")
+    assert client.get('/user').data == b"None"
+
+
+# With Redis down requests go on without the session, and the cookie is left alone for when it is back
+def test_redis_unavailable():
+    store = RedisSessionStore(60, "redis://127.0.0.1:1/0", "container")
+    client = make_app(store).test_client()
+    client.set_cookie("localhost", "session", "existing")
+    response = client.get('/user')
+    assert (response.status_code, response.data) == (200, b"None")
+    assert 'Set-Cookie' not in response.headers
+    assert client.get('/login/alice').status_code == 200
+    assert client.get('/logout').status_code == 200
+
+
+def test_compact_token_cache():
+    cache = '{"Account": {"a": 1}, "IdToken": {"b": 2}, "AccessToken": {}, "RefreshToken": {"c": 3}}'
+    assert compact_token_cache(cache) == '{"Account":{"a":1},"RefreshToken":{"c":3}}'
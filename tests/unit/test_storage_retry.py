@@ -0,0 +1,129 @@
+import time
+import pytest
+from azure.core.exceptions import AzureError, HttpResponseError
+from azure.core.pipeline import PipelineRequest, PipelineContext
+from azure.core.pipeline.transport import HttpRequest
+import storage_retry
+from storage_retry import (CircuitBreaker, StorageRetry, StorageUnavailableError, CIRCUIT_CLOSED, CIRCUIT_OPEN,
+                           CIRCUIT_HALF_OPEN)
+
+
+# Stands in for time.monotonic in storage_retry so tests can move the clock
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(storage_retry.time, 'monotonic', clock)
+    return clock
+
+
+def pipeline_request(**options):
+    return PipelineRequest(HttpRequest("GET", "https://account.blob.core.windows.net/container/a.txt"),
+                           PipelineContext(None, **options))
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for i in range(2):
+        breaker.record_failure()
+    assert breaker.state == CIRCUIT_CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN and not breaker.allow()
+
+
+def test_breaker_success_resets_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_CLOSED
+
+
+# After reset_timeout one trial request is let through, its outcome closes or opens the circuit again
+def test_breaker_half_open_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.allow() and breaker.state == CIRCUIT_HALF_OPEN
+    # Other requests wait for the trial
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN
+    clock.now += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CIRCUIT_CLOSED and breaker.allow()
+
+
+def test_breaker_disabled(clock):
+    breaker = CircuitBreaker(failure_threshold=0)
+    for i in range(100):
+        breaker.record_failure()
+    assert breaker.allow() and breaker.state == CIRCUIT_CLOSED
+
+
+def test_timeouts_limited_by_deadline(clock):
+    policy = StorageRetry(CircuitBreaker(), deadline=20, connection_timeout=10, read_timeout=30)
+    request = pipeline_request()
+    settings = policy.configure_retries(request)
+    assert request.context.options == dict(connection_timeout=10, read_timeout=20)
+    # The timeouts of the next attempt end at the deadline, but are never below a second
+    policy.limit_timeouts(settings, 5)
+    assert request.context.options == dict(connection_timeout=5, read_timeout=5)
+    policy.limit_timeouts(settings, 0.1)
+    assert request.context.options == dict(connection_timeout=1, read_timeout=1)
+
+
+def test_retry_within_deadline(clock):
+    policy = StorageRetry(CircuitBreaker(), initial_backoff=2, max_backoff=8, deadline=30)
+    request = pipeline_request()
+    settings = policy.configure_retries(request)
+    policy.increment(settings, request.http_request, error=AzureError("failed"))
+    backoff = policy.next_backoff(settings)
+    assert 0 <= backoff <= 2
+
+
+def test_no_retry_past_deadline(clock):
+    policy = StorageRetry(CircuitBreaker(), initial_backoff=2, max_backoff=8, deadline=30)
+    request = pipeline_request()
+    settings = policy.configure_retries(request)
+    policy.increment(settings, request.http_request, error=AzureError("failed"))
+    clock.now += 30
+    with pytest.raises(StorageUnavailableError) as e:
+        policy.next_backoff(settings)
+    assert "GET /container/a.txt failed with AzureError" in str(e.value)
+
+
+def test_backoff_doubles_up_to_max(monkeypatch):
+    monkeypatch.setattr(storage_retry.random, 'uniform', lambda low, high: high)
+    policy = StorageRetry(CircuitBreaker(), initial_backoff=0.5, max_backoff=3)
+    assert [policy.get_backoff_time(dict(count=count)) for count in range(1, 6)] == [0.5, 1, 2, 3, 3]
+
+
+# Storage requests fail at once while the circuit is open, without waiting for the retries
+def test_open_circuit_fails_requests(make_storage, blob_service):
+    blob_service.busy_rate = 1.0
+    storage = make_storage(STORAGE_RETRY_TOTAL=1, STORAGE_RETRY_BACKOFF=0.01, STORAGE_CIRCUIT_FAILURES=2,
+                           STORAGE_CIRCUIT_RESET=60)
+    blob = storage.container_client.get_blob_client("a.txt")
+    with pytest.raises(HttpResponseError):
+        blob.get_blob_properties()
+    assert storage.circuit_breaker.state == CIRCUIT_OPEN
+    requests = sum(blob_service.counts.values())
+    started = time.monotonic()
+    with pytest.raises(StorageUnavailableError):
+        blob.get_blob_properties()
+    assert time.monotonic() - started < 1
+    assert sum(blob_service.counts.values()) == requests
@@ -0,0 +1,49 @@
+import io
+import os
+import zipfile
+from datetime import datetime
+from zip_stream import iter_zip
+
+MODIFIED = datetime(2020, 6, 1, 12, 30, 10)
+
+
+def chunks_of(data, size):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def test_zip_round_trip():
+    files = {"a.txt": b"hello", "sub/b.bin": os.urandom(300000), "empty": b""}
+    entries = [(name, len(data), MODIFIED, chunks_of(data, 65536)) for name, data in files.items()]
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(iter_zip(entries))))
+    assert archive.testzip() is None
+    assert archive.namelist() == list(files)
+    for name, data in files.items():
+        assert archive.read(name) == data
+        assert archive.getinfo(name).date_time == (2020, 6, 1, 12, 30, 10)
+        assert archive.getinfo(name).compress_type == zipfile.ZIP_STORED
+
+
+# The archive is written to an output that can't seek, so the sizes and CRC of each entry follow
+# its content in a data descriptor
+def test_entries_have_data_descriptors():
+    data = os.urandom(1000)
+    archive = zipfile.ZipFile(io.BytesIO(b"".join(iter_zip([("a.bin", len(data), MODIFIED, [data])]))))
+    assert archive.getinfo("a.bin").flag_bits & 0x08
+
+
+# Each chunk of an entry is sent as soon as it is written instead of after the whole archive
+def test_streams_while_reading():
+    read = []
+
+    def chunks():
+        for i in range(5):
+            read.append(i)
+            yield bytes([i]) * 1000
+
+    pieces = iter_zip([("a.bin", 5000, MODIFIED, chunks())])
+    sent = 0
+    for piece in pieces:
+        sent += len(piece)
+        if sent > 1000:
+            break
+    assert len(read) < 5